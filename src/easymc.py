@@ -1,22 +1,58 @@
 
 import socket
+import threading
+import hashlib
+import bisect
+import cPickle
+import time
+import SocketServer
+
+
+class MemcacheError( IOError ):
+    pass
+
 
 class Memcache( object ):
     
-    def __init__( self, host, port ):
+    FLAG_PICKLE = 1
+    
+    def __init__( self, host, port, timeout=None ):
+        
+        self.addr = ( host, port )
+        self.timeout = timeout
+        
+        self.conn = None
+        self.buffer = ''
+        
+        # a connection can only run one command at once
+        self.lock = threading.Lock()
+        
+        return
+    
+    def _connect( self ):
         
         self.conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.conn.settimeout( self.timeout )
         
-        self.conn((host, port))
+        self.conn.connect( self.addr )
         
         self.buffer = ''
         
         return
+    
+    def close( self ):
+        
+        if self.conn != None :
+            self.conn.close()
         
+        self.conn = None
+        self.buffer = ''
+        
+        return
     
     def _send( self, s ):
         
-        return self.conn.send( s )
+        return self.conn.sendall( s )
     
     def _readline( self ):
         
@@ -31,7 +67,7 @@ class Memcache( object ):
             data = recv(4096)
             if not data:
                 self.buffer = ''
-                return None
+                raise MemcacheError( 'connection closed by server' )
             buf += data
             
             
@@ -48,7 +84,7 @@ class Memcache( object ):
             foo = self_socket_recv(max(rlen - len(buf), 4096))
             buf += foo
             if not foo:
-                raise _Error( 'Read %d bytes, expecting %d, '
+                raise MemcacheError( 'Read %d bytes, expecting %d, '
                         'read returned 0 length bytes' % ( len(buf), rlen ))
         
         self.buffer = buf[rlen:]
@@ -65,30 +101,32 @@ class Memcache( object ):
         
         
         <command name> : set add replace
+        
+        return True if stored, False if not stored
         '''
         
         bytes = len(contain)
         
-        self._send( '%s %s %d %d %d\r\n' %
-                    (cmd, key, flags, exptime, bytes)
+        self._send( '%s %s %d %d %d\r\n%s\r\n' %
+                    (cmd, key, flags, exptime, bytes, contain)
                   )
         
-        self._send( contain + '\r\n')
-        
         r = self._readline()
         
         if r == "STORED" :
-            return
+            return True
+        elif r == "NOT_STORED" :
+            return False
         else :
-            raise Exception(r)
+            raise MemcacheError(r)
         
-    def _set( key, flags, exptime, contain ):
+    def _set( self, key, flags, exptime, contain ):
         return self._store( 'set', key, flags, exptime, contain )
         
-    def _add( key, flags, exptime, contain ):
+    def _add( self, key, flags, exptime, contain ):
         return self._store( 'add', key, flags, exptime, contain )
 
-    def _replace( key, flags, exptime, contain ):
+    def _replace( self, key, flags, exptime, contain ):
         return self._store( 'replace', key, flags, exptime, contain )
 
     def _get( self, keys ):
@@ -98,56 +136,90 @@ class Memcache( object ):
         VALUE <key> <flags> <bytes>\r\n
         <data block>\r\n
         "END\r\n"
+        
+        return { key : ( flags, data ), ... } of the keys found
         '''
         
         keylist = ' '.join(keys)
         
         self._send( 'get %s\r\n' % ( keylist, ) )
         
-        r = []
-        for k in keys :
-            v, ke, flags, le = self._readline().split(' ')
-            data = self._read(le)
+        r = {}
+        while True :
+            
+            x = self._readline()
+            
+            if x == 'END' :
+                break
+            
+            if not x.startswith('VALUE ') :
+                raise MemcacheError(x)
+            
+            v, ke, flags, le = x.split(' ')[:4]
+            data = self._read( int(le) )
             self._readline()
-            r.append( ( flags, data ) )
-        
-        ed = self._readline()
+            r[ke] = ( int(flags), data )
         
         return r
 
-    def _delete( self, key, time ):
+    def _delete( self, key, time=None ):
         '''
-        delete <key> <time>\r\n
+        delete <key> [<time>]\r\n
         
         - "DELETED\r\n"
         - "NOT_FOUND\r\n"
+        
+        return True if deleted, False if not found
         '''
         
-        self._send( 'delete %s %s\r\n' % ( key, time ) )
+        if time == None :
+            self._send( 'delete %s\r\n' % ( key, ) )
+        else :
+            self._send( 'delete %s %s\r\n' % ( key, time ) )
         
         r = self._readline()
         
         if r == 'DELETED' :
-            return
+            return True
+        elif r == 'NOT_FOUND' :
+            return False
+        
+        raise MemcacheError(r)
+    
+    def _incdec( self, cmd, key, value ):
         
-        raise Exception(r)
+        self._send( '%s %s %d\r\n' % ( cmd, key, value ) )
+        
+        r = self._readline()
+        
+        if r == 'NOT_FOUND' :
+            return None
+        
+        if not r.isdigit() :
+            raise MemcacheError(r)
+        
+        return int(r)
         
     def _inc( self, key, value ):
         '''
-        <key> <value>\r\n
+        incr <key> <value>\r\n
         
         - "NOT_FOUND\r\n"
         - <value>\r\n
         '''
+        
+        return self._incdec( 'incr', key, value )
 
     def _dec( self, key, value ):
         '''
-        <key> <value>\r\n
+        decr <key> <value>\r\n
         
         - "NOT_FOUND\r\n"
         - <value>\r\n
         '''
         
+        return self._incdec( 'decr', key, value )
+        
     def _stat( self, args=None ):
         '''
         stats\r\n
@@ -170,10 +242,10 @@ class Memcache( object ):
                 k, v = x.split(' ',1)
                 r[k] = v
             else :
-                raise Exception(x)
-        
+                raise MemcacheError(x)
+            x = self._readline()
             
-        raise Exception(r)
+        return r
         
     def _flush_all( self ):
         '''
@@ -181,6 +253,15 @@ class Memcache( object ):
         
         OK\r\n
         '''
+        
+        self._send('flush_all\r\n')
+        
+        r = self._readline()
+        
+        if r == 'OK' :
+            return
+        
+        raise MemcacheError(r)
     
     def _version( self ):
         '''
@@ -196,4 +277,372 @@ class Memcache( object ):
         if r.startswith('VERSION ') :
             return r[8:]
             
-        raise Exception(r)
\ No newline at end of file
+        raise MemcacheError(r)
+    
+    def _call( self, method, *args ):
+        '''
+        run a command with the connection locked, connect if not connected,
+        the connection is closed on error.
+        '''
+        
+        self.lock.acquire()
+        try :
+            
+            try :
+                if self.conn == None :
+                    self._connect()
+                return method( *args )
+            except ( socket.error, MemcacheError ), e :
+                self.close()
+                if isinstance( e, MemcacheError ) :
+                    raise
+                raise MemcacheError( *e.args )
+            
+        finally :
+            self.lock.release()
+    
+    @classmethod
+    def _dumps( cls, value ):
+        
+        if type(value) == str :
+            return 0, value
+        
+        return cls.FLAG_PICKLE, cPickle.dumps( value, 2 )
+    
+    @classmethod
+    def _loads( cls, flags, data ):
+        
+        if flags & cls.FLAG_PICKLE :
+            return cPickle.loads( data )
+        
+        return data
+    
+    def get_multi( self, keys ):
+        '''
+        return { key : value, ... } of the keys found
+        '''
+        
+        if not keys :
+            return {}
+        
+        r = self._call( self._get, keys )
+        
+        return dict( [ ( k, self._loads( flags, data ) )
+                       for k, ( flags, data ) in r.items() ] )
+    
+    def get( self, key, default=None ):
+        
+        return self.get_multi( [key,] ).get( key, default )
+    
+    def set( self, key, value, exptime=0 ):
+        
+        flags, data = self._dumps( value )
+        
+        return self._call( self._set, key, flags, exptime, data )
+    
+    def add( self, key, value, exptime=0 ):
+        
+        flags, data = self._dumps( value )
+        
+        return self._call( self._add, key, flags, exptime, data )
+    
+    def replace( self, key, value, exptime=0 ):
+        
+        flags, data = self._dumps( value )
+        
+        return self._call( self._replace, key, flags, exptime, data )
+    
+    def delete( self, key ):
+        
+        return self._call( self._delete, key )
+    
+    def incr( self, key, value=1 ):
+        
+        return self._call( self._inc, key, value )
+    
+    def decr( self, key, value=1 ):
+        
+        return self._call( self._dec, key, value )
+    
+    def stats( self, args=None ):
+        
+        return self._call( self._stat, args )
+    
+    def flush_all( self ):
+        
+        return self._call( self._flush_all )
+    
+    def version( self ):
+        
+        return self._call( self._version )
+
+
+class MemcacheRing( object ):
+    '''
+    distribute the keys over memcached nodes by consistent hash
+    
+    ring = MemcacheRing( [ ('10.0.0.1', 11211), ('10.0.0.2', 11211) ] )
+    '''
+    
+    def __init__( self, nodes, replicas=160, timeout=None ):
+        
+        self.replicas = replicas
+        
+        self.nodes = []
+        self.points = []
+        self.pointnodes = []
+        
+        for node in nodes :
+            self.addnode( node, timeout )
+        
+        return
+    
+    @staticmethod
+    def _hash( s ):
+        
+        return long( hashlib.md5(s).hexdigest()[:8], 16 )
+    
+    def addnode( self, node, timeout=None ):
+        '''
+        add a ( host, port ) or a Memcache to the ring,
+        only about 1/n of the keys are moved to the new node.
+        '''
+        
+        if type(node) == tuple :
+            name = '%s:%d' % node
+            node = Memcache( node[0], node[1], timeout )
+        else :
+            name = '%s:%d' % node.addr
+        
+        self.nodes.append( node )
+        
+        ring = zip( self.points, self.pointnodes )
+        ring += [ ( self._hash( '%s-%d' % ( name, i ) ), node )
+                  for i in range(self.replicas) ]
+        ring.sort( key = lambda x : x[0] )
+        
+        self.points = [ p for p, n in ring ]
+        self.pointnodes = [ n for p, n in ring ]
+        
+        return node
+    
+    def getnode( self, key ):
+        
+        i = bisect.bisect( self.points, self._hash(key) )
+        
+        return self.pointnodes[ i % len(self.points) ]
+    
+    def get_multi( self, keys ):
+        '''
+        one get command for each node of the keys
+        '''
+        
+        nodekeys = {}
+        for k in keys :
+            nodekeys.setdefault( self.getnode(k), [] ).append( k )
+        
+        r = {}
+        for node, ks in nodekeys.items() :
+            r.update( node.get_multi( ks ) )
+        
+        return r
+    
+    def get( self, key, default=None ):
+        
+        return self.getnode( key ).get( key, default )
+    
+    def set( self, key, value, exptime=0 ):
+        
+        return self.getnode( key ).set( key, value, exptime )
+    
+    def add( self, key, value, exptime=0 ):
+        
+        return self.getnode( key ).add( key, value, exptime )
+    
+    def replace( self, key, value, exptime=0 ):
+        
+        return self.getnode( key ).replace( key, value, exptime )
+    
+    def delete( self, key ):
+        
+        return self.getnode( key ).delete( key )
+    
+    def incr( self, key, value=1 ):
+        
+        return self.getnode( key ).incr( key, value )
+    
+    def decr( self, key, value=1 ):
+        
+        return self.getnode( key ).decr( key, value )
+    
+    def flush_all( self ):
+        
+        for node in self.nodes :
+            node.flush_all()
+        
+        return
+
+
+class FakeMemcacheHandler( SocketServer.StreamRequestHandler ):
+    '''
+    the text protocol commands of memcached used by Memcache
+    '''
+    
+    def handle( self ):
+        
+        data = self.server.data
+        lock = self.server.lock
+        
+        while True :
+            
+            line = self.rfile.readline()
+            if not line :
+                return
+            
+            args = line.rstrip('\r\n').split(' ')
+            cmd = args[0]
+            
+            lock.acquire()
+            try :
+                r = self.command( data, cmd, args[1:] )
+            finally :
+                lock.release()
+            
+            self.wfile.write( r )
+    
+    def command( self, data, cmd, args ):
+        
+        now = time.time()
+        
+        if cmd in ( 'set', 'add', 'replace' ) :
+            
+            key, flags, exptime, bytes = args[:4]
+            contain = self.rfile.read( int(bytes) + 2 )[:-2]
+            
+            exptime = int(exptime)
+            if exptime != 0 and exptime <= 2592000 :
+                exptime = now + exptime
+            
+            exist = key in data and \
+                    ( data[key][2] == 0 or data[key][2] > now )
+            
+            if ( cmd == 'add' and exist ) or ( cmd == 'replace' and not exist ) :
+                return 'NOT_STORED\r\n'
+            
+            data[key] = ( int(flags), contain, exptime )
+            
+            return 'STORED\r\n'
+        
+        if cmd in ( 'get', 'gets' ) :
+            
+            r = []
+            for key in args :
+                if key not in data :
+                    continue
+                flags, contain, exptime = data[key]
+                if exptime != 0 and exptime <= now :
+                    del data[key]
+                    continue
+                r.append( 'VALUE %s %d %d\r\n%s\r\n' %
+                          ( key, flags, len(contain), contain ) )
+            
+            return ''.join(r) + 'END\r\n'
+        
+        if cmd == 'delete' :
+            
+            if data.pop( args[0], None ) == None :
+                return 'NOT_FOUND\r\n'
+            
+            return 'DELETED\r\n'
+        
+        if cmd in ( 'incr', 'decr' ) :
+            
+            key, value = args[0], int(args[1])
+            
+            if key not in data :
+                return 'NOT_FOUND\r\n'
+            
+            flags, contain, exptime = data[key]
+            
+            if not contain.isdigit() :
+                return 'CLIENT_ERROR cannot increment or decrement ' \
+                       'non-numeric value\r\n'
+            
+            contain = int(contain) + value if cmd == 'incr' else \
+                      max( int(contain) - value, 0 )
+            data[key] = ( flags, str(contain), exptime )
+            
+            return '%d\r\n' % (contain,)
+        
+        if cmd == 'flush_all' :
+            
+            data.clear()
+            
+            return 'OK\r\n'
+        
+        if cmd == 'version' :
+            
+            return 'VERSION fake\r\n'
+        
+        if cmd == 'stats' :
+            
+            return 'STAT curr_items %d\r\nEND\r\n' % ( len(data), )
+        
+        return 'ERROR\r\n'
+
+
+class FakeMemcacheServer( SocketServer.ThreadingTCPServer ):
+    '''
+    a local in-memory memcached for tests
+    
+    server = FakeMemcacheServer().start()
+    mc = Memcache( *server.server_address )
+    '''
+    
+    daemon_threads = True
+    allow_reuse_address = True
+    
+    def __init__( self, host='127.0.0.1', port=0 ):
+        
+        SocketServer.ThreadingTCPServer.__init__( self, ( host, port ),
+                                                  FakeMemcacheHandler )
+        
+        self.data = {}
+        self.lock = threading.Lock()
+        
+        return
+    
+    def start( self ):
+        
+        t = threading.Thread( target=self.serve_forever )
+        t.setDaemon(True)
+        t.start()
+        
+        return self
+    
+    def stop( self ):
+        
+        self.shutdown()
+        self.server_close()
+        
+        return
+
+
+if __name__ == '__main__' :
+    
+    servers = [ FakeMemcacheServer().start() for i in range(3) ]
+    
+    ring = MemcacheRing( [ s.server_address for s in servers ] )
+    
+    for i in range(10) :
+        ring.set( 'key%d' % i, { 'ID' : i } )
+    
+    print ring.get_multi( [ 'key%d' % i for i in range(12) ] )
+    print [ len(s.data) for s in servers ]
+    
+    ring.delete( 'key1' )
+    ring.set( 'counter', '1' )
+    print ring.get( 'key1' ), ring.incr( 'counter' )
+    
+    for s in servers :
+        s.stop()
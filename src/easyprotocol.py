@@ -2,6 +2,9 @@
 import re
 import types
 import os
+import struct
+import mmap
+import UserDict
 
 class EasyBinaryProtocolError( Exception ):
     pass
@@ -121,6 +124,50 @@ def complength( e, vs, namespace ):
     if t == 6 :
         return reduce( (lambda x,y : x[y]), e[1], vs )
 
+# struct formats and structs of the unsigned integers by length
+uintformats = { 1 : 'B', 2 : 'H', 4 : 'I', 8 : 'Q' }
+
+uints_l = dict( ( n, struct.Struct( '<' + c ) ) for n, c in uintformats.items() )
+uints_b = dict( ( n, struct.Struct( '>' + c ) ) for n, c in uintformats.items() )
+
+# structs of the arrays by ( byteorder, format of an item, count )
+arraystructs = {}
+
+def arraystruct( order, fmt, n ):
+    '''
+    return the struct of n items of the format fmt
+    '''
+    
+    k = ( order, fmt, n )
+    
+    st = arraystructs.get(k)
+    
+    if st == None :
+        
+        if len(arraystructs) >= 1024 :
+            arraystructs.clear()
+        
+        st = struct.Struct( order + ( ( '%d%s' % ( n, fmt ) ) if len(fmt) == 1
+                                      else fmt * n ) )
+        arraystructs[k] = st
+    
+    return st
+
+def sizeof( t, lens, array ):
+    '''
+    the length of array items of the type t, or None if it is not known
+    before read
+    '''
+    
+    if isinstance( t, TypeStruct ) :
+        s = t.size()
+        return None if s == None else s * array
+    
+    if isinstance( t, TypeUnion ) :
+        return None
+    
+    return t.length( lens, array )
+
 def find_var( e ):
     
     if e == None :
@@ -135,6 +182,31 @@ def find_var( e ):
             
     return []
 
+def compile_expr( e ):
+    '''
+    python source of the value of e, the same as complength
+    '''
+    
+    t = e[0]
+    
+    if t == 0 :
+        return '1'
+    
+    if t == 1 :
+        return 'None'
+    
+    if t == 2 :
+        return repr(e[1])
+    
+    if t == 3 :
+        args = [ compile_expr(a) for a in e[1][1] ]
+        return 'namespace[%r](%s)' % ( e[1][0], ', '.join(args) )
+    
+    if t == 4 :
+        return 'namespace[%r]' % ( e[1], )
+    
+    return 'r' + ''.join( '[%r]' % ( k, ) for k in e[1] )
+
 
 class ProtocolType( object ):
     
@@ -170,6 +242,46 @@ class TypeStruct( ProtocolType ):
         self.variables += sum( (m['object'].variables for m in members) , [] )
         
         return
+    
+    def compile( self ):
+        '''
+        replace read with a python function made for the struct
+        '''
+        
+        self.read, self.source = ReaderCompiler( self.name ).build( self.members )
+        
+        multi = ReaderCompiler( self.name ).build_multi( self.members )
+        
+        if multi :
+            self.read_multi, self.multisource = multi
+        
+        return
+    
+    def size( self ):
+        '''
+        the length of the struct, or None if it is not known before read
+        '''
+        
+        if not hasattr( self, '_size' ) :
+            
+            self._size = 0
+            
+            for m in self.members :
+                
+                if m['length'][0] not in ( 0, 2 ) or m['array'][0] not in ( 0, 2 ) :
+                    self._size = None
+                    break
+                
+                le = sizeof( m['object'], complength( m['length'], {}, {} ),
+                             complength( m['array'], {}, {} ) )
+                
+                if le == None :
+                    self._size = None
+                    break
+                
+                self._size += le
+        
+        return self._size
         
     def read( self, namespace, fp, lens, args ):
         
@@ -179,61 +291,129 @@ class TypeStruct( ProtocolType ):
         
         for i, m in enumerate(self.members) :
             
-            #print m
+            r0, l0, lens = self._readmember( namespace, fp, lens, r, l, i )
             
-            if m['array'][0] == 0 : #None
-                
-                if m['length'][0] == 1 : #auto
-                    lx = sum( _m['object'].length( complength(_m['length'], r, namespace), complength(_m['array'], r, namespace) ) for _m in self.members[i+1:] )
-                    #lx = sum( )
-                    if type(lens) not in ( types.IntType, types.LongType ) :
-                        lens = complength( lens, r, namespace )
-                    le = lens - l - lx
-                else :
-                    try :
-                        le = complength( m['length'], r, namespace )
-                    except KeyError :
-                        le = m['length']
-                
-                a = complength( m['arg'], r, namespace )
+            l += l0
+            r[m['var']] = r0
+            
+        return r, l
+    
+    def skim( self, namespace, fp, lens, args ):
+        '''
+        read as read from a BufferIO, but the arrays of known length are
+        skipped and decoded from the buffer when they are got from the
+        LazyRecord returned, and the structs in it are skimmed too.
+        '''
+        
+        r = LazyRecord()
+        
+        l = 0
+        
+        for i, m in enumerate(self.members) :
+            
+            o = m['object']
+            
+            if m['length'][0] == 1 or m['array'][0] == 1 or \
+               ( m['array'][0] == 0 and not isinstance( o, TypeStruct ) ) or \
+               isinstance( o, BuildinTypeNone ) :
                 
-                r0, l0 = m['object'].read( namespace, fp, le, a )
+                r0, l0, lens = self._readmember( namespace, fp, lens, r, l, i )
                 
-            elif m['array'][0] == 1 : #auto
+                l += l0
+                r[m['var']] = r0
                 
+                continue
+            
+            try :
                 le = complength( m['length'], r, namespace )
-                
+            except KeyError :
+                le = m['length']
+            
+            a = complength( m['arg'], r, namespace )
+            
+            if m['array'][0] == 0 :
+                r0, l0 = o.skim( namespace, fp, le, a )
+                l += l0
+                r[m['var']] = r0
+                continue
+            
+            array = complength( m['array'], r, namespace )
+            
+            l0 = sizeof( o, le, array )
+            
+            if l0 == None :
+                r0, l0 = o.read_multi( namespace, fp, le, array, a )
+                l += l0
+                r[m['var']] = r0
+                continue
+            
+            r.defer( m['var'], o.read_multi, namespace, fp.io, fp.pos, le, array, a )
+            
+            fp.seekcur( l0 )
+            l += l0
+            
+        return r, l
+    
+    def _readmember( self, namespace, fp, lens, r, l, i ):
+        '''
+        read the member i after the members read to r of length l,
+        return ( value, length, lens )
+        '''
+        
+        m = self.members[i]
+        
+        #print m
+        
+        if m['array'][0] == 0 : #None
+            
+            if m['length'][0] == 1 : #auto
                 lx = sum( _m['object'].length( complength(_m['length'], r, namespace), complength(_m['array'], r, namespace) ) for _m in self.members[i+1:] )
+                #lx = sum( )
                 if type(lens) not in ( types.IntType, types.LongType ) :
                     lens = complength( lens, r, namespace )
-                
-                xle = lens - l - lx
-                
-                if xle % le != 0 :
-                    raise AutoArrayError, 'auto array error'
-                
-                array = xle/le
-                
-                a = complength( m['arg'], r, namespace )
-                
-                r0, l0 = m['object'].read_multi( namespace, fp, le, array, a )
-                
+                le = lens - l - lx
             else :
-                
-                array = complength( m['array'], r, namespace )
                 try :
                     le = complength( m['length'], r, namespace )
                 except KeyError :
                     le = m['length']
-                
-                a = complength( m['arg'], r, namespace )
-                
-                r0, l0 = m['object'].read_multi( namespace, fp, le, array, a )
             
-            l += l0
-            r[m['var']] = r0
+            a = complength( m['arg'], r, namespace )
             
-        return r, l
+            r0, l0 = m['object'].read( namespace, fp, le, a )
+            
+        elif m['array'][0] == 1 : #auto
+            
+            le = complength( m['length'], r, namespace )
+            
+            lx = sum( _m['object'].length( complength(_m['length'], r, namespace), complength(_m['array'], r, namespace) ) for _m in self.members[i+1:] )
+            if type(lens) not in ( types.IntType, types.LongType ) :
+                lens = complength( lens, r, namespace )
+            
+            xle = lens - l - lx
+            
+            if xle % le != 0 :
+                raise AutoArrayError, 'auto array error'
+            
+            array = xle/le
+            
+            a = complength( m['arg'], r, namespace )
+            
+            r0, l0 = m['object'].read_multi( namespace, fp, le, array, a )
+            
+        else :
+            
+            array = complength( m['array'], r, namespace )
+            try :
+                le = complength( m['length'], r, namespace )
+            except KeyError :
+                le = m['length']
+            
+            a = complength( m['arg'], r, namespace )
+            
+            r0, l0 = m['object'].read_multi( namespace, fp, le, array, a )
+        
+        return r0, l0, lens
 
 class TypeUnion( ProtocolType ):
     
@@ -281,6 +461,38 @@ class TypeUnion( ProtocolType ):
         self.variables += sum( (m['object'].variables for m in members) , [] )
         
         return
+    
+    def compile( self ):
+        '''
+        replace read with a python function made for each member
+        '''
+        
+        readers = {}
+        self.source = []
+        
+        for m in self.members.values() + [self.defaultmember] :
+            if m and id(m) not in readers :
+                read, source = ReaderCompiler( self.name ).build( [m,] )
+                readers[id(m)] = read
+                self.source.append( source )
+        
+        table = dict( ( k, readers[id(m)] ) for k, m in self.members.items() )
+        default = readers.get( id(self.defaultmember) )
+        
+        name, members = self.name, self.members
+        
+        def read( namespace, fp, lens, args ):
+            
+            f = table.get( args, default )
+            
+            if f == None :
+                raise UndefinedValueInUnion, ( name, args, members )
+            
+            return f( namespace, fp, lens, args )
+        
+        self.read = read
+        
+        return
         
     def read( self, namespace, fp, lens, args ):
         
@@ -363,6 +575,10 @@ class BuildinTypeUINT( ProtocolType ):
         
     def read( self, namespace, fp, lens, args ):
         
+        st = uints_l.get(lens)
+        if st :
+            return fp.unpack(st)[0], lens
+        
         chrs = fp.read(lens)
         
         r = 0
@@ -372,6 +588,14 @@ class BuildinTypeUINT( ProtocolType ):
         
         return r, lens
         
+    def read_multi( self, namespace, fp, lens, mlens, args ):
+        
+        if lens not in uintformats or mlens <= 0 :
+            return ProtocolType.read_multi( self, namespace, fp, lens, mlens, args )
+        
+        st = arraystruct( '<', uintformats[lens], mlens )
+        
+        return fp.unpack(st), st.size
         
         
 class BuildinTypeUINTNZ( ProtocolType ):
@@ -394,6 +618,10 @@ class BuildinTypeUINTNZ( ProtocolType ):
         if args == 0 :
             return 0, 0
         
+        st = uints_l.get(lens)
+        if st :
+            return fp.unpack(st)[0], lens
+        
         chrs = fp.read(lens)
         
         r = 0
@@ -422,6 +650,10 @@ class BuildinTypeUINTB( ProtocolType ):
         
     def read( self, namespace, fp, lens, args ):
         
+        st = uints_b.get(lens)
+        if st :
+            return fp.unpack(st)[0], lens
+        
         chrs = fp.read(lens)
         
         r = 0
@@ -434,6 +666,15 @@ class BuildinTypeUINTB( ProtocolType ):
         
         return r, lens
         
+    def read_multi( self, namespace, fp, lens, mlens, args ):
+        
+        if lens not in uintformats or mlens <= 0 :
+            return ProtocolType.read_multi( self, namespace, fp, lens, mlens, args )
+        
+        st = arraystruct( '>', uintformats[lens], mlens )
+        
+        return fp.unpack(st), st.size
+        
 class BuildinTypeINTB( ProtocolType ):
     
     def __init__( self ):
@@ -451,6 +692,12 @@ class BuildinTypeINTB( ProtocolType ):
         
     def read( self, namespace, fp, lens, args ):
         
+        st = uints_b.get(lens)
+        if st :
+            r = fp.unpack(st)[0]
+            # negative from the high byte 127 as below
+            return ( r - 256**lens if r >= 127 * 256**(lens-1) else r ), lens
+        
         chrs = fp.read(lens)
         
         chrs = list(chrs)
@@ -465,6 +712,17 @@ class BuildinTypeINTB( ProtocolType ):
             r = r - 256**(i+1)
         
         return r, lens
+        
+    def read_multi( self, namespace, fp, lens, mlens, args ):
+        
+        if lens not in uintformats or mlens <= 0 :
+            return ProtocolType.read_multi( self, namespace, fp, lens, mlens, args )
+        
+        st = arraystruct( '>', uintformats[lens], mlens )
+        
+        m, t = 256**lens, 127 * 256**(lens-1)
+        
+        return tuple( [ ( x - m if x >= t else x ) for x in fp.unpack(st) ] ), st.size
 
 class BuildinTypeCHAR( ProtocolType ):
     
@@ -588,6 +846,12 @@ class SafeIO( object ):
         if len(r) != lens :
             raise ConnectionError, 'Connection Error'
         return r
+    
+    def unpack( self, st ):
+        return st.unpack( self.read( st.size ) )
+    
+    def tell( self ):
+        return self.io.tell()
         
     def seekcur( self, lens ):
         s = getattr( self.io, 'seek', None )
@@ -602,6 +866,517 @@ class SafeIO( object ):
                 raise ConnectionError, 'Connection Error'
         return
 
+class BufferIO( object ):
+    '''
+    read a str, buffer, bytearray, memoryview or mmap at a cursor, the
+    numbers are unpacked from the buffer without copying, and the skipped
+    fields are not read at all.
+    
+    fp = BufferIO( data, offset )
+    ebp.read( 'a', fp )
+    ebp.read( 'b', fp )    # after a
+    
+    need is the length of the buffer the read running over the end wanted.
+    '''
+    
+    def __init__( self, buf, pos=0 ):
+        
+        self.io = buf
+        self.pos = pos
+        self.end = len(buf)
+        self.need = None
+        
+        if isinstance( buf, memoryview ) :
+            self.tostr = memoryview.tobytes
+        elif isinstance( buf, bytearray ) :
+            self.tostr = str
+        else :
+            self.tostr = None
+        
+        return
+    
+    def read( self, lens ):
+        
+        e = self.pos + lens
+        
+        if lens < 0 or e > self.end :
+            self.need = e if lens >= 0 else None
+            raise ConnectionError, 'Connection Error'
+        
+        r = self.io[self.pos:e]
+        self.pos = e
+        
+        return self.tostr(r) if self.tostr else r
+    
+    def unpack( self, st ):
+        
+        if self.pos + st.size > self.end :
+            self.need = self.pos + st.size
+            raise ConnectionError, 'Connection Error'
+        
+        r = st.unpack_from( self.io, self.pos )
+        self.pos += st.size
+        
+        return r
+    
+    def seekcur( self, lens ):
+        
+        if lens < 0 or self.pos + lens > self.end :
+            self.need = self.pos + lens if lens >= 0 else None
+            raise ConnectionError, 'Connection Error'
+        
+        self.pos += lens
+        
+        return
+    
+    def tell( self ):
+        
+        return self.pos
+
+def mapfile( fp ):
+    '''
+    return a read only mmap of the file fp, or fp if it can not be mapped,
+    which can be read by EasyBinaryProtocol.read as fp.
+    '''
+    
+    try :
+        return mmap.mmap( fp.fileno(), 0, access=mmap.ACCESS_READ )
+    except ( AttributeError, ValueError, EnvironmentError ), e :
+        return fp
+
+class StreamParser( object ):
+    '''
+    parse the records of the define name from a stream fed by chunks, as
+    from a non-blocking socket. the bytes of the record not completed
+    are kept until the rest of it is fed.
+    
+    p = StreamParser( ebp, 'msg' )
+    
+    for r in p.feed( sock.recv(4096) ) :
+        work( r )
+    '''
+    
+    def __init__( self, ebp, name, **spaces ):
+        
+        self.ebp = ebp
+        self.name = name
+        self.spaces = spaces
+        
+        self.chunks = []
+        self.size = 0
+        
+        # the record is not parsed again before so many bytes are fed
+        self.need = 0
+        
+        return
+    
+    def feed( self, data ):
+        '''
+        return the list of the records completed by data
+        '''
+        
+        if data :
+            self.chunks.append( data )
+            self.size += len(data)
+        
+        if self.size == 0 or self.size < self.need :
+            return []
+        
+        fp = BufferIO( ''.join( self.chunks ) )
+        
+        r = []
+        
+        while fp.pos < fp.end :
+            
+            start = fp.pos
+            fp.need = None
+            
+            try :
+                r.append( self.ebp.read( self.name, fp, **self.spaces ) )
+            except ConnectionError :
+                # an error, but not the end of the bytes fed
+                if fp.need == None :
+                    raise
+                self.need = fp.need - start
+                fp.pos = start
+                break
+            
+            if fp.pos == start :
+                break
+        else :
+            self.need = 0
+        
+        rest = fp.io[fp.pos:]
+        self.chunks = [rest,] if rest else []
+        self.size = len(rest)
+        
+        return r
+    
+    def pending( self ):
+        '''
+        the length of the bytes of the record not completed
+        '''
+        
+        return self.size
+    
+    def close( self ):
+        '''
+        the end of the stream, raise ConnectionError if a record is not
+        completed
+        '''
+        
+        if self.size :
+            raise ConnectionError, ( 'Connection Error', self.size )
+        
+        return
+
+class LazyRecord( UserDict.DictMixin ):
+    '''
+    the record of a struct returned by EasyBinaryProtocol.skim, the
+    arrays deferred are read from the buffer when they are got first.
+    
+    r = ebp.skim( 'png', data )
+    r['type']          # read at skim
+    r['crc']           # read now
+    dict( r )          # read all
+    '''
+    
+    def __init__( self ):
+        
+        self._values = {}
+        self._deferred = {}
+        
+        return
+    
+    def defer( self, key, read_multi, namespace, buf, pos, lens, mlens, args ):
+        
+        self._deferred[key] = ( read_multi, namespace, buf, pos, lens, mlens, args )
+        
+        return
+    
+    def __getitem__( self, key ):
+        
+        try :
+            return self._values[key]
+        except KeyError :
+            pass
+        
+        read_multi, namespace, buf, pos, lens, mlens, args = self._deferred.pop(key)
+        
+        v = read_multi( namespace, BufferIO( buf, pos ), lens, mlens, args )[0]
+        self._values[key] = v
+        
+        return v
+    
+    def __setitem__( self, key, value ):
+        
+        self._deferred.pop( key, None )
+        self._values[key] = value
+        
+        return
+    
+    def __delitem__( self, key ):
+        
+        if key in self._deferred :
+            del self._deferred[key]
+        else :
+            del self._values[key]
+        
+        return
+    
+    def __contains__( self, key ):
+        
+        return key in self._values or key in self._deferred
+    
+    def keys( self ):
+        
+        return self._values.keys() + self._deferred.keys()
+
+class ReaderCompiler( object ):
+    '''
+    make the python source of the read function of the members of a struct,
+    which does the same as TypeStruct.read with the expressions inlined.
+    
+    the members of the buildin types of fixed length next to each other
+    are unpacked at once by one struct, and so are the arrays of the
+    structs made only of them.
+    '''
+    
+    # ( byteorder, signed ) of the buildin integers
+    integers = { BuildinTypeUINT : ( '<', False ),
+                 BuildinTypeUINTB : ( '>', False ),
+                 BuildinTypeINTB : ( '>', True ),
+               }
+    
+    strings = ( BuildinTypeCHAR, BuildinTypeBYTE )
+    
+    formats = uintformats
+    
+    def __init__( self, name ):
+        
+        self.name = name
+        self.lines = []
+        self.globals = { 'types' : types,
+                         'complength' : complength,
+                         'AutoArrayError' : AutoArrayError,
+                         'inttypes' : ( types.IntType, types.LongType ),
+                         'arraystruct' : arraystruct,
+                       }
+        self.n = 0
+        
+        return
+    
+    def const( self, prefix, v ):
+        
+        name = '%s%d' % ( prefix, self.n )
+        self.n += 1
+        
+        self.globals[name] = v
+        
+        return name
+    
+    def emit( self, indent, line ):
+        
+        self.lines.append( '    '*indent + line )
+        
+        return
+    
+    def build( self, members ):
+        '''
+        return ( the function, the source )
+        '''
+        
+        self.emit( 1, 'r = {}' )
+        self.emit( 1, 'l = 0' )
+        
+        i = 0
+        while i < len(members) :
+            
+            run = []
+            while i < len(members) and self.fixed( members[i] ) != None :
+                run.append( members[i] )
+                i += 1
+            
+            if run :
+                self.run( run )
+                continue
+            
+            self.member( members, i )
+            i += 1
+        
+        self.emit( 1, 'return r, l' )
+        
+        return self.define( 'read', 'namespace, fp, lens, args' )
+    
+    def build_multi( self, members ):
+        '''
+        return ( the read_multi function, the source ), or None if the
+        members are not all of fixed length in one byteorder
+        '''
+        
+        fixeds = [ self.fixed(m) for m in members ]
+        
+        if fixeds == [] or None in fixeds :
+            return None
+        
+        orders = set( f[1] for f in fixeds if f[1] )
+        
+        if len(orders) > 1 :
+            return None
+        
+        order = orders.pop() if orders else '<'
+        
+        items = []
+        j = 0
+        for m, f in zip( members, fixeds ) :
+            items.append( '%r : %s' % ( m['var'], self.value( f, j, 'i+' ) ) )
+            j += 1 if f[4] == None else f[4]
+        
+        size = sum( f[2] for f in fixeds )
+        fmt = self.const( 'F', ''.join( f[0] for f in fixeds ) )
+        
+        self.emit( 1, 'if mlens <= 0 :' )
+        self.emit( 2, 'return [], 0' )
+        self.emit( 1, 'v = fp.unpack( arraystruct( %r, %s, mlens ) )' % ( order, fmt ) )
+        self.emit( 1, 'r = [ { %s } for i in xrange( 0, %d*mlens, %d ) ]'
+                      % ( ', '.join( items ), j, j ) )
+        self.emit( 1, 'return tuple(r), %d*mlens' % size )
+        
+        return self.define( 'read_multi', 'namespace, fp, lens, mlens, args' )
+    
+    def define( self, name, args ):
+        
+        source = 'def %s( %s ):\n' % ( name, args ) + \
+                 '\n'.join( self.lines ) + '\n'
+        
+        exec compile( source, '<protocol %s>' % (self.name,), 'exec' ) \
+             in self.globals
+        
+        return self.globals[name], source
+    
+    def fixed( self, m ):
+        '''
+        return ( format, byteorder, size, signed, array ) of a member of
+        fixed length, or None
+        '''
+        
+        if m['arg'][0] != 0 or m['length'][0] not in ( 0, 2 ) or \
+           m['array'][0] not in ( 0, 2 ) :
+            return None
+        
+        lens = m['length'][1] if m['length'][0] == 2 else 1
+        array = m['array'][1] if m['array'][0] == 2 else None
+        
+        t = m['object'].__class__
+        
+        if t in self.strings :
+            n = 1 if array == None else array
+            return '%ds' % n, None, n, False, None
+        
+        if t not in self.integers or lens not in self.formats or array == 0 :
+            return None
+        
+        order, signed = self.integers[t]
+        
+        if lens == 1 :
+            order = None
+        
+        if array == None :
+            return self.formats[lens], order, lens, signed, None
+        
+        return '%d%s' % ( array, self.formats[lens] ), order, lens*array, \
+               signed, array
+    
+    def run( self, members ):
+        
+        fixeds = [ ( m, self.fixed(m) ) for m in members ]
+        size = sum( f[2] for m, f in fixeds )
+        
+        if len(fixeds) == 1 and fixeds[0][1][0].endswith('s') :
+            self.emit( 1, 'r[%r] = fp.read( %d )' % ( members[0]['var'], size ) )
+            self.emit( 1, 'l += %d' % size )
+            return
+        
+        # split by the byteorder, the bytes and strings go with any
+        groups = []
+        for m, f in fixeds :
+            if groups == [] or \
+               ( f[1] and groups[-1][0] and f[1] != groups[-1][0] ) :
+                groups.append( [ f[1], [] ] )
+            groups[-1][0] = groups[-1][0] or f[1]
+            groups[-1][1].append( ( m, f ) )
+        
+        for order, gfixeds in groups :
+            
+            st = struct.Struct( ( order or '<' ) +
+                                ''.join( f[0] for m, f in gfixeds ) )
+            
+            self.emit( 1, 'v = fp.unpack( %s )' % self.const( 'S', st ) )
+            
+            j = 0
+            for m, f in gfixeds :
+                self.emit( 1, 'r[%r] = %s' % ( m['var'], self.value( f, j ) ) )
+                j += 1 if f[4] == None else f[4]
+        
+        self.emit( 1, 'l += %d' % size )
+        
+        return
+    
+    def value( self, f, j, i='' ):
+        '''
+        python source of the value of the fixed member f at v[i+j]
+        '''
+        
+        fmt, order, le, signed, array = f
+        
+        if array == None :
+            x = 'v[%s%d]' % ( i, j )
+        else :
+            x = 'v[%s%d:%s%d]' % ( i, j, i, j+array )
+        
+        if not signed :
+            return x
+        
+        # as BuildinTypeINTB, negative from the high byte 127
+        w = le / ( array or 1 )
+        
+        if array == None :
+            return '( %s - %d if %s >= %d else %s )' % ( x, 256**w, x, 127*256**(w-1), x )
+        
+        neg = '( x - %d if x >= %d else x )' % ( 256**w, 127*256**(w-1) )
+        
+        return 'tuple( [ %s for x in %s ] )' % ( neg, x )
+    
+    def length( self, m, indent ):
+        
+        e = m['length']
+        
+        if e[0] in ( 0, 1, 2 ) :
+            self.emit( indent, 'le = %s' % compile_expr(e) )
+            return
+        
+        self.emit( indent, 'try :' )
+        self.emit( indent+1, 'le = %s' % compile_expr(e) )
+        self.emit( indent, 'except KeyError :' )
+        self.emit( indent+1, 'le = %s' % self.const( 'L', e ) )
+        
+        return
+    
+    def rest( self, members ):
+        '''
+        lens - l - the length of the members after
+        '''
+        
+        lx = [ '%s.length( %s, %s )' % ( self.const( 'O', m['object'] ),
+                                         compile_expr( m['length'] ),
+                                         compile_expr( m['array'] ) )
+               for m in members ]
+        
+        self.emit( 1, 'lx = %s' % ' + '.join( ['0',] + lx ) )
+        self.emit( 1, 'if type(lens) not in inttypes :' )
+        self.emit( 2, 'lens = complength( lens, r, namespace )' )
+        
+        return 'lens - l - lx'
+    
+    def member( self, members, i ):
+        
+        m = members[i]
+        
+        if m['array'][0] == 0 :
+            
+            if m['length'][0] == 1 :
+                self.emit( 1, 'le = %s' % self.rest( members[i+1:] ) )
+            else :
+                self.length( m, 1 )
+            
+            self.emit( 1, 'a = %s' % compile_expr( m['arg'] ) )
+            self.emit( 1, 'r0, l0 = %s( namespace, fp, le, a )'
+                          % self.const( 'R', m['object'].read ) )
+            
+        elif m['array'][0] == 1 :
+            
+            self.emit( 1, 'le = %s' % compile_expr( m['length'] ) )
+            self.emit( 1, 'xle = %s' % self.rest( members[i+1:] ) )
+            self.emit( 1, 'if xle % le != 0 :' )
+            self.emit( 2, "raise AutoArrayError, 'auto array error'" )
+            self.emit( 1, 'array = xle/le' )
+            self.emit( 1, 'a = %s' % compile_expr( m['arg'] ) )
+            self.emit( 1, 'r0, l0 = %s( namespace, fp, le, array, a )'
+                          % self.const( 'M', m['object'].read_multi ) )
+            
+        else :
+            
+            self.emit( 1, 'array = %s' % compile_expr( m['array'] ) )
+            self.length( m, 1 )
+            self.emit( 1, 'a = %s' % compile_expr( m['arg'] ) )
+            self.emit( 1, 'r0, l0 = %s( namespace, fp, le, array, a )'
+                          % self.const( 'M', m['object'].read_multi ) )
+        
+        self.emit( 1, 'l += l0' )
+        self.emit( 1, 'r[%r] = r0' % ( m['var'], ) )
+        
+        return
+
 class EasyBinaryProtocol( object ):
     
     buildintypes = [ BuildinTypeCHAR(),
@@ -636,6 +1411,10 @@ class EasyBinaryProtocol( object ):
                         ( 'false', False ),
                       ]
     
+    # compile the structs and unions to python functions when parsed,
+    # False to interpret the definitions on every read
+    compiled = True
+    
     def __init__( self ):
         
         seg = r'(?P<seg>([0-9,*]*|0x[0-9A-Fa-f]+|true|false):)'
@@ -709,9 +1488,14 @@ class EasyBinaryProtocol( object ):
             m['object'] = self.namespaces[m['name']]
     
         if declaration['arg'] == None :
-            self.namespaces[declaration['name']] = TypeStruct( declaration['name'], members )
+            t = TypeStruct( declaration['name'], members )
         else :
-            self.namespaces[declaration['name']] = TypeUnion( declaration['name'], members )
+            t = TypeUnion( declaration['name'], members )
+        
+        if self.compiled :
+            t.compile()
+        
+        self.namespaces[declaration['name']] = t
         
         return
     
@@ -759,7 +1543,14 @@ class EasyBinaryProtocol( object ):
         
         return rootnode
     
+    buffertypes = ( str, buffer, bytearray, memoryview )
+    
     def read( self, name, io, **spaces ):
+        '''
+        read the define name from io, which is a file like object, a
+        BufferIO, an mmap read from its position, or a buffer read from
+        the beginning.
+        '''
         
         v = self.p_globals[name]
         stt = self.namespaces[v['name']]
@@ -767,7 +1558,57 @@ class EasyBinaryProtocol( object ):
         for k, bif in self.buildinfunction :
             spaces.setdefault(k,bif)
         
-        return stt.read( spaces, SafeIO(io), v['length'], v['array'] )[0]
+        if isinstance( io, ( SafeIO, BufferIO ) ) :
+            fp = io
+        elif isinstance( io, mmap.mmap ) :
+            fp = BufferIO( io, io.tell() )
+        elif isinstance( io, self.buffertypes ) :
+            fp = BufferIO( io )
+        else :
+            fp = SafeIO( io )
+        
+        try :
+            return stt.read( spaces, fp, v['length'], v['array'] )[0]
+        finally :
+            # the mmap goes on as a file
+            if isinstance( io, mmap.mmap ) :
+                io.seek( fp.pos )
+    
+    def skim( self, name, io, **spaces ):
+        '''
+        read the define name from io as read, but return a LazyRecord
+        whose arrays of known length are skipped, and read from the
+        buffer when they are got. a file is mapped by mapfile, a file or
+        stream which can not be mapped is read as read.
+        '''
+        
+        v = self.p_globals[name]
+        stt = self.namespaces[v['name']]
+        
+        if not isinstance( stt, TypeStruct ) :
+            return self.read( name, io, **spaces )
+        
+        if isinstance( io, BufferIO ) :
+            fp = io
+        elif isinstance( io, mmap.mmap ) :
+            fp = BufferIO( io, io.tell() )
+        elif isinstance( io, self.buffertypes ) :
+            fp = BufferIO( io )
+        else :
+            m = mapfile( io )
+            if m is io :
+                return self.read( name, io, **spaces )
+            fp = BufferIO( m, io.tell() )
+        
+        for k, bif in self.buildinfunction :
+            spaces.setdefault(k,bif)
+        
+        try :
+            return stt.skim( spaces, fp, v['length'], v['array'] )[0]
+        finally :
+            # the mmap and file go on after the record
+            if fp is not io and not isinstance( io, self.buffertypes ) :
+                io.seek( fp.pos )
         
         
 ebp = EasyBinaryProtocol()
@@ -13,6 +13,7 @@ import json
 import MySQLdb
 
 import sys
+import os
 import logging
 
 import datetime
@@ -21,6 +22,17 @@ import time
 
 import ctypes
 import Queue
+import collections
+import hashlib
+import operator
+import binascii
+import itertools
+import re
+import bisect
+import base64
+import copy
+import decimal
+import inspect
 
 
 class EasySqlException( Exception ):
@@ -44,6 +56,9 @@ class TypeError(EasySqlException, TypeError ):
 class ConnectionError(EasySqlException):
     pass
 
+class TimeoutError(EasySqlException):
+    pass
+
 def sqlstr( v ):
     
     if hasattr(v, '_tosql'):
@@ -487,6 +502,37 @@ CR = dict( [ ( getattr(CR, e), e )
          )
 '''
 
+def _bulkconv( conv ):
+    '''
+    return the bulk version of a converter, which takes the columns of a page
+    and returns the converted columns.
+    
+    it is conv.many, or <name>_many of the object of a bound method
+    ( e.g. LIST_MOD(l).de_many for LIST_MOD(l).de ), or a loop of conv.
+    
+    <name>_many is only taken from the class defining conv, a subclass
+    overriding de alone must not get the de_many of its base.
+    '''
+    
+    many = getattr( conv, 'many', None )
+    
+    if many == None :
+        im_self = getattr( conv, 'im_self', None )
+        if im_self != None :
+            cls = im_self if isinstance( im_self, ( type, types.ClassType ) ) \
+                          else im_self.__class__
+            for c in inspect.getmro( cls ) :
+                if conv.__name__ in c.__dict__ :
+                    if conv.__name__ + '_many' in c.__dict__ :
+                        many = getattr( im_self, conv.__name__ + '_many' )
+                    break
+    
+    if many != None :
+        return many
+    
+    return lambda *cols : zip( *[ conv( *args ) for args in zip( *cols ) ] )
+
+
 class MultiDimDict():
     
     def __init__( self ):
@@ -546,12 +592,246 @@ class MultiDimDict():
     get = getdefault
 
 
+class QueryMetrics( object ):
+    '''
+    metrics of the statements run by SQLConnectionPool, fed by its _traceback
+    
+    pool = SQLConnectionPool( metrics = QueryMetrics( slowtime=0.5 ) )
+    
+    the latency histograms, rows, errors, retries and connection failures
+    are counted by backend ( 'host:port/db' ) and by table ( the name of
+    the tablet ). the statements slower than slowtime seconds are kept in a
+    ring of slowlogsize entries with the fingerprints of their sqls.
+    '''
+    
+    # upper bounds in seconds of the histogram buckets, the last bucket
+    # counts the rest
+    buckets = ( 0.001, 0.002, 0.005, 0.01, 0.02, 0.05,
+                0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0 )
+    
+    sqlsize = 1024
+    
+    _fprules = [
+        ( re.compile( r"\b0x[0-9a-fA-F]+\b|\b[xX]'[0-9a-fA-F]*'" ), '?' ),
+        ( re.compile( r"'(?:[^'\\]|\\.)*'" ), '?' ),
+        ( re.compile( r'"(?:[^"\\]|\\.)*"' ), '?' ),
+        ( re.compile( r'(?<![\w`.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b' ), '?' ),
+        ( re.compile( r'\s+' ), ' ' ),
+        ( re.compile( r'\( ?\?(?: ?, ?\?)* ?\)' ), '(?+)' ),
+        ( re.compile( r'\(\?\+\)(?: ?, ?\(\?\+\))+' ), '(?+),...' ),
+    ]
+    
+    def __init__( self, slowtime=1.0, slowlogsize=128, buckets=None ):
+        
+        self.slowtime = slowtime
+        self.slowlogsize = slowlogsize
+        
+        if buckets != None :
+            self.buckets = tuple( sorted( buckets ) )
+        
+        self.lock = threading.Lock()
+        
+        self.reset()
+        
+        return
+    
+    def reset( self ):
+        
+        self.lock.acquire()
+        try :
+            self.backends = {}
+            self.tables = {}
+            self.slowlog = collections.deque( maxlen = self.slowlogsize )
+            self.since = time.time()
+        finally :
+            self.lock.release()
+        
+        return
+    
+    @classmethod
+    def fingerprint( cls, sql ):
+        '''
+        return the sql with the values replaced by ? ,
+        e.g. "SELECT * FROM `t` WHERE `a` IN (?+)"
+        '''
+        
+        for r, s in cls._fprules :
+            sql = r.sub( s, sql )
+        
+        return sql.strip()
+    
+    def _stat( self, stats, key ):
+        
+        s = stats.get( key )
+        
+        if s == None :
+            s = { 'queries' : 0, 'reads' : 0, 'writes' : 0, 'rows' : 0,
+                  'errors' : 0, 'retries' : 0, 'connectfailed' : 0,
+                  'slow' : 0, 'time' : 0.0, 'maxtime' : 0.0,
+                  'histogram' : [0] * ( len(self.buckets) + 1 ),
+                }
+            stats[key] = s
+        
+        return s
+    
+    def record( self, info, wrt, conn, sql, elapsed, r, *args ):
+        '''
+        count a statement, the arguments are the ones of
+        SQLConnectionPool._traceback :
+        
+        elapsed is -1    : the connection is broken and the sql is retried
+        r is an int      : failed to connect, r is the failures before
+        elapsed is 0 and r is None : the sql failed
+        
+        args[0] is the rows fetched if given
+        '''
+        
+        backend = '%s:%s/%s' % ( conn[0], conn[1], conn[4] )
+        table = info[0] if info else None
+        
+        slow = ( elapsed > 0 and self.slowtime != None and
+                 elapsed >= self.slowtime )
+        
+        if slow :
+            entry = { 'time' : time.time(),
+                      'elapsed' : elapsed,
+                      'backend' : backend,
+                      'table' : table,
+                      'write' : wrt,
+                      'fingerprint' : self.fingerprint( sql ),
+                      'sql' : sql[:self.sqlsize],
+                    }
+        
+        if elapsed == -1 :
+            name = 'retries'
+        elif type(r) in ( types.IntType, types.LongType ) :
+            name = 'connectfailed'
+        elif elapsed == 0 and r == None and not args :
+            name = 'errors'
+        else :
+            name = None
+        
+        if args :
+            rows = args[0]
+        elif name != None or r == None :
+            rows = 0
+        elif wrt :
+            rows = r[0]
+        else :
+            rows = len(r)
+        
+        self.lock.acquire()
+        try :
+            stats = [ self._stat( self.backends, backend ) ]
+            if table != None :
+                stats.append( self._stat( self.tables, table ) )
+            
+            if name != None :
+                for s in stats :
+                    s[name] += 1
+                return
+            
+            i = bisect.bisect_left( self.buckets, elapsed )
+            
+            for s in stats :
+                s['queries'] += 1
+                s['writes' if wrt else 'reads'] += 1
+                s['rows'] += rows
+                s['time'] += elapsed
+                s['maxtime'] = max( s['maxtime'], elapsed )
+                s['histogram'][i] += 1
+                if slow :
+                    s['slow'] += 1
+            
+            if slow :
+                self.slowlog.append( entry )
+        finally :
+            self.lock.release()
+        
+        return
+    
+    def _percentile( self, s, q ):
+        
+        need = s['queries'] * q
+        
+        if need == 0 :
+            return 0.0
+        
+        n = 0
+        for bound, c in zip( self.buckets, s['histogram'] ) :
+            n += c
+            if n >= need :
+                return min( bound, s['maxtime'] )
+        
+        return s['maxtime']
+    
+    def _export( self, s ):
+        
+        r = dict( s )
+        r['histogram'] = list( s['histogram'] )
+        r['avgtime'] = ( s['time'] / s['queries'] ) if s['queries'] else 0.0
+        r['p50'] = self._percentile( s, 0.50 )
+        r['p95'] = self._percentile( s, 0.95 )
+        r['p99'] = self._percentile( s, 0.99 )
+        
+        return r
+    
+    def getstats( self ):
+        '''
+        return a snapshot of the counters by backend and by table,
+        the percentiles are the upper bounds of the histogram buckets.
+        '''
+        
+        self.lock.acquire()
+        try :
+            r = { 'since' : self.since,
+                  'buckets' : list( self.buckets ),
+                  'backends' : dict( [ ( k, self._export(s) )
+                                       for k, s in self.backends.items() ] ),
+                  'tables' : dict( [ ( k, self._export(s) )
+                                     for k, s in self.tables.items() ] ),
+                }
+        finally :
+            self.lock.release()
+        
+        return r
+    
+    def getslowlog( self ):
+        '''
+        return the slow statements, the oldest first
+        '''
+        
+        self.lock.acquire()
+        try :
+            r = [ dict( e ) for e in self.slowlog ]
+        finally :
+            self.lock.release()
+        
+        return r
+
+
 class SQLConnectionPool( object ):
     '''
     Connection Pool
+    
+    maxconnections : max opened connections per backend, None is unbounded
+    waittimeout    : seconds to wait for a free connection when the backend
+                     is full, None is wait forever
+    idletimeout    : idle connections unused for this seconds are closed,
+                     None is never
+    pinginterval   : ping an idle connection before reuse if it was unused
+                     for this seconds, None is never ping
+    metrics        : QueryMetrics counting the statements, None is off
+    pipeline       : send several statements in one round trip if the
+                     connection supports multiple results ( next_result )
     '''
     
     default_timeout = 2
+    
+    # a waiting checkout wakes up at least so often, a wait without a
+    # timeout can not be interrupted, and the idle ones expire meanwhile
+    waitinterval = 1.0
+    
     writeRetryError = (
         2006,
     )
@@ -561,16 +841,36 @@ class SQLConnectionPool( object ):
             2013, # timeout
     )
     
-    def __init__( self, ):
+    def __init__( self, maxconnections=None, waittimeout=None,
+                        idletimeout=None, pinginterval=None, metrics=None,
+                        pipeline=True ):
         
         #self.conns = MultiDimDict()
-        self.conns = {}
+        self.conns = {}     # conn_args -> [ ( conn, lastused ), ... ]
+        self.opened = {}    # conn_args -> opened connections number
         
         self._longlink = {True:False, False:True}
         
+        self.maxconnections = maxconnections
+        self.waittimeout = waittimeout
+        self.idletimeout = idletimeout
+        self.pinginterval = pinginterval
+        
+        self.metrics = metrics
+        
+        self.pipeline = pipeline
+        
+        self.lock = threading.Condition()
+        
         self.connectionfailed = 0
         
-        self.dq = Queue.Queue()
+        self.stats = { 'checkouts' : 0,
+                       'waits' : 0,
+                       'waittimeouts' : 0,
+                       'creations' : 0,
+                       'reaped' : 0,
+                       'pingfailed' : 0,
+                     }
         
         return
     
@@ -596,7 +896,35 @@ class SQLConnectionPool( object ):
         
         return rst, fs
     
-    def _write( self, conn, sql ):
+    def _pipelined( self, conn ):
+        
+        return self.pipeline and hasattr( conn, 'next_result' )
+    
+    def _readpre( self, conn, sql, presql=None ):
+        '''
+        read sql after presql, in one round trip if pipelined
+        '''
+        
+        if presql == None :
+            return self._read( conn, sql )
+        
+        if not self._pipelined( conn ) :
+            self._write( conn, presql )
+            return self._read( conn, sql )
+        
+        conn.query( presql + ';' + sql )
+        
+        # the results must be all fetched before the next query
+        rst = conn.store_result()
+        while conn.next_result() == 0 :
+            r = conn.store_result()
+            rst = r if r != None else rst
+        
+        rst = rst.fetch_row(rst.num_rows())
+        
+        return rst
+    
+    def _write( self, conn, sql, commit=True ):
         '''
         using Mysql_info() to get the match number affact number
         using Mysql_insert_id() to get lastid
@@ -610,6 +938,48 @@ class SQLConnectionPool( object ):
         #print 'w>', sql, type(sql)
         conn.query(sql)
         
+        r = self._written( conn )
+        
+        if commit :
+            conn.commit()
+        
+        return r
+    
+    def _writemany( self, conn, sqls, commit=True, done=None ):
+        '''
+        run the sqls in order, in one round trip if pipelined,
+        return [ ( affect, lastid, info ), ... ]
+        
+        the result of each sql is appended to done as it is known, the
+        sqls after them are not run yet if the connection is lost.
+        '''
+        
+        rs = done if done != None else []
+        
+        if len(sqls) <= 1 or not self._pipelined( conn ) :
+            for sql in sqls :
+                rs.append( self._write( conn, sql, False ) )
+        else :
+            conn.query( ';'.join( sqls ) )
+            
+            conn.store_result()
+            rs.append( self._written( conn ) )
+            
+            while conn.next_result() == 0 :
+                conn.store_result()
+                rs.append( self._written( conn ) )
+        
+        if commit :
+            conn.commit()
+        
+        return rs
+    
+    @staticmethod
+    def _written( conn ):
+        '''
+        return ( affect, lastid, info ) of the last write
+        '''
+        
         affect = conn.affected_rows()
         
         lastid = conn.insert_id()
@@ -621,8 +991,6 @@ class SQLConnectionPool( object ):
             info = [ ( k.strip(' '), int(v.strip(' ')) ) for k, v in info ]
             info = dict(info)
         
-        conn.commit()
-        
         return affect, lastid, info
     
     def explain( self, conn_args, sql, infos=() ):
@@ -641,8 +1009,11 @@ class SQLConnectionPool( object ):
                 try :
                     r, fs = self._read_with_cols( conn, sql )
                     rconn = conn
+                    break
                 except MySQLdb.OperationalError, e :
                     if e.args[0] in self.readRetryError:
+                        self._discard( conn_args, conn )
+                        conn = None
                         conn = self._get( conn_args, False, sql, infos )
                         self._traceback( infos, False, 
                                          tuple(conn_args), sql, -1, None )
@@ -654,11 +1025,13 @@ class SQLConnectionPool( object ):
                     e.args = tuple( list(e.args)+[sql,] )
                     raise
         finally :
-            self._put( conn_args, False, rconn )
+            self._putback( conn_args, False, conn, rconn )
             endtime = time.time()
-            self._traceback( infos, False, tuple(conn_args), sql ,
-                             0 if rconn == None else endtime - starttime, r,
-                           )
+            # conn is None if connecting again failed, counted by _get
+            if conn != None :
+                self._traceback( infos, False, tuple(conn_args), sql ,
+                                 0 if rconn == None else endtime - starttime, r,
+                               )
         return r, fs
     
     def read( self, conn_args, sql, presql=None, infos=() ):
@@ -675,13 +1048,13 @@ class SQLConnectionPool( object ):
         try :
             while(True):
                 try :
-                    if presql != None :
-                        self._write( conn, presql )
-                    r = self._read( conn, sql )
+                    r = self._readpre( conn, sql, presql )
                     rconn = conn
                     break
                 except MySQLdb.OperationalError, e :
                     if e.args[0] in self.readRetryError:
+                        self._discard( conn_args, conn )
+                        conn = None
                         conn = self._get( conn_args, False, sql, infos )
                         self._traceback( infos, False, 
                                          tuple(conn_args), sql, -1, None )
@@ -693,17 +1066,78 @@ class SQLConnectionPool( object ):
                     e.args = tuple( list(e.args)+[sql,] )
                     raise
         finally :
-            self._put( conn_args, False, rconn )
+            self._putback( conn_args, False, conn, rconn )
             endtime = time.time()
-            self._traceback( infos, False, tuple(conn_args), 
-                             ';'.join( ( presql, sql ) ) \
+            # conn is None if connecting again failed, counted by _get
+            if conn != None :
+                self._traceback( infos, False, tuple(conn_args), 
+                                 ';'.join( ( presql, sql ) ) \
                                                   if presql != None else sql ,
-                             0 if rconn == None else endtime - starttime,
-                             r,
-                           )
+                                 0 if rconn == None else endtime - starttime,
+                                 r,
+                               )
         
         return r
     
+    def iterread( self, conn_args, sql, batch=1000, infos=() ):
+        '''
+        yield the rows of the result batch by batch with mysql_use_result,
+        the connection is given back only if the result is fetched to the end
+        '''
+        
+        conn_args = tuple(conn_args)
+        
+        conn = self._get( conn_args, False, sql, infos = infos )
+        rconn = None
+        
+        nrows = 0
+        
+        starttime = time.time()
+        
+        try :
+            while(True):
+                try :
+                    conn.query(sql)
+                    rst = conn.use_result()
+                    break
+                except MySQLdb.OperationalError, e :
+                    if e.args[0] in self.readRetryError:
+                        self._discard( conn_args, conn )
+                        conn = None
+                        conn = self._get( conn_args, False, sql, infos )
+                        self._traceback( infos, False, 
+                                         tuple(conn_args), sql, -1, None )
+                        starttime = time.time()
+                        continue
+                    else :
+                        raise
+                except MySQLdb.ProgrammingError, e :
+                    e.args = tuple( list(e.args)+[sql,] )
+                    raise
+            
+            while(True):
+                rows = rst.fetch_row( batch )
+                if not rows :
+                    break
+                nrows += len(rows)
+                yield rows
+            
+            rconn = conn
+            
+        finally :
+            self._putback( conn_args, False, conn, rconn )
+            endtime = time.time()
+            # conn is None if connecting again failed, counted by _get
+            if conn == None :
+                pass
+            elif rconn == None :
+                self._traceback( infos, False, tuple(conn_args), sql, 0, None )
+            else :
+                self._traceback( infos, False, tuple(conn_args), sql,
+                                 endtime - starttime, None, nrows )
+        
+        return
+    
     def write( self, conn_args, sql, infos=() ):
         
         conn_args = tuple(conn_args)
@@ -723,6 +1157,8 @@ class SQLConnectionPool( object ):
                     break
                 except MySQLdb.OperationalError, e :
                     if e.args[0] in self.writeRetryError:
+                        self._discard( conn_args, conn )
+                        conn = None
                         conn = self._get( conn_args, True, sql, infos )
                         self._traceback( infos, True, 
                                          tuple(conn_args), sql, -1, None )
@@ -730,374 +1166,2272 @@ class SQLConnectionPool( object ):
                     else :
                         raise
         finally :
-            self._put( conn_args, True, rconn )
+            self._putback( conn_args, True, conn, rconn )
             endtime = time.time()
-            self._traceback( infos, True, tuple(conn_args), sql, \
-                             0 if rconn == None else endtime - starttime, r )
+            # conn is None if connecting again failed, counted by _get
+            if conn != None :
+                self._traceback( infos, True, tuple(conn_args), sql, \
+                                 0 if rconn == None else endtime - starttime, r )
             
         return r
     
-    def _get( self, conn_args, wrt, sql='', infos=() ):
+    def writemany( self, conn_args, sqls, infos=() ):
+        '''
+        run the sqls in order on one connection, in one round trip if
+        pipelined, return [ ( affect, lastid, info ), ... ]
         
-        try :
-            conn = self.conns.get( conn_args, self.dq ).get( False ) \
-                                            if self._longlink[wrt] else None
-        except Queue.Empty, e :
-            conn = None
+        the connection is autocommit, only the sqls not known done are
+        run again on a new connection. the ConnectionError raised has
+        the results of the sqls done in written.
+        '''
         
-        if conn == None :
-            
-            try :
-                conn = \
-                    MySQLdb.Connection(
-                        host=conn_args[0], port=conn_args[1], db=conn_args[4],
-                        user=conn_args[2], passwd=conn_args[3],
-                        connect_timeout = self.default_timeout,
-#                        use_unicode=True, 
-                        charset="utf8mb4",
-                    )
-            except MySQLdb.OperationalError, e :
-                self._traceback( infos, wrt, tuple(conn_args), sql, 0, self.connectionfailed )
-                self.connectionfailed += 1
-                raise ConnectionError, e.args
-                
-            conn.query("set autocommit=1")
+        conn_args = tuple(conn_args)
         
-        return conn
-    
-    def _put( self, conn_args, wrt, conn ):
+        sql = ';'.join( sqls )
         
-        if self._longlink[wrt] and conn != None :
-            self.conns.setdefault( conn_args, Queue.Queue() )
-            self.conns[conn_args].put( conn )
-            
-        return
+        conn = self._get( conn_args, True, sql, infos = infos )
+        rconn = None
         
-    def _traceback( self, info, wrt, conn, sql, time, r, *args ):
-        return self.mytraceback( conn, sql, time )
+        r = []
         
-    def mytraceback( self, conn, sql, time ):
+        starttime = time.time()
         
-        return
-
-class Tablet( object ) :
-    '''
-    tablet of table
-    '''
+        try :
+            while(True):
+                try :
+                    self._writemany( conn, sqls[len(r):], done=r )
+                    rconn = conn
+                    break
+                except MySQLdb.OperationalError, e :
+                    if e.args[0] in self.writeRetryError:
+                        self._discard( conn_args, conn )
+                        conn = None
+                        try :
+                            conn = self._get( conn_args, True, sql, infos )
+                        except ConnectionError, e :
+                            e.written = r
+                            raise
+                        self._traceback( infos, True, 
+                                         tuple(conn_args), sql, -1, None )
+                        starttime = time.time()
+                    else :
+                        raise
+        finally :
+            self._putback( conn_args, True, conn, rconn )
+            endtime = time.time()
+            # conn is None if connecting again failed, counted by _get
+            if conn == None :
+                pass
+            elif rconn == None :
+                self._traceback( infos, True, tuple(conn_args), sql, 0, None )
+            else :
+                self._traceback( infos, True, tuple(conn_args), sql,
+                                 endtime - starttime, r,
+                                 sum( [ w[0] for w in r ] ) )
+            
+        return r
     
-    def __init__ ( self, name, conn_args, cols=[] ):
-        
-        self.conn_args = conn_args
-        
-        self.name = str(name)
+    def _connect( self, conn_args ):
         
-        self.cols = [ str(c) for c in cols ]
-        self.defaultcols = [ str(c) for c in cols if not c.startswith('_') ]
+        conn = \
+            MySQLdb.Connection(
+                host=conn_args[0], port=conn_args[1], db=conn_args[4],
+                user=conn_args[2], passwd=conn_args[3],
+                connect_timeout = self.default_timeout,
+#                use_unicode=True, 
+                charset="utf8mb4",
+            )
         
+        conn.query("set autocommit=1")
         
-    def _buildrow( self, row ):
+        return conn
+    
+    @staticmethod
+    def _close( conn ):
         
-        return dict( [ ( k, sqlstr(v) ) for k, v in row.items() 
-                                        if k in self.cols ] )
+        try :
+            conn.close()
+        except MySQLdb.Error, e :
+            pass
         
-    def _insert( self, connpool, rows, dup=None ):
+        return
+    
+    def _reap( self, conn_args, now ):
         '''
-        return ( affect rows number , lastid )
+        close the idle connections of the backend unused for idletimeout,
+        must be called with self.lock held
         '''
         
-        rows = [ self._buildrow(row) for row in rows ]
-        dup = self._buildrow(dup) if dup else None
+        idles = self.conns.get( conn_args )
         
-        sql = self._insert_sql( rows, dup )
+        if self.idletimeout == None or not idles :
+            return
         
-        affectrows, lastid, info = connpool.write( self.conn_args, sql )
+        # idles are pushed and popped at the end, the oldest is at the front
+        n = 0
+        while n < len(idles) and now - idles[n][1] >= self.idletimeout :
+            n += 1
         
-        return affectrows, lastid
+        for conn, lastused in idles[:n] :
+            self._close( conn )
         
-    def _insert_sql( self, rows, dup = None, ignore = True ):
+        del idles[:n]
+        
+        self.opened[conn_args] -= n
+        self.stats['reaped'] += n
+        
+        if n :
+            self.lock.notifyAll()
+        
+        return
+    
+    def reap( self ):
         '''
-        INSERT [LOW_PRIORITY | DELAYED | HIGH_PRIORITY] [IGNORE]
-            [INTO] tbl_name [(col_name,...)]
-            {VALUES | VALUE} ({expr | DEFAULT},...),(...),...
-            [ ON DUPLICATE KEY UPDATE
-              col_name=expr
-                [, col_name=expr] ... ]
+        close idle connections of all backends unused for idletimeout
         '''
         
-        cols = set( sum( [ r.keys() for r in rows ] , [] ) )
-        
-        rows = [ [ r.get( c, 'DEFAULT' ) for c in cols ]
-                 for r in rows ]
+        self.lock.acquire()
+        try :
+            now = time.time()
+            for conn_args in self.conns.keys() :
+                self._reap( conn_args, now )
+        finally :
+            self.lock.release()
         
-        #print rows, [self.name], dup
+        return
+    
+    def _checkout( self, conn_args, wrt ):
+        '''
+        return ( idle connection or None, lastused )
+        a slot of the backend is reserved for the caller in both cases
+        '''
         
-        sql = ' '.join( [
+        self.lock.acquire()
+        try :
             
-            'INSERT',
-            # LOW_PRIORITY or DELAYED or ''
+            self.stats['checkouts'] += 1
+            
+            deadline = None
+            
+            while(True):
+                
+                now = time.time()
+                
+                self._reap( conn_args, now )
+                
+                idles = self.conns.get( conn_args )
+                
+                if self._longlink[wrt] and idles :
+                    return idles.pop()
+                
+                opened = self.opened.get( conn_args, 0 )
+                
+                if self.maxconnections == None or \
+                   opened < self.maxconnections :
+                    self.opened[conn_args] = opened + 1
+                    return None, now
+                
+                if idles :
+                    # the slot is held by an idle connection can not be
+                    # shared with this one, close it and take the slot over.
+                    conn, lastused = idles.pop(0)
+                    self._close( conn )
+                    self.stats['reaped'] += 1
+                    return None, now
+                
+                if deadline == None :
+                    self.stats['waits'] += 1
+                    deadline = ( now + self.waittimeout ) \
+                                    if self.waittimeout != None else -1
+                
+                if deadline != -1 and now >= deadline :
+                    self.stats['waittimeouts'] += 1
+                    raise ConnectionError, \
+                        ( 'connection pool is full', conn_args[:2], opened )
+                
+                self.lock.wait( min( deadline - now, self.waitinterval )
+                                if deadline != -1 else self.waitinterval )
+            
+        finally :
+            self.lock.release()
+    
+    def _get( self, conn_args, wrt, sql='', infos=() ):
+        
+        conn, lastused = self._checkout( conn_args, wrt )
+        
+        if conn != None and self.pinginterval != None and \
+           time.time() - lastused >= self.pinginterval :
+            try :
+                conn.ping()
+            except MySQLdb.Error, e :
+                self._close( conn )
+                conn = None
+                self.lock.acquire()
+                self.stats['pingfailed'] += 1
+                self.lock.release()
+        
+        if conn == None :
+            
+            try :
+                conn = self._connect( conn_args )
+            except MySQLdb.OperationalError, e :
+                self._release( conn_args )
+                self._traceback( infos, wrt, tuple(conn_args), sql, 0, self.connectionfailed )
+                self.connectionfailed += 1
+                raise ConnectionError, e.args
+            
+            self.lock.acquire()
+            self.stats['creations'] += 1
+            self.lock.release()
+        
+        return conn
+    
+    def _release( self, conn_args ):
+        
+        self.lock.acquire()
+        try :
+            self.opened[conn_args] -= 1
+            self.lock.notify()
+        finally :
+            self.lock.release()
+        
+        return
+    
+    def _put( self, conn_args, wrt, conn ):
+        
+        if conn == None :
+            return
+        
+        if not self._longlink[wrt] :
+            return self._discard( conn_args, conn )
+        
+        self.lock.acquire()
+        try :
+            self.conns.setdefault( conn_args, [] ).append( ( conn, time.time() ) )
+            self.lock.notify()
+        finally :
+            self.lock.release()
+        
+        return
+    
+    def _discard( self, conn_args, conn ):
+        
+        self._close( conn )
+        self._release( conn_args )
+        
+        return
+    
+    def _putback( self, conn_args, wrt, conn, rconn ):
+        '''
+        give back the connection after a query,
+        the connection is dropped if the query was not successed
+        '''
+        
+        if rconn != None :
+            return self._put( conn_args, wrt, rconn )
+        
+        if conn != None :
+            return self._discard( conn_args, conn )
+        
+        return
+    
+    def getstats( self ):
+        '''
+        return the counters and the opened/idle connections of each backend
+        '''
+        
+        self.lock.acquire()
+        try :
+            r = dict( self.stats )
+            r['connectionfailed'] = self.connectionfailed
+            r['backends'] = dict( [ ( conn_args[:2] + (conn_args[4],),
+                                      { 'opened' : n,
+                                        'idle' : len(self.conns.get(conn_args,[])),
+                                      } )
+                                    for conn_args, n in self.opened.items() ] )
+        finally :
+            self.lock.release()
+        
+        return r
+        
+    def _traceback( self, info, wrt, conn, sql, time, r, *args ):
+        if self.metrics != None :
+            self.metrics.record( info, wrt, conn, sql, time, r, *args )
+        return self.mytraceback( conn, sql, time )
+        
+    def mytraceback( self, conn, sql, time ):
+        
+        return
+
+
+class Transaction( object ):
+    '''
+    pin one connection of each backend of a SQLConnectionPool, and commit
+    the sqls on it at once
+    
+    with Transaction( connpool ) as tx :
+        users = tx.bind( usertable )
+        logs = tx.bind( logtable )
+        users.set( {'ID':1}, {'n':This('n')+1} )
+        logs.append( {'uid':1, 'msg':'n+1'} )
+    
+    the tables bound run their sqls in the transaction, a backend begins on
+    its first sql and is committed at the end of with, or rolled back if an
+    exception is raised. tx.commit() or tx.rollback() ends it as well, it
+    can not be used after ended.
+    
+    the backends are committed one by one, the rest are rolled back after
+    one failed to commit. the row caches of the tables bound are not used
+    in the transaction, and cleared after committed.
+    '''
+    
+    def __init__( self, connpool ):
+        
+        self.pool = connpool
+        
+        # conn_args -> ( conn, lock )
+        self.conns = {}
+        self.tables = []
+        self.ended = False
+        
+        self.lock = threading.Lock()
+        
+        return
+    
+    def bind( self, table ):
+        '''
+        return a copy of the table runs its sqls in the transaction
+        '''
+        
+        t = copy.copy( table )
+        t.connpool = self
+        t.rowcache = None
+        
+        self.tables.append( table )
+        
+        return t
+    
+    def _pin( self, conn_args, sql, infos ):
+        
+        self.lock.acquire()
+        try :
+            if self.ended :
+                raise EasySqlException, 'transaction ended'
+            
+            c = self.conns.get( conn_args )
+            
+            if c == None :
+                
+                conn = self.pool._get( conn_args, True, sql, infos )
+                
+                try :
+                    conn.query( 'BEGIN' )
+                except :
+                    self.pool._discard( conn_args, conn )
+                    raise
+                
+                c = ( conn, threading.Lock() )
+                self.conns[conn_args] = c
+        finally :
+            self.lock.release()
+        
+        return c
+    
+    def _run( self, conn_args, wrt, sql, infos, func, *args ):
+        
+        conn_args = tuple(conn_args)
+        
+        conn, lock = self._pin( conn_args, sql, infos )
+        
+        r = None
+        
+        starttime = time.time()
+        
+        lock.acquire()
+        try :
+            try :
+                r = func( conn, *args )
+            except MySQLdb.ProgrammingError, e :
+                e.args = tuple( list(e.args)+[sql,] )
+                raise
+        finally :
+            lock.release()
+            endtime = time.time()
+            if r == None :
+                self.pool._traceback( infos, wrt, conn_args, sql, 0, None )
+            elif wrt and type(r) == types.ListType :
+                self.pool._traceback( infos, wrt, conn_args, sql,
+                                      endtime - starttime, r,
+                                      sum( [ w[0] for w in r ] ) )
+            else :
+                self.pool._traceback( infos, wrt, conn_args, sql,
+                                      endtime - starttime, r )
+        
+        return r
+    
+    def read( self, conn_args, sql, presql=None, infos=() ):
+        
+        return self._run( conn_args, False,
+                          ';'.join( ( presql, sql ) ) \
+                                            if presql != None else sql,
+                          infos, self.pool._readpre, sql, presql )
+    
+    def iterread( self, conn_args, sql, batch=1000, infos=() ):
+        '''
+        the result is fetched at once, the connection is used by the others
+        '''
+        
+        rows = self.read( conn_args, sql, infos=infos )
+        
+        for i in range( 0, len(rows), batch ) :
+            yield rows[i:i+batch]
+        
+        return
+    
+    def explain( self, conn_args, sql, infos=() ):
+        
+        return self._run( conn_args, False, sql, infos,
+                          self.pool._read_with_cols, sql )
+    
+    def write( self, conn_args, sql, infos=() ):
+        
+        return self._run( conn_args, True, sql, infos,
+                          self.pool._write, sql, False )
+    
+    def writemany( self, conn_args, sqls, infos=() ):
+        
+        return self._run( conn_args, True, ';'.join( sqls ), infos,
+                          self.pool._writemany, sqls, False )
+    
+    def _end( self ):
+        
+        self.lock.acquire()
+        try :
+            if self.ended :
+                raise EasySqlException, 'transaction ended'
+            self.ended = True
+            conns, self.conns = self.conns, {}
+        finally :
+            self.lock.release()
+        
+        return [ ( conn_args, conn ) for conn_args, ( conn, lock )
+                 in conns.items() ]
+    
+    def _rollback( self, conn_args, conn ):
+        
+        try :
+            conn.rollback()
+        except MySQLdb.Error, e :
+            return self.pool._discard( conn_args, conn )
+        
+        return self.pool._put( conn_args, True, conn )
+    
+    def commit( self ):
+        
+        exc_info = None
+        
+        for conn_args, conn in self._end() :
+            
+            if exc_info != None :
+                self._rollback( conn_args, conn )
+                continue
+            
+            try :
+                conn.commit()
+            except MySQLdb.Error, e :
+                exc_info = sys.exc_info()
+                self.pool._discard( conn_args, conn )
+                continue
+            
+            self.pool._put( conn_args, True, conn )
+        
+        for t in self.tables :
+            if t.rowcache != None :
+                t.rowcache.clear()
+        
+        if exc_info != None :
+            raise exc_info[0], exc_info[1], exc_info[2]
+        
+        return
+    
+    def rollback( self ):
+        
+        for conn_args, conn in self._end() :
+            self._rollback( conn_args, conn )
+        
+        return
+    
+    def __enter__( self ):
+        
+        return self
+    
+    def __exit__( self, exc_type, exc_value, tb ):
+        
+        if self.ended :
+            return False
+        
+        if exc_type == None :
+            self.commit()
+        else :
+            self.rollback()
+        
+        return False
+
+class SQLTemplateCache( object ):
+    '''
+    LRU cache of the compiled sql templates of tablets
+    
+    a template is the sql skeleton which keeps '%s' for the escaped values,
+    keyed on table, statement, columns, condition keys and options.
+    '''
+    
+    def __init__( self, maxsize=1024 ):
+        
+        self.maxsize = maxsize
+        
+        self.tpls = collections.OrderedDict()
+        self.lock = threading.Lock()
+        
+        self.stats = { 'hits' : 0, 'misses' : 0, 'evictions' : 0 }
+        
+        return
+    
+    def get( self, key, compiler, *args ):
+        
+        self.lock.acquire()
+        try :
+            tpl = self.tpls.pop( key, None )
+            if tpl != None :
+                self.tpls[key] = tpl
+                self.stats['hits'] += 1
+                return tpl
+            self.stats['misses'] += 1
+        finally :
+            self.lock.release()
+        
+        tpl = compiler( *args )
+        
+        self.lock.acquire()
+        try :
+            self.tpls[key] = tpl
+            while len(self.tpls) > self.maxsize :
+                self.tpls.popitem( last = False )
+                self.stats['evictions'] += 1
+        finally :
+            self.lock.release()
+        
+        return tpl
+    
+    def clear( self ):
+        
+        self.lock.acquire()
+        try :
+            self.tpls.clear()
+        finally :
+            self.lock.release()
+        
+        return
+    
+    def getstats( self ):
+        
+        self.lock.acquire()
+        try :
+            r = dict( self.stats )
+            r['size'] = len(self.tpls)
+        finally :
+            self.lock.release()
+        
+        return r
+
+
+# placeholder of values when compiling a template,
+# escape_string never leaves a NUL in the escaped values.
+_TPL_HOLDER = '\0'
+
+def _tplcompile( sql ):
+    
+    return sql.replace( '%', '%%' ).replace( _TPL_HOLDER, '%s' )
+
+def _tplcolkey( c ):
+    
+    return sqlstr(c) if type(c) == SQLExprType else str(c)
+
+
+class Tablet( object ) :
+    '''
+    tablet of table
+    '''
+    
+    # shared by all tablets, set to None to build sql without cache
+    sqlcache = SQLTemplateCache()
+    
+    def __init__ ( self, name, conn_args, cols=[], keys=[] ):
+        
+        self.conn_args = conn_args
+        
+        self.name = str(name)
+        
+        self.cols = [ str(c) for c in cols ]
+        self.defaultcols = [ str(c) for c in cols if not c.startswith('_') ]
+        
+        # the primary key columns
+        self.keys = [ str(k) for k in keys ]
+        
+        
+    def _buildrow( self, row ):
+        
+        return dict( [ ( k, sqlstr(v) ) for k, v in row.items() 
+                                        if k in self.cols ] )
+    
+    def _template( self, key, compiler, *args ):
+        
+        if self.sqlcache == None :
+            return compiler( *args )
+        
+        return self.sqlcache.get( key, compiler, *args )
+    
+    @staticmethod
+    def _condxsql( condx ):
+        
+        return ( ' AND '.join( [ i._tosql() for i in condx ] ), ) \
+                                                    if condx != [] else ()
+        
+    def _insert( self, connpool, rows, dup=None ):
+        '''
+        return ( affect rows number , lastid )
+        '''
+        
+        n, lastid = 0, None
+        
+        for sql in self._insertchunks( rows, dup ) :
+            affectrows, _lastid, info = connpool.write( self.conn_args, sql, (self.name,) )
+            n += affectrows
+            lastid = _lastid if lastid == None else lastid
+        
+        return n, lastid
+    
+    def _insertchunks( self, rows, dup=None, chunkrows=None, chunkbytes=None ):
+        '''
+        return the insert sqls of rows, split to chunks of at most chunkrows
+        rows and chunkbytes bytes ( a single row may be larger )
+        '''
+        
+        rows = [ self._buildrow(row) for row in rows ]
+        dup = self._buildrow(dup) if dup else None
+        
+        return self._chunksql( self._insert_parts( rows, dup ),
+                               chunkrows, chunkbytes )
+    
+    @staticmethod
+    def _chunksql( parts, chunkrows=None, chunkbytes=None ):
+        
+        head, values, tail = parts
+        
+        if chunkrows == None and chunkbytes == None :
+            return [ head + ','.join(values) + tail ]
+        
+        fixed = len(head) + len(tail)
+        
+        sqls = []
+        chunk = []
+        size = fixed
+        
+        for v in values :
+            
+            if chunk != [] and \
+               ( ( chunkrows != None and len(chunk) >= chunkrows ) or \
+                 ( chunkbytes != None and size + len(v) + 1 > chunkbytes ) ) :
+                sqls.append( head + ','.join(chunk) + tail )
+                chunk = []
+                size = fixed
+            
+            chunk.append( v )
+            size += len(v) + 1
+        
+        if chunk != [] :
+            sqls.append( head + ','.join(chunk) + tail )
+        
+        return sqls
+        
+    def _insert_sql( self, rows, dup = None, ignore = True ):
+        
+        head, values, tail = self._insert_parts( rows, dup, ignore )
+        
+        return head + ','.join(values) + tail
+    
+    def _insert_parts( self, rows, dup = None, ignore = True ):
+        
+        cols = set([])
+        for r in rows :
+            cols.update( r )
+        cols = tuple(cols)
+        
+        dupkeys = tuple( dup.keys() ) if dup else ()
+        
+        head, rowtpl, tail = self._template(
+                                ( self.name, 'INSERT', cols, dupkeys, ignore ),
+                                self._insert_tpl, cols, dupkeys, ignore )
+        
+        return head, \
+               [ rowtpl % tuple( [ r.get( c, 'DEFAULT' ) for c in cols ] )
+                 for r in rows ], \
+               tail % tuple( [ dup[k] for k in dupkeys ] )
+        
+    def _insert_tpl( self, cols, dupkeys, ignore ):
+        '''
+        INSERT [LOW_PRIORITY | DELAYED | HIGH_PRIORITY] [IGNORE]
+            [INTO] tbl_name [(col_name,...)]
+            {VALUES | VALUE} ({expr | DEFAULT},...),(...),...
+            [ ON DUPLICATE KEY UPDATE
+              col_name=expr
+                [, col_name=expr] ... ]
+        '''
+        
+        head = ' '.join( [
+            
+            'INSERT',
+            # LOW_PRIORITY or DELAYED or ''
+            'IGNORE' if ignore else '',
+            'INTO',
+            '`'+self.name+'`',
+            '(%s)' % ( ','.join( [ '`%s`' % (str(c),) for c in cols ] ) ),
+            'VALUES',
+            '',
+        ] )
+        
+        rowtpl = '(%s)' % ( ','.join( [_TPL_HOLDER]*len(cols) ), )
+        
+        tail = ' ' + ( ('ON DUPLICATE KEY UPDATE %s' %
+                ( ','.join( [ '`%s`=%s' % ( k, _TPL_HOLDER ) for k in dupkeys ] ), )
+            ) if dupkeys else '' )
+        
+        return head, _tplcompile(rowtpl), _tplcompile(tail)
+    
+    def _select( self, connpool,
+                 cond=None, condx=[], cols=None, limit=None, offset=None,
+                 group=None, order=None, opts=[], uvars=[], columnar=False ):
+        '''
+        return ( result rows, result )
+        
+        the rows are the tuples of values when columnar
+        '''
+        
+        cond = self._buildrow(cond) if cond else None
+        
+        sql = self._select_sql( 
+                    cond, condx, cols, limit, offset, group, order,
+                    nocache = (True if 'SQL_NO_CACHE' in opts else None),
+                    calc_rows = (True if 'SQL_CALC_FOUND_ROWS' in opts else None)
+              )
+        
+        presql = self._set_sql( uvars ) if uvars != [] else None
+        
+        rst = connpool.read( self.conn_args , sql, presql, (self.name,) )
+        
+        cols = cols or self.defaultcols
+        
+        cols = [ getattr(c,'_colname',c) for c in cols ]
+        
+        if columnar :
+            rst = list( rst )
+        else :
+            rst = [ dict(zip(cols,row)) for row in rst ]
+        
+        rst2 = connpool.read( self.conn_args , 'SELECT FOUND_ROWS()',
+                                   infos=(self.name,) ) \
+                if 'SQL_CALC_FOUND_ROWS' in opts else None
+        
+        return len(rst), rst, rst2, None # the forth argument is uvars' results
+    
+    def _iterselect( self, connpool, cond=None, condx=[], cols=None,
+                           limit=None, batch=1000 ):
+        '''
+        yield the result rows batch by batch
+        '''
+        
+        cond = self._buildrow(cond) if cond else None
+        
+        sql = self._select_sql( cond, condx, cols, limit )
+        
+        cols = cols or self.defaultcols
+        
+        cols = [ getattr(c,'_colname',c) for c in cols ]
+        
+        for rows in connpool.iterread( self.conn_args, sql, batch,
+                                          (self.name,) ):
+            yield [ dict(zip(cols,row)) for row in rows ]
+        
+        return
+    
+    def _select_low( self, connpool, sql, ):
+        
+        rst = connpool.read( self.conn_args , sql, infos=(self.name,) )
+        
+        #rst = [ dict(zip(cols,row)) for row in rst ] 
+        
+        return len(rst), rst
+    
+    def _select_sql( self,
+                     cond=None, condx=[], cols=None,
+                     limit=None, offset=None,
+                     group=None, order=None, vset=None, nocache=None,
+                     calc_rows=None ):
+        
+        cols = cols or self.defaultcols
+        condkeys = tuple( cond.keys() ) if cond else ()
+        
+        # limit and offset are values of the template, one for all pages
+        page = ( ( '%d' % (limit,), ) if limit else () ) + \
+               ( ( '%d' % (offset,), ) if limit and offset else () )
+        
+        tpl = self._template(
+                ( self.name, 'SELECT', condkeys, condx != [],
+                  tuple( [ _tplcolkey(c) for c in cols ] ), len(page),
+                  tuple( [ sqlstr(g) for g in group ] ) if group else None,
+                  tuple( order ) if order else None,
+                  vset, nocache, calc_rows ),
+                self._select_tpl,
+                condkeys, condx != [], cols, bool(limit), len(page) > 1,
+                group, order, vset, nocache, calc_rows )
+        
+        return tpl % ( tuple( [ cond[k] for k in condkeys ] ) + \
+                       self._condxsql( condx ) + page )
+    
+    def _select_tpl( self,
+                     condkeys=(), condx=False, cols=None,
+                     limit=None, offset=None,
+                     group=None, order=None, vset=None, nocache=None,
+                     calc_rows=None ):
+        '''
+        SELECT
+            [ALL | DISTINCT | DISTINCTROW ]
+              [HIGH_PRIORITY]
+              [STRAIGHT_JOIN]
+              [SQL_SMALL_RESULT] [SQL_BIG_RESULT] [SQL_BUFFER_RESULT]
+              [SQL_CACHE | SQL_NO_CACHE] [SQL_CALC_FOUND_ROWS]
+            select_expr [, select_expr ...]
+            [FROM table_references
+            [WHERE where_condition]
+            [GROUP BY {col_name | expr | position}
+              [ASC | DESC], ... [WITH ROLLUP]]
+            [HAVING where_condition]
+            [ORDER BY {col_name | expr | position}
+              [ASC | DESC], ...]
+            [LIMIT {[offset,] row_count | row_count OFFSET offset}]
+            [PROCEDURE procedure_name(argument_list)]
+            [INTO OUTFILE 'file_name'
+                [CHARACTER SET charset_name]
+                export_options
+              | INTO DUMPFILE 'file_name'
+              | INTO var_name [, var_name]]
+            [FOR UPDATE | LOCK IN SHARE MODE]]
+        '''
+        
+        # limit and offset only tell if they have placeholders
+        cols = cols or self.defaultcols
+        
+        sql = ' '.join( [
+            
+            'SELECT',
+            'DISTINCT' if vset else '',
+            'SQL_CALC_FOUND_ROWS' if calc_rows else '',
+            'SQL_NO_CACHE' if nocache else '',
+            ','.join([ '%s' % ( ('`'+str(c)+'`') \
+                                if type(c) != SQLExprType else \
+                                sqlstr(c), \
+                              ) for c in cols ]),
+            'FROM `%s`' % self.name ,
+            'WHERE' if condkeys or condx else '',
+                ' AND '.join( [ '`%s`=%s' % ( k, _TPL_HOLDER )
+                                for k in condkeys ] ),
+                'AND' if condkeys and condx else '',
+                _TPL_HOLDER if condx else '',
+            'GROUP BY' if group else '',
+                ','.join( ['%s' % sqlstr(g) for g in group ] ) if group else '',
+            'ORDER BY' if order else '',
+                ','.join( [ '`%s` DESC' % o[1:] if o.startswith('~') else \
+                            ( '`%s`' % o )
+                            for o in order ] ) if order else '',
+            ('LIMIT ' + _TPL_HOLDER ) if limit else '',
+            ('OFFSET ' + _TPL_HOLDER ) if limit and offset else '',
+            
+        ] )
+        
+        return _tplcompile( sql )
+    
+    def _set_sql( self, uvars ):
+        """
+        SET variable_assignment [, variable_assignment] ...
+        
+        variable_assignment:
+              user_var_name = expr
+            | [GLOBAL | SESSION] system_var_name = expr
+            | @@[global. | session.]system_var_name = expr
+        """
+        
+        sql = ' '.join( [
+            
+            'SET',
+            ','.join( [ '@%s=%s' % ( str(v._varname), sqlstr_typed(v._value) ) 
+                        for v in uvars ])
+            
+        ] )
+        
+        return sql
+    
+    def _delete( self, connpool, cond=None, condx=[], limit=None ):
+        '''
+        return ( affect rows, None )
+        '''
+        cond = self._buildrow(cond) if cond else None
+        
+        sql = self._delete_sql( cond, condx, limit )
+        
+        affectrows, lastid, info = connpool.write( self.conn_args, sql, (self.name,) )
+        
+        return affectrows, None
+        
+    def _delete_sql( self, cond=None, condx=[], limit=None, ignore = True ):
+        
+        condkeys = tuple( cond.keys() ) if cond else ()
+        
+        tpl = self._template(
+                ( self.name, 'DELETE', condkeys, condx != [], limit, ignore ),
+                self._delete_tpl, condkeys, condx != [], limit, ignore )
+        
+        return tpl % ( tuple( [ cond[k] for k in condkeys ] ) + \
+                       self._condxsql( condx ) )
+        
+    def _delete_tpl( self, condkeys=(), condx=False, limit=None, ignore = True ):
+        '''
+        DELETE [LOW_PRIORITY] [QUICK] [IGNORE] FROM tbl_name
+            [WHERE where_condition]
+            [ORDER BY ...]
+            [LIMIT row_count]
+        '''
+        
+        sql = ' '.join( [
+            
+            'DELETE',
             'IGNORE' if ignore else '',
+            'FROM `%s`' % self.name ,
+            'WHERE' if condkeys or condx else '',
+                ' AND '.join( [ '`%s`=%s' % ( k, _TPL_HOLDER )
+                                for k in condkeys ] ),
+                'AND' if condkeys and condx else '',
+                _TPL_HOLDER if condx else '',
+            ('LIMIT %d' % (limit,) ) if limit else '',
+            
+        ] )
+        
+        return _tplcompile( sql )
+        
+    def _replace( self, connpool, rows ):
+        '''
+        return ( affect rows, lastid )
+        '''
+        
+        n, lastid = 0, None
+        
+        for sql in self._replacechunks( rows ) :
+            affectrows, _lastid, info = connpool.write( self.conn_args, sql, (self.name,) )
+            n += affectrows
+            lastid = _lastid if lastid == None else lastid
+        
+        return n, lastid
+    
+    def _replacechunks( self, rows, chunkrows=None, chunkbytes=None ):
+        '''
+        return the replace sqls of rows, split to chunks as _insertchunks
+        '''
+        
+        rows = [ self._buildrow(row) for row in rows ]
+        
+        return self._chunksql( self._replace_parts( rows ),
+                               chunkrows, chunkbytes )
+        
+    def _replace_sql( self, rows ):
+        
+        head, values, tail = self._replace_parts( rows )
+        
+        return head + ','.join(values) + tail
+    
+    def _replace_parts( self, rows ):
+        
+        cols = set([])
+        for r in rows :
+            cols.update( r )
+        cols = tuple(cols)
+        
+        head, rowtpl = self._template( ( self.name, 'REPLACE', cols ),
+                                       self._replace_tpl, cols )
+        
+        return head, \
+               [ rowtpl % tuple( [ r.get( c, 'DEFAULT' ) for c in cols ] )
+                 for r in rows ], \
+               ''
+        
+    def _replace_tpl( self, cols ):
+        '''
+        REPLACE [LOW_PRIORITY | DELAYED]
+            [INTO] tbl_name [(col_name,...)]
+            {VALUES | VALUE} ({expr | DEFAULT},...),(...),...
+        '''
+        
+        head = ' '.join( [
+            
+            'REPLACE',
+            # LOW_PRIORITY or DELAYED or ''
             'INTO',
             '`'+self.name+'`',
             '(%s)' % ( ','.join( [ '`%s`' % (str(c),) for c in cols ] ) ),
             'VALUES',
-            ','.join( [ '(%s)' % ( ','.join(r), ) for r in rows ] ),
-            ('ON DUPLICATE KEY UPDATE %s' %
-                ( ','.join( [ '`%s`=%s' % i for i in dup.items() ] ), )
-            ) if dup else '',
+            '',
+        ] )
+        
+        rowtpl = '(%s)' % ( ','.join( [_TPL_HOLDER]*len(cols) ), )
+        
+        return head, _tplcompile(rowtpl)
+        
+    def _update( self, connpool, row, cond=None, condx=[], limit=None):
+        '''
+        return ( matched rows, affectrows )
+        '''
+        
+        row = self._buildrow(row)
+        cond = self._buildrow(cond) if cond else None
+        
+        sql = self._update_sql( row, cond, condx, limit )
+        
+        affectrows, lastid, info = connpool.write( self.conn_args, sql, (self.name,) )
+        
+        return info['Rows matched'], affectrows
+        
+        
+    def _update_sql( self, row, cond=None, condx=[],
+                           limit=None, ignore = True  ):
+        
+        rowkeys = tuple( row.keys() )
+        condkeys = tuple( cond.keys() ) if cond else ()
+        
+        tpl = self._template(
+                ( self.name, 'UPDATE', rowkeys, condkeys, condx != [],
+                  limit, ignore ),
+                self._update_tpl, rowkeys, condkeys, condx != [], limit, ignore )
+        
+        return tpl % ( tuple( [ row[k] for k in rowkeys ] ) + \
+                       tuple( [ cond[k] for k in condkeys ] ) + \
+                       self._condxsql( condx ) )
+    
+    def _update_tpl( self, rowkeys, condkeys=(), condx=False,
+                           limit=None, ignore = True  ):
+        '''
+        UPDATE [LOW_PRIORITY] [IGNORE] table_reference
+            SET col_name1={expr1|DEFAULT} [, col_name2={expr2|DEFAULT}] ...
+            [WHERE where_condition]
+            [ORDER BY ...]
+            [LIMIT row_count]
+        '''
+        
+        sql = ' '.join( [
+            
+            'UPDATE',
+            'IGNORE' if ignore else '',
+            '`%s`' % self.name ,
+            'SET',
+                ','.join( [ '`%s`=%s' % ( str(k), _TPL_HOLDER )
+                            for k in rowkeys ] ),
+            'WHERE' if condkeys or condx else '',
+                ' AND '.join( [ '`%s`=%s' % ( str(k), _TPL_HOLDER )
+                                for k in condkeys ] ),
+                'AND' if condkeys and condx else '',
+                _TPL_HOLDER if condx else '',
+            ('LIMIT %d' % (limit,) ) if limit else '',
+            
         ] )
         
-        #print sql, type(sql), sql.encode('hex')
+        return _tplcompile( sql )
+    
+    def _writesql( self, connpool, sql ):
+        '''
+        return ( affect rows, lastid )
+        '''
+        
+        affectrows, lastid, info = connpool.write( self.conn_args, sql, (self.name,) )
+        
+        return affectrows, lastid
+    
+    def _writesqls( self, connpool, sqls ):
+        '''
+        return [ ( affect rows, lastid ), ... ]
+        '''
+        
+        rs = connpool.writemany( self.conn_args, sqls, (self.name,) )
+        
+        return [ ( affectrows, lastid ) for affectrows, lastid, info in rs ]
+    
+    def _explain_low( self, connpool, sql, ):
+        
+        rst, fs = connpool.explain( self.conn_args , sql, (self.name,) )
+        
+        #rst = [ dict(zip(cols,row)) for row in rst ] 
+        
+        return len(rst), rst, fs
+
+
+
+
+
+
+def _keyvalue( v ):
+    '''
+    the value of a key column as a str, the same for the values mysql
+    takes as equal, 1 and 1L and '1', 1.5 and Decimal('1.50')
+    '''
+    
+    if type(v) in ( types.IntType, types.LongType, types.BooleanType ) :
+        return str( int(v) )
+    
+    if type(v) == types.FloatType or isinstance( v, decimal.Decimal ) :
+        v = decimal.Decimal( repr(v) if type(v) == types.FloatType else v )
+        return str( v.normalize() ) if v else '0'
+    
+    if type(v) == types.UnicodeType :
+        return v.encode('utf-8')
+    
+    return str(v)
+
+
+def _cachekey( keys, row, exact=True ):
+    '''
+    return the values of the key columns in row or None,
+    if exact, row must not have other columns.
+    '''
+    
+    if not row or ( exact and len(row) != len(keys) ) :
+        return None
+    
+    try :
+        k = tuple( [ row[c] for c in keys ] )
+        hash(k)
+    except ( KeyError, TypeError ), e :
+        return None
+    
+    if any( [ isinstance( v, Raw ) for v in k ] ) :
+        return None
+    
+    return tuple( [ _keyvalue(v) for v in k ] )
+
+
+class RowCache( object ):
+    '''
+    LRU and TTL cache of the rows read by the key columns of a table
+    
+    only the conditions made of exactly the key columns are cached.
+    
+    a read takes version() before it asks mysql and puts the row with it,
+    the row is not kept if the key is invalidated in between.
+    '''
+    
+    def __init__( self, keys, maxsize=10000, ttl=None ):
+        
+        self.keys = tuple( [ str(k) for k in keys ] )
+        self.maxsize = maxsize
+        self.ttl = ttl
+        
+        self.rows = collections.OrderedDict() # ( key, cols ) -> ( expire, row )
+        self.index = {}                       # key -> set( cols, ... )
+        self.lock = threading.Lock()
+        
+        # counted up by each invalidate and clear, the keys invalidated
+        # last are kept with it, the ones forgotten are taken as floor
+        self.epoch = 0
+        self.floor = 0
+        self.invalidated = collections.OrderedDict()
+        
+        self.stats = { 'hits' : 0,
+                       'misses' : 0,
+                       'evictions' : 0,
+                       'expired' : 0,
+                       'invalidations' : 0,
+                       'clears' : 0,
+                     }
+        
+        return
+    
+    def key( self, row, exact=True ):
+        
+        return _cachekey( self.keys, row, exact )
+    
+    def _remove( self, k, cols ):
+        
+        del self.rows[(k, cols)]
+        
+        kcols = self.index[k]
+        kcols.discard( cols )
+        if not kcols :
+            del self.index[k]
+        
+        return
+    
+    def get( self, k, cols ):
+        
+        self.lock.acquire()
+        try :
+            
+            r = self.rows.pop( ( k, cols ), None )
+            
+            if r == None :
+                self.stats['misses'] += 1
+                return NoArg
+            
+            if r[0] != None and r[0] < time.time() :
+                self.rows[(k, cols)] = r
+                self._remove( k, cols )
+                self.stats['expired'] += 1
+                self.stats['misses'] += 1
+                return NoArg
+            
+            self.rows[(k, cols)] = r
+            self.stats['hits'] += 1
+            
+        finally :
+            self.lock.release()
+        
+        return dict( r[1] )
+    
+    def get_multi( self, ks, cols ):
+        '''
+        return { key : row, ... } of the keys cached
+        '''
+        
+        r = [ ( k, self.get( k, cols ) ) for k in ks ]
+        
+        return dict( [ ( k, row ) for k, row in r if row != NoArg ] )
+    
+    def version( self ):
+        
+        return self.epoch
+    
+    def put( self, k, cols, row, version=None ):
+        
+        expire = ( time.time() + self.ttl ) if self.ttl != None else None
+        
+        self.lock.acquire()
+        try :
+            
+            # invalidated after the row was read
+            if version != None and \
+               self.invalidated.get( k, self.floor ) > version :
+                return
+            
+            self.rows.pop( ( k, cols ), None )
+            self.rows[(k, cols)] = ( expire, dict(row) )
+            self.index.setdefault( k, set([]) ).add( cols )
+            
+            while len(self.rows) > self.maxsize :
+                ( ek, ecols ), r = self.rows.popitem( last = False )
+                self.rows[(ek, ecols)] = r
+                self._remove( ek, ecols )
+                self.stats['evictions'] += 1
+            
+        finally :
+            self.lock.release()
+        
+        return
+    
+    def invalidate( self, k ):
+        
+        self.lock.acquire()
+        try :
+            for cols in list( self.index.get( k, () ) ) :
+                self._remove( k, cols )
+                self.stats['invalidations'] += 1
+            
+            self.epoch += 1
+            self.invalidated.pop( k, None )
+            self.invalidated[k] = self.epoch
+            
+            while len(self.invalidated) > self.maxsize :
+                self.floor = self.invalidated.popitem( last = False )[1]
+        finally :
+            self.lock.release()
+        
+        return
+    
+    def clear( self ):
+        
+        self.lock.acquire()
+        try :
+            self.rows.clear()
+            self.index.clear()
+            self.epoch += 1
+            self.floor = self.epoch
+            self.invalidated.clear()
+            self.stats['clears'] += 1
+        finally :
+            self.lock.release()
+        
+        return
+    
+    def getstats( self ):
+        
+        self.lock.acquire()
+        try :
+            r = dict( self.stats )
+            r['size'] = len(self.rows)
+        finally :
+            self.lock.release()
+        
+        return r
+
+
+class MemcacheRowCache( object ):
+    '''
+    row cache of a table in memcached, shared by the processes
+    
+    client is an easymc.Memcache or easymc.MemcacheRing. only the rows read
+    with all columns are cached. clear() bumps a generation number kept in
+    memcached, other processes see it in genttl seconds. errors of memcached
+    are taken as misses.
+    
+    the rows are filled by add, a fill never overwrites a row, and expire in
+    ttl seconds, a stale row put by a read racing an invalidate is not kept
+    longer than that.
+    '''
+    
+    def __init__( self, keys, client, prefix, ttl=300, genttl=1 ):
+        
+        self.keys = tuple( [ str(k) for k in keys ] )
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+        self.genttl = genttl
+        
+        self.genkey = prefix + ':gen'
+        self.gen = None
+        self.genchecked = 0
+        
+        self.lock = threading.Lock()
+        
+        self.stats = { 'hits' : 0,
+                       'misses' : 0,
+                       'bypasses' : 0,
+                       'invalidations' : 0,
+                       'clears' : 0,
+                       'errors' : 0,
+                     }
+        
+        return
+    
+    def _count( self, name, n=1 ):
+        
+        self.lock.acquire()
+        self.stats[name] += n
+        self.lock.release()
+        
+        return
+    
+    def key( self, row, exact=True ):
+        
+        return _cachekey( self.keys, row, exact )
+    
+    @staticmethod
+    def _newgen():
+        
+        # a lost generation is not counted again from 0, which would bring
+        # back the rows of the generations before
+        return str( int( time.time() * 1000 ) )
+    
+    def _getgen( self ):
+        
+        now = time.time()
+        
+        if self.gen != None and now - self.genchecked < self.genttl :
+            return self.gen
+        
+        gen = self.client.get( self.genkey )
+        
+        if gen == None :
+            newgen = self._newgen()
+            self.client.add( self.genkey, newgen )
+            gen = self.client.get( self.genkey, newgen )
+        
+        self.gen = int(gen)
+        self.genchecked = now
+        
+        return self.gen
+    
+    def _mckey( self, k, gen ):
+        
+        # the values normalized by key(), 1 and '1' are the same key
+        k = hashlib.md5( '\x1f'.join( [ sqlstr(v) for v in k ] ) ).hexdigest()
+        
+        return '%s:%d:%s' % ( self.prefix, gen, k )
+    
+    def get( self, k, cols ):
+        
+        return self.get_multi( [k,], cols ).get( k, NoArg )
+    
+    def get_multi( self, ks, cols ):
+        
+        if cols != None :
+            self._count( 'bypasses', len(ks) )
+            return {}
+        
+        try :
+            gen = self._getgen()
+            mcks = dict( [ ( self._mckey( k, gen ), k ) for k in ks ] )
+            r = self.client.get_multi( mcks.keys() )
+        except IOError, e :
+            self._count( 'errors' )
+            self._count( 'misses', len(ks) )
+            return {}
+        
+        self._count( 'hits', len(r) )
+        self._count( 'misses', len(ks) - len(r) )
+        
+        return dict( [ ( mcks[mck], row ) for mck, row in r.items() ] )
+    
+    def version( self ):
+        
+        # the fills are made by add, a row deleted is not put back by them
+        return None
+    
+    def put( self, k, cols, row, version=None ):
+        
+        if cols != None :
+            return
+        
+        try :
+            self.client.add( self._mckey( k, self._getgen() ), row, self.ttl )
+        except IOError, e :
+            self._count( 'errors' )
+        
+        return
+    
+    def invalidate( self, k ):
+        
+        try :
+            self.client.delete( self._mckey( k, self._getgen() ) )
+        except IOError, e :
+            self._count( 'errors' )
+        
+        self._count( 'invalidations' )
+        
+        return
+    
+    def clear( self ):
+        
+        try :
+            if self.client.incr( self.genkey ) == None :
+                self.client.add( self.genkey, self._newgen() )
+        except IOError, e :
+            self._count( 'errors' )
+        
+        self.gen = None
+        self._count( 'clears' )
+        
+        return
+    
+    def getstats( self ):
+        
+        self.lock.acquire()
+        try :
+            r = dict( self.stats )
+        finally :
+            self.lock.release()
+        
+        return r
+
+
+class _ColIndex( dict ):
+    '''
+    column name -> position, shared by all the records of a Rows
+    '''
+    
+    def __init__( self, cols ):
+        
+        dict.__init__( self, [ ( c, i ) for i, c in enumerate( cols ) ] )
+        self.cols = tuple( cols )
+
+
+class Record( object ):
+    '''
+    a read only row of Rows, the values are kept in a tuple and looked up
+    by name like a dict, record.asdict() turns it to a dict.
+    '''
+    
+    __slots__ = ( '_index', '_vals' )
+    
+    __hash__ = None
+    
+    def __init__( self, index, vals ):
+        
+        self._index = index
+        self._vals = vals
+    
+    def __getitem__( self, k ):
+        
+        return self._vals[ self._index[k] ]
+    
+    def get( self, k, default=None ):
+        
+        i = self._index.get( k )
+        
+        return default if i == None else self._vals[i]
+    
+    def __contains__( self, k ):
+        
+        return k in self._index
+    
+    has_key = __contains__
+    
+    def __len__( self ):
+        
+        return len( self._vals )
+    
+    def __iter__( self ):
+        
+        return iter( self._index.cols )
+    
+    def keys( self ):
+        
+        return list( self._index.cols )
+    
+    def values( self ):
+        
+        return list( self._vals )
+    
+    def items( self ):
+        
+        return zip( self._index.cols, self._vals )
+    
+    def asdict( self ):
+        
+        return dict( zip( self._index.cols, self._vals ) )
+    
+    def __eq__( self, other ):
+        
+        if isinstance( other, Record ) :
+            other = other.asdict()
+        
+        return self.asdict() == other
+    
+    def __ne__( self, other ):
+        
+        return not self.__eq__( other )
+    
+    def __repr__( self ):
+        
+        return repr( self.asdict() )
+
+
+class Rows( object ):
+    '''
+    columnar result, the rows are kept as tuples of values in rows.rows,
+    and are only turned to Record when accessed.
+    
+    rows[i]            # Record
+    rows.column('a')   # list of the values of column a
+    rows.columns()     # { 'a' : [...], 'b' : [...] }
+    rows.todicts()     # list of dicts
+    '''
+    
+    def __init__( self, cols, rows=None ):
+        
+        self._index = _ColIndex( cols )
+        self.cols = self._index.cols
+        self.rows = rows if rows != None else []
+    
+    def __len__( self ):
+        
+        return len( self.rows )
+    
+    def __iter__( self ):
+        
+        index = self._index
+        
+        for vals in self.rows :
+            yield Record( index, vals )
+    
+    def __getitem__( self, i ):
+        
+        if type( i ) == types.SliceType :
+            return Rows( self.cols, self.rows[i] )
+        
+        return Record( self._index, self.rows[i] )
+    
+    def extend( self, other ):
+        
+        if isinstance( other, Rows ) :
+            if other.cols != self.cols :
+                raise TypeError, ( 'columns mismatch', self.cols, other.cols )
+            other = other.rows
+        
+        self.rows.extend( other )
+    
+    def column( self, name ):
+        
+        i = self._index[name]
+        
+        return [ vals[i] for vals in self.rows ]
+    
+    def columns( self ):
+        
+        if self.rows == [] :
+            return dict( [ ( c, [] ) for c in self.cols ] )
+        
+        return dict( zip( self.cols, map( list, zip( *self.rows ) ) ) )
+    
+    def todicts( self ):
+        
+        cols = self.cols
+        
+        return [ dict( zip( cols, vals ) ) for vals in self.rows ]
+    
+    def __repr__( self ):
+        
+        return '<Rows %r %d rows>' % ( self.cols, len(self.rows) )
+
+
+class QueryJob( object ):
+    
+    def __init__( self ):
+        
+        self.cancelled = False
+        self.done = Queue.Queue()
+    
+    def finish( self, i, r ):
+        
+        self.done.put( ( i, r ) )
+
+
+class QueryFuture( object ):
+    '''
+    result of a query run in the threads, returned by QueryThreadPool.submit
+    
+    f.result( timeout=None )      # wait and return, or raise the exception
+    f.add_done_callback( fn )     # fn(f) is called in the thread at the end
+    '''
+    
+    def __init__( self ):
+        
+        self.cancelled = False
+        
+        self._r = None  # ( True, result ) or ( False, exc_info )
+        self._cond = threading.Condition()
+        self._callbacks = []
+    
+    def finish( self, i, r ):
+        
+        self._cond.acquire()
+        try :
+            self._r = r
+            callbacks, self._callbacks = self._callbacks, []
+            self._cond.notifyAll()
+        finally :
+            self._cond.release()
+        
+        for fn in callbacks :
+            self._callback( fn )
+        
+        return
+    
+    def _callback( self, fn ):
+        
+        try :
+            fn( self )
+        except :
+            logging.exception( 'QueryFuture callback %r failed', fn )
+        
+        return
+    
+    def done( self ):
+        
+        return self._r != None
+    
+    def _wait( self, timeout ):
+        
+        self._cond.acquire()
+        try :
+            if timeout == None :
+                while self._r == None :
+                    self._cond.wait()
+            else :
+                deadline = time.time() + timeout
+                while self._r == None :
+                    left = deadline - time.time()
+                    if left <= 0 :
+                        raise TimeoutError, 'query not finished'
+                    self._cond.wait( left )
+        finally :
+            self._cond.release()
+        
+        return self._r
+    
+    def result( self, timeout=None ):
+        
+        ok, r = self._wait( timeout )
+        
+        if not ok :
+            raise r[0], r[1], r[2]
+        
+        return r
+    
+    def exception( self, timeout=None ):
+        
+        ok, r = self._wait( timeout )
+        
+        return None if ok else r[1]
+    
+    def add_done_callback( self, fn ):
+        
+        self._cond.acquire()
+        try :
+            if self._r == None :
+                self._callbacks.append( fn )
+                return
+        finally :
+            self._cond.release()
+        
+        self._callback( fn )
+        
+        return
+
+
+class QueryThreadPool( object ):
+    '''
+    daemon threads to run the queries of tablets concurrently
+    '''
+    
+    def __init__( self, threadnum ):
+        
+        self.threadnum = threadnum
+        self.q = Queue.Queue()
+        self.closed = False
         
-        return sql
+        self.ts = [ threading.Thread( target=self.run )
+                    for i in range(threadnum) ]
+        
+        for t in self.ts :
+            t.setDaemon(True)
+            t.start()
+        
+        return
     
-    def _select( self, connpool,
-                 cond=None, condx=[], cols=None, limit=None, offset=None,
-                 group=None, order=None, opts=[], uvars=[] ):
+    def run( self ):
+        
+        while True :
+            
+            item = self.q.get()
+            
+            if item == None :
+                break
+            
+            job, i, func, args = item
+            
+            if job.cancelled :
+                job.finish( i, None )
+                continue
+            
+            try :
+                r = ( True, func( *args ) )
+            except :
+                r = ( False, sys.exc_info() )
+            
+            job.finish( i, r )
+        
+        return
+    
+    def map( self, func, argslist, enough=None ):
         '''
-        return ( result rows, result )
+        run func(*args) for each args in argslist concurrently,
+        return the results in the order of argslist.
+        
+        enough(result) is called on the results in order, once it returns
+        True the jobs not started are cancelled and the results before are
+        returned.
         '''
         
-        cond = self._buildrow(cond) if cond else None
+        if self.closed :
+            raise EasySqlException, 'query thread pool closed'
         
-        sql = self._select_sql( 
-                    cond, condx, cols, limit, offset, group, order,
-                    nocache = (True if 'SQL_NO_CACHE' in opts else None),
-                    calc_rows = (True if 'SQL_CALC_FOUND_ROWS' in opts else None)
-              )
+        job = QueryJob()
         
-        presql = self._set_sql( uvars ) if uvars != [] else None
+        for i, args in enumerate(argslist) :
+            self.q.put( ( job, i, func, args ) )
         
-        rst = connpool.read( self.conn_args , sql, presql )
+        rsts = [NoArg] * len(argslist)
+        nxt = 0
         
-        cols = cols or self.defaultcols
+        while nxt < len(argslist) :
+            
+            i, r = job.done.get()
+            rsts[i] = r
+            
+            if r != None and r[0] == False :
+                job.cancelled = True
+                raise r[1][0], r[1][1], r[1][2]
+            
+            while nxt < len(argslist) and rsts[nxt] != NoArg :
+                nxt += 1
+                if enough != None and enough( rsts[nxt-1][1] ) :
+                    job.cancelled = True
+                    return [ r[1] for r in rsts[:nxt] ]
         
-        cols = [ getattr(c,'_colname',c) for c in cols ]
+        return [ r[1] for r in rsts ]
+    
+    def submit( self, func, *args, **kwargs ):
+        '''
+        run func(*args, **kwargs) in a thread, return QueryFuture
+        '''
         
-        rst = [ dict(zip(cols,row)) for row in rst ]
+        if self.closed :
+            raise EasySqlException, 'query thread pool closed'
         
-        rst2 = connpool.read( self.conn_args , 'SELECT FOUND_ROWS()') \
-                if 'SQL_CALC_FOUND_ROWS' in opts else None
+        if kwargs :
+            args = ( func, args, kwargs )
+            func = lambda f, a, kw : f( *a, **kw )
         
-        return len(rst), rst, rst2, None # the forth argument is uvars' results
+        future = QueryFuture()
+        
+        self.q.put( ( future, 0, func, args ) )
+        
+        return future
     
-    def _select_low( self, connpool, sql, ):
+    def close( self, timeout=None ):
+        '''
+        stop the threads after the jobs queued are done, wait them at most
+        timeout seconds. the pool can not be used after closed.
+        '''
         
-        rst = connpool.read( self.conn_args , sql )
+        if self.closed :
+            return
         
-        #rst = [ dict(zip(cols,row)) for row in rst ] 
+        self.closed = True
         
-        return len(rst), rst
+        for t in self.ts :
+            self.q.put( None )
+        
+        for t in self.ts :
+            if t is not threading.currentThread() :
+                t.join( timeout )
+        
+        return
+
+
+class AsyncStream( object ):
+    '''
+    fetch the items of a blocking iterator in the threads of an
+    AsyncConnectionPool, stream.fetch() returns the QueryFuture of the list
+    of the next batch items, the list is [] at the end.
+    '''
     
-    def _select_sql( self,
-                     cond=None, condx=[], cols=None,
-                     limit=None, offset=None,
-                     group=None, order=None, vset=None, nocache=None,
-                     calc_rows=None ):
+    def __init__( self, pool, it, batch=1000, close=None ):
+        
+        self.pool = pool
+        self.it = it
+        self.batch = batch
+        self._close = close or getattr( it, 'close', None )
+        
+        # a generator must not run in two threads at once
+        self.lock = threading.Lock()
+    
+    def _fetch( self ):
+        
+        self.lock.acquire()
+        try :
+            return list( itertools.islice( self.it, self.batch ) )
+        finally :
+            self.lock.release()
+    
+    def fetch( self ):
+        
+        return self.pool.submit( self._fetch )
+    
+    def _closeit( self ):
+        
+        self.lock.acquire()
+        try :
+            if self._close != None :
+                self._close()
+        finally :
+            self.lock.release()
+    
+    def close( self ):
         '''
-        SELECT
-            [ALL | DISTINCT | DISTINCTROW ]
-              [HIGH_PRIORITY]
-              [STRAIGHT_JOIN]
-              [SQL_SMALL_RESULT] [SQL_BIG_RESULT] [SQL_BUFFER_RESULT]
-              [SQL_CACHE | SQL_NO_CACHE] [SQL_CALC_FOUND_ROWS]
-            select_expr [, select_expr ...]
-            [FROM table_references
-            [WHERE where_condition]
-            [GROUP BY {col_name | expr | position}
-              [ASC | DESC], ... [WITH ROLLUP]]
-            [HAVING where_condition]
-            [ORDER BY {col_name | expr | position}
-              [ASC | DESC], ...]
-            [LIMIT {[offset,] row_count | row_count OFFSET offset}]
-            [PROCEDURE procedure_name(argument_list)]
-            [INTO OUTFILE 'file_name'
-                [CHARACTER SET charset_name]
-                export_options
-              | INTO DUMPFILE 'file_name'
-              | INTO var_name [, var_name]]
-            [FOR UPDATE | LOCK IN SHARE MODE]]
+        stop the stream, return the QueryFuture of closing
         '''
         
-        cols = cols or self.defaultcols
+        return self.pool.submit( self._closeit )
+
+
+class AsyncConnectionPool( object ):
+    '''
+    run the blocking queries of a SQLConnectionPool in threads and return
+    QueryFuture at once, so one thread can keep many queries running.
+    
+    pool = AsyncConnectionPool( 32 )
+    f = pool.read( conn_args, sql )
+    f.add_done_callback( lambda f : ... )
+    rows = f.result()
+    pool.close()
+    '''
+    
+    def __init__( self, threadnum=16, connpool=None ):
         
-        sql = ' '.join( [
-            
-            'SELECT',
-            'DISTINCT' if vset else '',
-            'SQL_CALC_FOUND_ROWS' if calc_rows else '',
-            'SQL_NO_CACHE' if nocache else '',
-            ','.join([ '%s' % ( ('`'+str(c)+'`') \
-                                if type(c) != SQLExprType else \
-                                sqlstr(c), \
-                              ) for c in cols ]),
-            'FROM `%s`' % self.name ,
-            'WHERE' if cond or condx!=[] else '',
-                ' AND '.join( [ '`%s`=%s' % i for i in cond.items() ] ) \
-                                                                if cond else '',
-                'AND' if cond and condx !=[] else '',
-                ' AND '.join( [ i._tosql() for i in condx ] ),
-            'GROUP BY' if group else '',
-                ','.join( ['%s' % sqlstr(g) for g in group ] ) if group else '',
-            'ORDER BY' if order else '',
-                ','.join( [ '`%s` DESC' % o[1:] if o.startswith('~') else \
-                            ( '`%s`' % o )
-                            for o in order ] ) if order else '',
-            ('LIMIT %d' % (limit,) ) if limit else '',
-            ('OFFSET %d' % (offset,) ) if limit and offset else '',
-            
-        ] )
+        self.connpool = connpool if connpool != None else SQLConnectionPool()
+        self.querypool = QueryThreadPool( threadnum )
         
-        return sql
+        return
     
-    def _set_sql( self, uvars ):
-        """
-        SET variable_assignment [, variable_assignment] ...
+    @property
+    def closed( self ):
         
-        variable_assignment:
-              user_var_name = expr
-            | [GLOBAL | SESSION] system_var_name = expr
-            | @@[global. | session.]system_var_name = expr
-        """
+        return self.querypool.closed
+    
+    def close( self, timeout=None ):
+        '''
+        stop the threads after the queries queued are done,
+        the connections of connpool are left open.
+        '''
         
-        sql = ' '.join( [
-            
-            'SET',
-            ','.join( [ '@%s=%s' % ( str(v._varname), sqlstr_typed(v._value) ) 
-                        for v in uvars ])
-            
-        ] )
+        return self.querypool.close( timeout )
+    
+    def submit( self, func, *args, **kwargs ):
         
-        return sql
+        return self.querypool.submit( func, *args, **kwargs )
     
-    def _delete( self, connpool, cond=None, condx=[], limit=None ):
+    def read( self, conn_args, sql, presql=None, infos=() ):
+        
+        return self.submit( self.connpool.read, conn_args, sql, presql, infos )
+    
+    def write( self, conn_args, sql, infos=() ):
+        
+        return self.submit( self.connpool.write, conn_args, sql, infos )
+    
+    def writemany( self, conn_args, sqls, infos=() ):
+        
+        return self.submit( self.connpool.writemany, conn_args, sqls, infos )
+    
+    def explain( self, conn_args, sql, infos=() ):
+        
+        return self.submit( self.connpool.explain, conn_args, sql, infos )
+    
+    def iterread( self, conn_args, sql, batch=1000, infos=() ):
         '''
-        return ( affect rows, None )
+        return AsyncStream of the rows
         '''
-        cond = self._buildrow(cond) if cond else None
         
-        sql = self._delete_sql( cond, condx, limit )
+        rows = self.connpool.iterread( conn_args, sql, batch, infos )
+        
+        return AsyncStream( self, itertools.chain.from_iterable( rows ),
+                            batch, rows.close )
+
+
+class ReplicaBalancer( object ):
+    '''
+    choose a tablet among the replicas of Table._gettablets
+    
+    reads go to the better of two random healthy replicas, by the ewma of
+    the latency times the queries in flight ( power of two choices ).
+    writes stick to the first healthy replica, the primary, until it fails.
+    
+    a replica failing failthreshold times in a row is out for cooldown
+    seconds ( circuit open ), then one read is let through to try it, and
+    it is back if the read succeeds. a failure counts penalty seconds into
+    the ewma, so a replica that failed is also tried again by one read
+    every cooldown seconds.
+    '''
+    
+    def __init__( self, alpha=0.3, failthreshold=3, cooldown=10.0,
+                        penalty=1.0 ):
         
-        affectrows, lastid, info = connpool.write( self.conn_args, sql )
+        self.alpha = alpha
+        self.failthreshold = failthreshold
+        self.cooldown = cooldown
+        self.penalty = penalty
         
-        return affectrows, None
+        self.lock = threading.Lock()
         
-    def _delete_sql( self, cond=None, condx=[], limit=None, ignore = True ):
+        self.health = {}     # tablet -> state
+        self.primaries = {}  # replicas -> tablet of the writes
+        
+        return
+    
+    def _state( self, t ):
+        
+        s = self.health.get( t )
+        
+        if s == None :
+            s = { 'ewma' : None, 'inflight' : 0, 'queries' : 0,
+                  'failures' : 0, 'fails' : 0, 'opened' : 0,
+                  'openuntil' : 0, 'probeat' : 0 }
+            self.health[t] = s
+        
+        return s
+    
+    def _cost( self, t ):
+        
+        s = self._state( t )
+        
+        return ( s['ewma'] or 0.0 ) * ( s['inflight'] + 1 )
+    
+    def choose( self, tablets, wrt=False ):
+        
+        now = time.time()
+        
+        self.lock.acquire()
+        try :
+            usable = [ t for t in tablets
+                         if self._state(t)['openuntil'] <= now ]
+            
+            if usable == [] :
+                # all are out, try the one out for the shortest time
+                return min( tablets, key = lambda t : self.health[t]['openuntil'] )
+            
+            if wrt :
+                t = self.primaries.get( tablets )
+                if t not in usable :
+                    t = usable[0]
+                    self.primaries[tablets] = t
+            elif len(usable) == 1 :
+                t = usable[0]
+            elif any( [ self.health[t]['fails'] and
+                        self.health[t]['probeat'] <= now for t in usable ] ) :
+                t = [ t for t in usable if self.health[t]['fails'] and
+                                          self.health[t]['probeat'] <= now ][0]
+                self.health[t]['probeat'] = now + self.cooldown
+            else :
+                a, b = random.sample( usable, 2 )
+                t = a if self._cost(a) <= self._cost(b) else b
+            
+            s = self.health[t]
+            if s['openuntil'] != 0 :
+                # half open, keep the others away while trying it
+                s['openuntil'] = now + self.cooldown
+        finally :
+            self.lock.release()
+        
+        return t
+    
+    def begin( self, t ):
+        
+        self.lock.acquire()
+        try :
+            self._state(t)['inflight'] += 1
+        finally :
+            self.lock.release()
+        
+        return
+    
+    def end( self, t, elapsed=None, failed=False ):
         '''
-        DELETE [LOW_PRIORITY] [QUICK] [IGNORE] FROM tbl_name
-            [WHERE where_condition]
-            [ORDER BY ...]
-            [LIMIT row_count]
+        a query on t is over, elapsed is None if it is not measured
         '''
         
-        sql = ' '.join( [
+        self.lock.acquire()
+        try :
+            s = self._state(t)
+            s['inflight'] = max( s['inflight'] - 1, 0 )
             
-            'DELETE',
-            'IGNORE' if ignore else '',
-            'FROM `%s`' % self.name ,
-            'WHERE' if cond or condx!=[] else '',
-                ' AND '.join( [ '`%s`=%s' % i for i in cond.items() ] ) \
-                                                                if cond else '',
-                'AND' if cond and condx !=[] else '',
-                ' AND '.join( [ i._tosql() for i in condx ] ),
-            ('LIMIT %d' % (limit,) ) if limit else '',
+            if failed :
+                elapsed = self.penalty
+                s['failures'] += 1
+                s['fails'] += 1
+                s['probeat'] = time.time() + self.cooldown
+                if s['fails'] >= self.failthreshold :
+                    s['openuntil'] = time.time() + self.cooldown
+                    s['opened'] += 1
+            elif elapsed != None :
+                s['queries'] += 1
+                s['fails'] = 0
+                s['openuntil'] = 0
             
-        ] )
-        
-        return sql
+            if elapsed != None :
+                s['ewma'] = elapsed if s['ewma'] == None else \
+                            s['ewma'] + self.alpha * ( elapsed - s['ewma'] )
+        finally :
+            self.lock.release()
         
-    def _replace( self, connpool, rows ):
+        return
+    
+    def getstats( self ):
         '''
-        return ( affect rows, lastid )
+        return the health of the replicas by 'tablet@host:port'
         '''
         
-        rows = [ self._buildrow(row) for row in rows ]
+        now = time.time()
+        
+        self.lock.acquire()
+        try :
+            r = {}
+            for t, s in self.health.items() :
+                s = dict( s )
+                s['state'] = 'open' if s.pop('openuntil') > now else 'closed'
+                s.pop('probeat')
+                s['primary'] = t in self.primaries.values()
+                r[ '%s@%s:%s' % ( t.name, t.conn_args[0], t.conn_args[1] ) ] = s
+        finally :
+            self.lock.release()
+        
+        return r
+
+
+def _routehash( v ):
+    
+    if type(v) == types.UnicodeType :
+        v = v.encode('utf-8')
+    
+    return int( hashlib.md5( str(v) ).hexdigest()[:8], 16 )
+
+
+class HashRing( object ):
+    '''
+    consistent hash ring of shard names for Table.setrouter,
+    a value goes to the first point after its md5 on the ring, each name
+    has replicas points. adding a name moves about 1/n of the values to it.
+    
+    ring = HashRing( [ 's0', 's1', 's2' ] )
+    ring.route( 12345 )            # 's1'
+    ring.addname( 's3' )
+    '''
+    
+    def __init__( self, names=[], replicas=160 ):
         
-        sql = self._replace_sql( rows )
+        self.replicas = replicas
+        self.names = []
         
-        affectrows, lastid, info = connpool.write( self.conn_args, sql )
+        # ( sorted points, name of each point ), replaced at once on change
+        self._ring = ( [], [] )
         
-        return affectrows, lastid
+        for name in names :
+            self.addname( name )
         
-    def _replace_sql( self, rows ):
-        '''
-        REPLACE [LOW_PRIORITY | DELAYED]
-            [INTO] tbl_name [(col_name,...)]
-            {VALUES | VALUE} ({expr | DEFAULT},...),(...),...
-        '''
+        return
+    
+    def addname( self, name ):
+        
+        points = [ ( _routehash( '%s#%d' % ( name, i ) ), name )
+                   for i in range( self.replicas ) ]
+        
+        points = sorted( zip( *self._ring ) + points )
+        
+        self._ring = ( [ p for p, n in points ], [ n for p, n in points ] )
+        self.names = self.names + [ name ]
+        
+        return
+    
+    def route( self, v ):
+        
+        points, owners = self._ring
+        
+        return owners[ bisect.bisect( points, _routehash(v) ) % len(points) ]
+    
+    def route_many( self, vs ):
+        
+        points, owners = self._ring
+        n = len(points)
+        bs = bisect.bisect
+        
+        return [ owners[ bs( points, _routehash(v) ) % n ] for v in vs ]
+
+
+_RangeNumberTypes = ( types.IntType, types.LongType, types.BooleanType,
+                      types.FloatType, decimal.Decimal )
+
+def _rangevalue( b, v ):
+    '''
+    v as the type of the range bound b, python compares a str greater than
+    any number, so '5' must not be bisected in the integer bounds.
+    '''
+    
+    if v == None or isinstance( v, type(b) ) :
+        return v
+    
+    if isinstance( b, _RangeNumberTypes ) :
+        
+        if isinstance( v, _RangeNumberTypes ) :
+            return v
+        
+        if type(v) in StrTypes :
+            try :
+                return type(b)( v.strip() )
+            except ( ValueError, ArithmeticError ) :
+                pass
+    
+    elif type(b) in StrTypes and type(v) in StrTypes :
+        return v
+    
+    raise TypeError, ( 'value can not be compared with the range bounds', v, b )
+
+
+class RangeTable( object ):
+    '''
+    range table of shard names for Table.setrouter,
+    names[i] holds the values in [ bounds[i-1], bounds[i] ) , the first and
+    the last are open ended, so len(names) == len(bounds) + 1
+    
+    rt = RangeTable( [ 1000, 2000 ], [ 's0', 's1', 's2' ] )
+    rt.route( 1500 )               # 's1'
+    rt.route( '1500' )             # 's1', a value is read as the type of bounds
+    rt.addname( 3000, 's3' )       # split s2, [3000, ...) goes to s3
+    
+    a value can not be read as the type of the bounds raises TypeError.
+    '''
+    
+    def __init__( self, bounds=[], names=[''] ):
         
-        cols = set( sum( [ r.keys() for r in rows ] , [] ) )
+        if len(names) != len(bounds) + 1 or list(bounds) != sorted(bounds) :
+            raise TypeError, ( 'bad range table', bounds, names )
         
-        rows = [ [ r.get( c, 'DEFAULT' ) for c in cols ]
-                 for r in rows ]
+        for b in bounds[1:] :
+            _rangevalue( bounds[0], b )
         
-        sql = ' '.join( [
-            
-            'REPLACE',
-            # LOW_PRIORITY or DELAYED or ''
-            'INTO',
-            '`'+self.name+'`',
-            '(%s)' % ( ','.join( [ '`%s`' % (str(c),) for c in cols ] ) ),
-            'VALUES',
-            ','.join( [ '(%s)' % ( ','.join(r), ) for r in rows ] ),
-            
-        ] )
+        # ( bounds, names ), replaced at once on change
+        self._table = ( list(bounds), list(names) )
         
-        return sql
+        return
+    
+    @property
+    def names( self ):
         
-    def _update( self, connpool, row, cond=None, condx=[], limit=None):
-        '''
-        return ( matched rows, affectrows )
-        '''
+        return self._table[1]
+    
+    def addname( self, bound, name ):
         
-        row = self._buildrow(row)
-        cond = self._buildrow(cond) if cond else None
+        bounds, names = self._table
         
-        sql = self._update_sql( row, cond, condx, limit )
+        bound = _rangevalue( bounds[0], bound ) if bounds else bound
         
-        affectrows, lastid, info = connpool.write( self.conn_args, sql )
+        i = bisect.bisect_right( bounds, bound )
         
-        return info['Rows matched'], affectrows
+        self._table = ( bounds[:i] + [bound] + bounds[i:],
+                        names[:i+1] + [name] + names[i+1:] )
         
+        return
+    
+    def route( self, v ):
         
-    def _update_sql( self, row, cond=None, condx=[],
-                           limit=None, ignore = True  ):
-        '''
-        UPDATE [LOW_PRIORITY] [IGNORE] table_reference
-            SET col_name1={expr1|DEFAULT} [, col_name2={expr2|DEFAULT}] ...
-            [WHERE where_condition]
-            [ORDER BY ...]
-            [LIMIT row_count]
-        '''
+        bounds, names = self._table
         
-        sql = ' '.join( [
-            
-            'UPDATE',
-            'IGNORE' if ignore else '',
-            '`%s`' % self.name ,
-            'SET',
-                ','.join( [ '`%s`=%s' % ( str(k), v ) for k, v in row.items() ] ),
-            'WHERE' if cond or condx!=[] else '',
-                ' AND '.join( [ '`%s`=%s' % ( str(k), v ) for k, v in cond.items() ] ) \
-                                                                if cond else '',
-                'AND' if cond and condx !=[] else '',
-                ' AND '.join( [ i._tosql() for i in condx ] ),
-            ('LIMIT %d' % (limit,) ) if limit else '',
-            
-        ] )
+        if bounds :
+            v = _rangevalue( bounds[0], v )
         
-        return sql
+        return names[ bisect.bisect_right( bounds, v ) ]
     
-    def _explain_low( self, connpool, sql, ):
+    def route_many( self, vs ):
         
-        rst, fs = connpool.explain( self.conn_args , sql )
+        bounds, names = self._table
+        bs = bisect.bisect_right
         
-        #rst = [ dict(zip(cols,row)) for row in rst ] 
+        if not bounds :
+            return [ names[0] ] * len(vs)
         
-        return len(rst), rst, fs
-
-
-
-
+        b = bounds[0]
+        
+        return [ names[ bs( bounds, _rangevalue( b, v ) ) ] for v in vs ]
 
 
 class Table ( object ) :
@@ -1174,21 +3508,152 @@ class Table ( object ) :
         
         return [slc.step]
     
-    def __init__ ( self, tablets = [], name=None ):
+    def __init__ ( self, tablets = [], name=None, connpool=None ):
         
         self.name = name
         
         self.colconv = []
         self.colset = set([])
         
-        self.connpool = SQLConnectionPool()
+        self.connpool = connpool if connpool != None else SQLConnectionPool()
         self.tablets = tablets
         self.hashtablets = {'':tuple(self.tablets)}
+        self.hasher = None
+        
+        # HashRing or RangeTable on the column routekey, None is splitter
+        self.router = None
+        self.routekey = None
+        
+        # ReplicaBalancer choosing among the replicas, None is random
+        self.balancer = None
         
         #self._x_splitter = lambda x : [('',None,None),]
         
         self.retrytimes = 3
         
+        # QueryThreadPool to read the tablets concurrently, None is one by one
+        self.querypool = None
+        self._ownquerypool = None
+        
+        # max rows and bytes of a multi-row insert/replace, None is unlimited
+        self.chunkrows = None
+        self.chunkbytes = None
+        
+        # RowCache or MemcacheRowCache of the single row reads,
+        # None is not cached
+        self.rowcache = None
+        
+        # the key columns compare ignoring case and trailing spaces
+        # ( the _ci collations ), get_many matches the rows back so
+        self.casefold = False
+        
+        return
+    
+    def setrowcache( self, keys, maxsize=10000, ttl=None ):
+        '''
+        table.setrowcache( ['ID',], maxsize=10000, ttl=60 )
+        table.setrowcache( None )   # disable the cache
+        '''
+        
+        self.rowcache = RowCache( keys, maxsize, ttl ) if keys != None else None
+        
+        return
+    
+    def _cachekey( self, cond, condx, cols, limit, offset,
+                         group, order, opts, pres ):
+        '''
+        return ( key, cols ) of the cache if the read is a single row lookup
+        by the key columns, or None
+        '''
+        
+        if self.rowcache == None or limit != 1 or condx or offset or \
+           group or order or opts or pres :
+            return None
+        
+        k = self.rowcache.key( cond )
+        
+        if k == None :
+            return None
+        
+        return k, tuple( [ _tplcolkey(c) for c in cols ] ) if cols else None
+    
+    def _uncacherows( self, rows ):
+        
+        if self.rowcache == None :
+            return
+        
+        for row in rows :
+            
+            k = self.rowcache.key( row, False )
+            
+            if k == None :
+                # can not know which row is changed
+                return self.rowcache.clear()
+            
+            self.rowcache.invalidate( k )
+        
+        return
+    
+    def _uncachecond( self, cond, condx, row=None ):
+        
+        if self.rowcache == None :
+            return
+        
+        k = self.rowcache.key( cond ) if not condx else None
+        
+        if k == None :
+            return self.rowcache.clear()
+        
+        self.rowcache.invalidate( k )
+        
+        if row != None :
+            k = self.rowcache.key( row, False )
+            if k != None :
+                self.rowcache.invalidate( k )
+        
+        return
+    
+    def setchunk( self, chunkrows=None, chunkbytes=None ):
+        '''
+        table.setchunk( 1000 )
+        table.setchunk( chunkbytes = 1024*1024 ) # keep below max_allowed_packet
+        '''
+        
+        self.chunkrows = chunkrows
+        self.chunkbytes = chunkbytes
+        
+        return
+    
+    def setcasefold( self, casefold=True ):
+        '''
+        table.setcasefold( True )   # the key columns are of a _ci collation
+        table.setcasefold( False )  # binary, 'ABC' is not 'abc'
+        '''
+        
+        self.casefold = casefold
+        
+        return
+    
+    def setfanout( self, pool ):
+        '''
+        table.setfanout( 16 )
+        table.setfanout( QueryThreadPool(16) ) # share the threads in tables
+        table.setfanout( None )                # read the tablets one by one
+        
+        the threads made by table.setfanout( n ) are stopped when replaced.
+        '''
+        
+        if self.querypool != None and self.querypool is self._ownquerypool :
+            self.querypool.close()
+        
+        self._ownquerypool = None
+        
+        if type(pool) in ( types.IntType, types.LongType ) :
+            pool = QueryThreadPool( pool )
+            self._ownquerypool = pool
+        
+        self.querypool = pool
+        
         return
     
     def splitter( self, row ):
@@ -1201,31 +3666,159 @@ class Table ( object ) :
     
     def _splitter( self, row, oper ):
         
+        if self.router != None :
+            return [ self.hashtablets[h] for h in self._route( row ) ]
+        
         return [ self.hashtablets[h]
                  for h, mrcnd, _id in self.splitter_ex( row, oper ) ]
     
     def _splitter_ex( self, row, oper ):
         
+        if self.router != None :
+            return [ ( self.hashtablets[h], None, None )
+                     for h in self._route( row ) ]
+        
         return [ ( self.hashtablets[h], mrcnd, _id )
                  for h, mrcnd, _id in self.splitter_ex( row, oper ) ]
     
+    def _splittermany( self, rows, oper ):
+        '''
+        return the tablets of each row, the rows are routed in one call
+        of the router if it is set
+        '''
+        
+        if self.router == None :
+            return [ self._splitter( row, oper ) for row in rows ]
+        
+        k = self.routekey
+        
+        if any( [ k not in row or isinstance( row[k], Raw ) for row in rows ] ) :
+            return [ self._splitter( row, oper ) for row in rows ]
+        
+        hts = self.hashtablets
+        
+        return [ [ hts[h] ]
+                 for h in self.router.route_many( [ row[k] for row in rows ] ) ]
+    
+    def _route( self, row ):
+        
+        v = row.get( self.routekey, NoArg ) if row else NoArg
+        
+        if v == NoArg or isinstance( v, Raw ) :
+            # a shard can hold several ranges of a RangeTable, read it once
+            seen = set([])
+            return [ n for n in self.router.names
+                     if not ( n in seen or seen.add( n ) ) ]
+        
+        return [ self.router.route( v ) ]
+    
+    def setrouter( self, router, key ):
+        '''
+        route the rows by the value of column key with router
+        ( HashRing or RangeTable ) instead of splitter, the names of the
+        router are the keys of the hashtablets ( see _hashtablets ).
+        the conditions without key go to all the tablets.
+        
+        table.setrouter( None, None ) to use splitter again
+        '''
+        
+        if router != None :
+            missing = [ n for n in router.names if n not in self.hashtablets ]
+            if missing != [] :
+                raise PrimaryKeyError, ( 'no tablets of the shards', missing )
+        
+        self.router = router
+        self.routekey = key
+        
+        return
+    
     def _hashtablets( self, hasher ):
         
-        h = [ hasher(t) for t in self.tablets ]
-        hset = set(h)
-        h = zip( self.tablets, h )
+        hts = {}
+        
+        for t in self.tablets :
+            hts.setdefault( hasher(t), [] ).append( t )
+        
+        self.hasher = hasher
+        self.hashtablets = dict( [ ( h, tuple(ts) ) for h, ts in hts.items() ] )
         
-        self.hashtablets = dict(
-                             [ ( hs,
-                                 tuple( [ t for t, ha in h if ha == hs ] )
-                               ) for hs in hset ]
-                           )
+        return
+    
+    def addtablet( self, tablet ):
+        '''
+        add a tablet online, it is put into hashtablets by the hasher given
+        to _hashtablets. add its name to the router after it.
+        
+        table.addtablet( Tablet( 'tbl_s3', conn_args, cols ) )
+        ring.addname( 's3' )
+        '''
+        
+        h = self.hasher( tablet ) if self.hasher != None else ''
+        
+        hts = dict( self.hashtablets )
+        hts[h] = hts.get( h, () ) + ( tablet, )
+        
+        self.tablets = self.tablets + [ tablet ]
+        self.hashtablets = hts
         
         return
     
-    def _gettablets( self, tbl ):
+    def _gettablets( self, tbl, wrt=False ):
+        
+        if self.balancer == None :
+            return random.choice(tbl)
+        
+        return self.balancer.choose( tbl, wrt )
+    
+    # the errors of the connection, not of the query ( as lock wait
+    # timeout 1205 or deadlock 1213 ), are the failures of a replica
+    replicaErrors = frozenset( SQLConnectionPool.readRetryError +
+                               SQLConnectionPool.writeRetryError )
+    
+    def _tabletcall( self, tbl, wrt, method, *args ):
+        '''
+        call method of a tablet of tbl, or method( tablet, *args ) if it is
+        a function, the balancer is told how it went
+        '''
+        
+        t = self._gettablets( tbl, wrt )
+        
+        if type( method ) in types.StringTypes :
+            call = getattr( t, method )
+        else :
+            call = lambda *args : method( t, *args )
+        
+        if self.balancer == None :
+            return call( *args )
+        
+        self.balancer.begin( t )
+        
+        elapsed, failed = None, False
+        starttime = time.time()
+        
+        try :
+            r = call( *args )
+            elapsed = time.time() - starttime
+        except ConnectionError, e :
+            failed = True
+            raise
+        except MySQLdb.OperationalError, e :
+            failed = e.args[0] in self.replicaErrors if e.args else True
+            raise
+        finally :
+            self.balancer.end( t, elapsed, failed )
+        
+        return r
+    
+    def setbalancer( self, balancer ):
+        '''
+        table.setbalancer( ReplicaBalancer() )
+        table.setbalancer( None )   # random replica
+        '''
+        
+        self.balancer = balancer
         
-        return random.choice(tbl)
+        return
         
     def _conv( self, row, k_in, k_out, conv ):
         
@@ -1249,6 +3842,132 @@ class Table ( object ) :
         return dict( [ (str(k), v) for k, v in row.items()
                               if k not in self.colset ]\
                      + sum( newcols, [] ) )
+    
+    @staticmethod
+    def _convrows( rows, convs, dropcols ):
+        '''
+        convert a page of rows column by column,
+        each converter is applied once on its whole columns.
+        
+        convs : [ ( k_in, k_out, bulkconv ), ... ]
+        
+        return None if the rows are not all of the same columns
+        '''
+        
+        keys = rows[0].keys()
+        n = len(keys)
+        
+        if n == 0 or any( [ len(r) != n for r in rows ] ) or \
+           any( [ k_in == [] or k_in == () for k_in, k_out, conv in convs ] ):
+            return None
+        
+        try :
+            values = map( operator.itemgetter(*keys), rows )
+        except KeyError, e :
+            return None
+        
+        if n == 1 :
+            values = [ (v,) for v in values ]
+        
+        names, outs = Table._convcolumns( keys, zip( *values ), convs, dropcols )
+        
+        if outs == [] :
+            return [ {} for r in rows ]
+        
+        return [ dict( zip( names, vals ) ) for vals in zip( *outs ) ]
+    
+    @staticmethod
+    def _convcolumns( keys, columns, convs, dropcols ):
+        '''
+        convert the columns named by keys, each converter is applied once
+        on its whole columns.
+        
+        return ( names, columns ) after conversion
+        '''
+        
+        data = dict( zip( keys, columns ) )
+        
+        names = [ str(k) for k in keys if k not in dropcols ]
+        outs = [ data[k] for k in keys if k not in dropcols ]
+        
+        for k_in, k_out, conv in convs :
+            
+            if any( [ k not in data for k in k_in ] ) :
+                continue
+            
+            if len( columns[0] ) == 0 :
+                names.extend( k_out )
+                outs.extend( [ () ] * len( k_out ) )
+                continue
+            
+            for k, col in zip( k_out, conv( *[ data[k] for k in k_in ] ) ) :
+                names.append( k )
+                outs.append( col )
+        
+        return names, outs
+    
+    def _encoderows( self, rows ):
+        
+        if rows == [] :
+            return []
+        
+        rst = self._convrows( rows,
+                              [ ( cc[0], cc[1], _bulkconv(cc[2]) )
+                                for cc in self.colconv ],
+                              () )
+        
+        if rst == None :
+            rst = [ self._encoderow(row) for row in rows ]
+        
+        return rst
+    
+    def _decoderows( self, rows ):
+        
+        if rows == [] :
+            return []
+        
+        rst = self._convrows( rows,
+                              [ ( cc[1], cc[0], _bulkconv(cc[3]) )
+                                for cc in self.colconv ],
+                              self.colset )
+        
+        if rst == None :
+            rst = [ self._decoderow(row) for row in rows ]
+        
+        return rst
+    
+    def _resultcols( self, cols ):
+        
+        cols = cols or ( self.tablets[0].defaultcols if self.tablets else [] )
+        
+        return [ getattr(c,'_colname',c) for c in cols ]
+    
+    def _decodecolumns( self, cols, rows ):
+        '''
+        decode the value tuples of cols column by column to Rows
+        '''
+        
+        if cols == [] :
+            return Rows( [], [ () for r in rows ] )
+        
+        columns = zip( *rows ) if rows != [] else [ () ] * len(cols)
+        
+        names, outs = self._convcolumns( cols, columns,
+                                         [ ( cc[1], cc[0], _bulkconv(cc[3]) )
+                                           for cc in self.colconv ],
+                                         self.colset )
+        
+        if len( set(names) ) != len( names ) :
+            # the later column wins, as in the dict rows
+            last = dict( [ ( k, i ) for i, k in enumerate( names ) ] )
+            keep = [ i for i, k in enumerate( names ) if last[k] == i ]
+            names = [ names[i] for i in keep ]
+            outs = [ outs[i] for i in keep ]
+        
+        if outs == [] :
+            return Rows( [], [ () for r in rows ] )
+        
+        return Rows( names, zip( *outs ) if rows != [] else [] )
         
     #def setsplitter( self, splitter ):
     #    
@@ -1269,73 +3988,150 @@ class Table ( object ) :
         
         return
         
-    def _write( self, rows, ondup = None ):
+    def _grouprows( self, rows, oper, opername ):
+        '''
+        return [ ( tablets, rows ), ... ] in the order of the first row
+        of each tablets
+        '''
         
-        rows = [ self._encoderow(row) for row in rows ]
+        groups = {}
+        tbls = []
+        tblc = []
+        
+        for row, t in zip( rows, self._splittermany( rows, oper ) ) :
+            
+            if len(t) != 1 :
+                tblc.append( row )
+                continue
+            
+            t = t[0]
+            
+            if t not in groups :
+                groups[t] = []
+                tbls.append( t )
+            
+            groups[t].append( row )
         
-        tbls = [ self._splitter( row, 'insert' ) for row in rows ]
-        tblc = [ r for r, t in zip(rows, tbls) if len(t) != 1 ]
         if tblc != [] :
             raise PrimaryKeyError, \
-                           ( 'Can not find the tablet on write', tblc )
-        tbls = [ t[0] for t in tbls ]
+                           ( 'Can not find the tablet on '+opername, tblc )
+        
+        return [ ( t, groups[t] ) for t in tbls ]
+    
+    def _tabletwrite( self, tbl, sqls ):
+        '''
+        run the chunk sqls of a tablet in order, the chunks of at most
+        chunkbytes together are sent in one round trip if the connpool
+        pipelines, retry the sqls of a round trip not done
+        '''
+        
+        n, lastid = 0, None
+        
+        batches = []
+        size = None
+        
+        # without chunkbytes a chunk is sent alone, chunkrows is all
+        # the rows a round trip
+        for sql in sqls :
+            if size == None or self.chunkbytes == None or \
+               size + len(sql) + 1 > self.chunkbytes :
+                batches.append( [] )
+                size = -1
+            batches[-1].append( sql )
+            size += len(sql) + 1
+        
+        for batch in batches :
+            
+            rs = []
+            
+            for excpt in ([ConnectionError]*(self.retrytimes-1)+[None,]) :
+                try :
+                    rs += self._tabletcall( tbl, True, '_writesqls',
+                                            self.connpool, batch[len(rs):] )
+                except excpt as e :
+                    # autocommit, the sqls done must not run again
+                    rs += [ w[:2] for w in getattr( e, 'written', [] ) ]
+                    continue
+                
+                break
+            
+            for _n, _lastid in rs :
+                n += _n
+                lastid = _lastid if lastid == None else lastid
         
-        tblrows = [ ( tbl, [ r for r, t in zip(rows,tbls) if t == tbl ] )
-                    for tbl in set(tbls) ]
+        return n, lastid
+    
+    def _bulkwrite( self, tblsqls ):
+        '''
+        run the sqls of the tablets, concurrently if the table has querypool
+        '''
         
-        for excpt in ([ConnectionError]*(self.retrytimes-1)+[None,]) :
-            
-            try : 
-                rsts = [ self._gettablets(tbl)._insert( 
-                                            self.connpool, rows, ondup )
-                         for tbl, rows in tblrows ]
-            except excpt as e :
-                continue
-            
-            break
+        if self.querypool != None and len(tblsqls) > 1 :
+            rsts = self.querypool.map( self._tabletwrite, tblsqls )
+        else :
+            rsts = [ self._tabletwrite( tbl, sqls ) for tbl, sqls in tblsqls ]
         
         n, lastids = zip(*rsts)
         n = sum(n)
         
         return n, lastids
     
-    def _replace( self, rows ):
+    def _write( self, rows, ondup = None ):
         
-        rows = [ self._encoderow(row) for row in rows ]
-        tbls = [ self._splitter( row, 'replace' ) for row in rows ]
-        tblc = [ r for r, t in zip(rows, tbls) if len(t) != 1 ]
-        if tblc != [] :
-            raise PrimaryKeyError, \
-                           ( 'Can not find the tablet on replace', tblc )
-        tbls = [ t[0] for t in tbls ]
+        rows = self._encoderows( rows )
         
-        tblrows = [ ( tbl, [ r for r, t in zip(rows,tbls) if t == tbl ] )
-                    for tbl in set(tbls) ]
+        tblrows = self._grouprows( rows, 'insert', 'write' )
         
-        for excpt in ([ConnectionError]*(self.retrytimes-1)+[None,]) :
-            
-            try :
-                rsts = [ self._gettablets(tbl)._replace( self.connpool, rows )
-                         for tbl, rows in tblrows ]
-            except excpt as e :
-                continue
-            
-            break
+        try :
+            return self._bulkwrite( [ ( tbl,
+                                        tbl[0]._insertchunks( rows, ondup,
+                                                              self.chunkrows,
+                                                              self.chunkbytes ) )
+                                      for tbl, rows in tblrows ] )
+        finally :
+            # insert ignore never changes the rows exist
+            if ondup :
+                self._uncacherows( rows )
+    
+    def _replace( self, rows ):
         
-        n, lastids = zip(*rsts)
-        n = sum(n)
+        rows = self._encoderows( rows )
         
-        return n, lastids
+        tblrows = self._grouprows( rows, 'replace', 'replace' )
+        
+        try :
+            return self._bulkwrite( [ ( tbl,
+                                        tbl[0]._replacechunks( rows,
+                                                               self.chunkrows,
+                                                               self.chunkbytes ) )
+                                      for tbl, rows in tblrows ] )
+        finally :
+            self._uncacherows( rows )
 
     
     def _read( self, cond, condx=[],
                      cols=None, limit=None, offset=None, 
-                     group=None, order=None, opts=[], pres=[] ):
+                     group=None, order=None, opts=[], pres=[], cached=True,
+                     columnar=False ):
         
         if type( cond ) in ArrayTypes :
             cond = dict(sum([ c.items() for c in cond ], []))
         
         cond = self._encoderow(cond) if cond else cond
+        
+        ck = self._cachekey( cond, condx, cols, limit, offset,
+                             group, order, opts, pres )
+        
+        if columnar :
+            ck = None
+        
+        if ck != None and cached :
+            row = self.rowcache.get( *ck )
+            if row != NoArg :
+                return 1, [row,]
+        
+        version = self.rowcache.version() if ck != None else None
+        
         tbls = self._splitter_ex(cond, 'select') # todo : set to all tablets if cond is none
         
         tlimit = limit
@@ -1364,8 +4160,12 @@ class Table ( object ) :
                 toffset = self._encoderow(toffset)
                 toffset = self._splitter_ex(toffset, 'select')
                 
-                toffset = [ i for o in toffset for i, t in enumerate(tbls)
-                                    if o[0] == t[0] and o[2] == t[2] ]
+                pos = {}
+                for i, t in enumerate(tbls) :
+                    pos.setdefault( ( t[0], t[2] ), [] ).append( i )
+                
+                toffset = sum( [ pos.get( ( o[0], o[2] ), [] )
+                                 for o in toffset ], [] )
                 
                 if len(toffset) != 1 :
                     raise PrimaryKeyError, 'can\'t find the offset subtable'
@@ -1384,6 +4184,14 @@ class Table ( object ) :
         
         ocalc = ('SQL_CALC_FOUND_ROWS' in opts )
         
+        if self.querypool != None and len(tbls) > 1 :
+            
+            nx, rst = self._read_fanout( tbls, cond, condx, cols, limit,
+                                         offset, group, order, opts, pres,
+                                         columnar )
+            
+            tbls = []
+        
         for tbl, mrcnd, _id in tbls : # read lazy
             
             if offset != None and not tbl is tbls[-1]:
@@ -1391,39 +4199,77 @@ class Table ( object ) :
             else :
                 xopts = opts
             
-            if mrcnd != None and mrcnd != [] :
-                condx += mrcnd
-            
-            for excpt in ([ConnectionError]*(self.retrytimes-1)+[None,]) :
-                try :
-                    n, r, f, v = \
-                        self._gettablets(tbl)._select( 
-                                                self.connpool,
-                                                cond, condx, cols, tlimit,
-                                                offset, group, order, 
-                                                xopts, pres, # pres = uvars
-                                              )
-                except excpt as e :
-                    continue
-                
-                break
+            n, r, f, v = self._tabletselect( tbl,
+                                             cond, condx + ( mrcnd or [] ),
+                                             cols, tlimit, offset,
+                                             group, order,
+                                             xopts, pres, # pres = uvars
+                                             columnar,
+                                           )
             
             if offset != None :
                 offset = offset - f
                 offset = None if offset <= 0 else offset
             
             nx += n
-            rst = rst + r
+            rst.extend( r )
             tlimit = ( tlimit - n ) if tlimit != None else tlimit
             if tlimit != None and tlimit <= 0 :
                 break
             
         
-        rst = [ self._decoderow(r) for r in rst ]
+        if columnar :
+            return nx, self._decodecolumns( self._resultcols( cols ), rst )
+        
+        rst = self._decoderows( rst )
+        
+        if ck != None and len(rst) == 1 :
+            self.rowcache.put( ck[0], ck[1], rst[0], version )
         
         return nx, rst
     
-    def _read_low( self, sql, cols, decoder, tbl ):
+    def _tabletselect( self, tbl, *args ):
+        
+        for excpt in ([ConnectionError]*(self.retrytimes-1)+[None,]) :
+            try :
+                r = self._tabletcall( tbl, False, '_select', self.connpool,
+                                      *args )
+            except excpt as e :
+                continue
+            
+            break
+        
+        return r
+    
+    def _read_fanout( self, tbls, cond, condx, cols, limit, offset,
+                            group, order, opts, pres, columnar=False ):
+        '''
+        query all the tablets at once and merge the results in tablet order,
+        every tablet is asked for offset+limit rows, and the rows of the
+        merged result are sliced by offset and limit.
+        '''
+        
+        offset = offset or 0
+        need = ( limit + offset ) if limit != None else None
+        
+        got = [0]
+        
+        def enough( r ):
+            got[0] += r[0]
+            return need != None and got[0] >= need
+        
+        rsts = self.querypool.map( self._tabletselect,
+                                   [ ( tbl, cond, condx + ( mrcnd or [] ),
+                                       cols, need, None, group, order,
+                                       opts, pres, columnar )
+                                     for tbl, mrcnd, _id in tbls ],
+                                   enough )
+        
+        rst = [ row for n, r, f, v in rsts for row in r ][offset:need]
+        
+        return len(rst), rst
+    
+    def _read_low( self, sql, cols, decoder, tbl, columnar=False ):
             
         for excpt in ([ConnectionError]*(self.retrytimes-1)+[None,]) :
             
@@ -1434,6 +4280,12 @@ class Table ( object ) :
             
             break
         
+        if columnar :
+            rst = Rows( cols, [ tuple( x for f, s, e in decoder
+                                         for x in f(*r[s:e]) )
+                                for r in rst ] )
+            return n, rst
+        
         rst = [ dict( zip( cols, ( x for f, s, e in decoder for x in f(*r[s:e]) ) ) )
                 for r in rst
               ]
@@ -1469,20 +4321,23 @@ class Table ( object ) :
         
         tlimit = limit
         nx = 0
-        for tbl in tbls :
-            for excpt in ([ConnectionError]*(self.retrytimes-1)+[None,]) :
-                try :
-                    n, r = self._gettablets(tbl)._update( self.connpool,
-                                                  row, cond, condx, tlimit )
-                except excpt as e :
-                    continue
-                
-                break
-            nx += n
-            tlimit = ( tlimit - n ) if tlimit != None else tlimit
-            if tlimit <= 0 :
-                break
-
+        try :
+            for tbl in tbls :
+                for excpt in ([ConnectionError]*(self.retrytimes-1)+[None,]) :
+                    try :
+                        n, r = self._tabletcall( tbl, True, '_update',
+                                                 self.connpool,
+                                                 row, cond, condx, tlimit )
+                    except excpt as e :
+                        continue
+                    
+                    break
+                nx += n
+                tlimit = ( tlimit - n ) if tlimit != None else tlimit
+                if tlimit <= 0 :
+                    break
+        finally :
+            self._uncachecond( cond, condx, row )
         
         return nx, None
     
@@ -1496,19 +4351,23 @@ class Table ( object ) :
         
         tlimit = limit
         nx = 0
-        for tbl in tbls : # read lazy
-            for excpt in ([ConnectionError]*(self.retrytimes-1)+[None,]) :
-                try :
-                    n, r = self._gettablets(tbl)._delete( self.connpool,
-                                                  cond, condx, tlimit )
-                except excpt as e :
-                    continue
-                
-                break
-            nx += n
-            tlimit = ( tlimit - n ) if tlimit != None else tlimit
-            if tlimit <= 0 :
-                break
+        try :
+            for tbl in tbls : # read lazy
+                for excpt in ([ConnectionError]*(self.retrytimes-1)+[None,]) :
+                    try :
+                        n, r = self._tabletcall( tbl, True, '_delete',
+                                                 self.connpool,
+                                                 cond, condx, tlimit )
+                    except excpt as e :
+                        continue
+                    
+                    break
+                nx += n
+                tlimit = ( tlimit - n ) if tlimit != None else tlimit
+                if tlimit <= 0 :
+                    break
+        finally :
+            self._uncachecond( cond, condx )
         
         return nx, None
         
@@ -1596,29 +4455,422 @@ class Table ( object ) :
         
         return rst[0]
     
+    def get_many( self, conds, default=NoArg, keys=[], chunk=1000 ):
+        '''
+        table.get_many( [{'ID':1},{'ID':2}], default=None, keys=[] )
+        
+        return the rows in the order of conds, the missing ones are default.
+        the cached rows are fetched at once by the rowcache, the others
+        are read by `ID` IN (...) of chunk keys a tablet, at once if the
+        table has a querypool.
+        '''
+        
+        rst = [NoArg] * len(conds)
+        
+        if self.rowcache != None :
+            
+            cols = tuple( [ _tplcolkey(c) for c in keys ] ) if keys else None
+            
+            ks = [ self.rowcache.key( self._encoderow(c) ) for c in conds ]
+            hits = self.rowcache.get_multi( [ k for k in ks if k != None ],
+                                            cols )
+            
+            rst = [ hits.get( k, NoArg ) for k in ks ]
+        
+        miss = [ i for i, r in enumerate( rst ) if r == NoArg ]
+        
+        for i, r in zip( miss, self._getmany( [ conds[i] for i in miss ],
+                                              keys, chunk ) ) :
+            
+            if r != NoArg :
+                rst[i] = r
+            elif default != NoArg :
+                rst[i] = default
+            else :
+                raise NotFoundError, ( 'not found', conds[i] )
+        
+        return rst
+    
+    _keyof = staticmethod( _keyvalue )
+    
+    @staticmethod
+    def _foldkey( kv ):
+        
+        # case-insensitive collations match 'ABC' to 'abc ' ,
+        # tried when there is no row of the exact value and table.casefold
+        return tuple( [ k.decode('utf-8','replace').lower().rstrip(' ')
+                        for k in kv ] )
+    
+    def _getmany( self, conds, keys, chunk ):
+        '''
+        read the first row of each condition, or NoArg.
+        
+        the conditions of the same columns are grouped by tablet and read
+        by `a` IN (...) or (`a`,`b`) IN ((...),...) , the rows are matched
+        back by the values of the columns.
+        '''
+        
+        encs = [ dict(sum([ c.items() for c in cond ], []))
+                 if type( cond ) in ArrayTypes else cond
+                 for cond in conds ]
+        encs = [ self._encoderow(c) for c in encs ]
+        
+        rst = [NoArg] * len(conds)
+        
+        byset = {}
+        for i, c in enumerate( encs ) :
+            if c and not any( [ isinstance( v, Raw ) for v in c.values() ] ) :
+                byset.setdefault( tuple( sorted( c.keys() ) ), [] ).append( i )
+            else :
+                n, r = self._read( conds[i], [], cols=keys, limit=1,
+                                   cached=False )
+                rst[i] = r[0] if n == 1 else NoArg
+        
+        version = self.rowcache.version() if self.rowcache != None else None
+        
+        for kcols, idxs in byset.items() :
+            
+            # the key columns are selected to match the rows back,
+            # even the ones out of defaultcols
+            cols = list( keys ) if keys else \
+                   list( self.tablets[0].defaultcols if self.tablets else [] )
+            dropcols = [ k for k in kcols if k not in cols ]
+            cols += dropcols
+            
+            rows = self._getmanyby( kcols, [ encs[i] for i in idxs ],
+                                    cols, chunk )
+            
+            got = [ ( i, r ) for i, r in zip( idxs, rows ) if r != NoArg ]
+            
+            rows = self._decoderows( [ dict(r) for i, r in got ] )
+            
+            for ( i, r ), row in zip( got, rows ) :
+                
+                for k in dropcols :
+                    row.pop( k, None )
+                
+                rst[i] = row
+                
+                ck = self._cachekey( encs[i], [], keys, 1, None,
+                                     None, None, [], [] )
+                if ck != None :
+                    self.rowcache.put( ck[0], ck[1], row, version )
+        
+        return rst
+    
+    def _getmanyby( self, kcols, encs, cols, chunk ):
+        
+        keyof = self._keyof
+        
+        if self.router != None :
+            routes = [ [ ( tbls[0], None, None ) ]
+                       for tbls in self._splittermany( encs, 'select' ) ]
+        else :
+            routes = [ self._splitter_ex( c, 'select' ) for c in encs ]
+        
+        # ( tablets, more conditions ) -> [ key values ]
+        groups = {}
+        gks = []
+        kvs = []
+        
+        for c, route in zip( encs, routes ) :
+            
+            kv = tuple( [ keyof( c[k] ) for k in kcols ] )
+            kvs.append( kv )
+            
+            gks.append( [] )
+            
+            for tbl, mrcnd, _id in route :
+                
+                gk = ( tbl, tuple( [ sqlstr(x) for x in mrcnd or [] ] ) )
+                gks[-1].append( gk )
+                
+                if gk not in groups :
+                    groups[gk] = ( mrcnd or [], collections.OrderedDict() )
+                
+                groups[gk][1][kv] = tuple( [ c[k] for k in kcols ] )
+        
+        jobs = []
+        jobgks = []
+        
+        for gk, ( mrcnd, vals ) in groups.items() :
+            
+            vals = vals.values()
+            
+            for s in range( 0, len(vals), chunk ) :
+                
+                part = vals[s:s+chunk]
+                
+                if len(kcols) == 1 :
+                    incond = '`%s` IN (%s)' % ( kcols[0],
+                               ','.join( [ sqlstr(v[0]) for v in part ] ) )
+                else :
+                    incond = '(%s) IN (%s)' % (
+                               ','.join( [ '`%s`' % k for k in kcols ] ),
+                               ','.join( [ '(' + ','.join( map( sqlstr, v ) ) + ')'
+                                           for v in part ] ) )
+                
+                jobs.append( ( gk[0], None, mrcnd + [ Condition( incond ) ],
+                               cols, None, None, None, None, [], [] ) )
+                jobgks.append( gk )
+        
+        if self.querypool != None and len(jobs) > 1 :
+            rsts = self.querypool.map( self._tabletselect, jobs )
+        else :
+            rsts = [ self._tabletselect( *job ) for job in jobs ]
+        
+        found = {}
+        folded = {}
+        
+        for gk, ( n, r, f, v ) in zip( jobgks, rsts ) :
+            for row in r :
+                kv = tuple( [ keyof( row[k] ) for k in kcols ] )
+                found.setdefault( ( gk, kv ), row )
+                if self.casefold :
+                    folded.setdefault( ( gk, self._foldkey( kv ) ), row )
+        
+        rst = []
+        
+        for kv, route in zip( kvs, gks ) :
+            
+            rows = [ found[ ( gk, kv ) ] for gk in route
+                     if ( gk, kv ) in found ]
+            
+            if not rows and self.casefold :
+                fkv = self._foldkey( kv )
+                rows = [ folded[ ( gk, fkv ) ] for gk in route
+                         if ( gk, fkv ) in folded ]
+            
+            rst.append( rows[0] if rows else NoArg )
+        
+        return rst
+    
     def __rshift__ ( self, cond ):
         '''
         a = {'ID':1} ; table >> a
         '''
         
-        n, rst = self._read( cond, limit = 1 )
+        n, rst = self._read( cond, limit = 1 )
+        
+        if n != 1 :
+            raise NotFoundError, 'not found'
+        
+        cond.update(rst[0])
+        
+        return rst[0]
+        
+    def gets( self, cond, keys=[], limit=None, offset=None, columnar=False ):
+        '''
+        table.gets( {'a':1}, keys=[], limit=n, offset = p )
+        
+        return Rows instead of a list of dicts when columnar
+        '''
+        
+        n, rst = self._read( cond, [], cols=keys, limit=limit, offset=offset,
+                             columnar=columnar )
+        
+        return rst
+
+    def iter( self, cond, keys=[], limit=None, offset=None, batch=1000 ):
+        '''
+        for row in table.iter( {'a':1}, keys=[], limit=n, offset=p, batch=m ):
+        
+        the rows are fetched m by m from the tablets one by one,
+        the first p rows are fetched and skipped.
+        '''
+        
+        if type( cond ) in ArrayTypes :
+            cond = dict(sum([ c.items() for c in cond ], []))
+        
+        cond = self._encoderow(cond) if cond else cond
+        tbls = self._splitter_ex(cond, 'select')
+        
+        skip = offset or 0
+        tlimit = ( limit + skip ) if limit != None else None
+        
+        for tbl, mrcnd, _id in tbls :
+            
+            if tlimit != None and tlimit <= 0 :
+                break
+            
+            def first( t ) :
+                rows = t._iterselect( self.connpool, cond, mrcnd or [],
+                                      keys, tlimit, batch )
+                return rows, next( rows, [] )
+            
+            for excpt in ([ConnectionError]*(self.retrytimes-1)+[None,]) :
+                
+                # the balancer is told of the first batch
+                try :
+                    rows, r = self._tabletcall( tbl, False, first )
+                except excpt as e :
+                    continue
+                
+                break
+            
+            try :
+                while r != [] :
+                    
+                    tlimit = ( tlimit - len(r) ) if tlimit != None else tlimit
+                    
+                    if skip >= len(r) :
+                        skip -= len(r)
+                    else :
+                        for row in self._decoderows( r[skip:] ) :
+                            yield row
+                        skip = 0
+                    
+                    r = next( rows, [] )
+            finally :
+                rows.close()
+        
+        return
+    
+    @staticmethod
+    def _pagecheck( cond, order, tbls ):
+        
+        return hashlib.md5( repr( (
+                   sorted( [ ( k, sqlstr(v) ) for k, v in cond.items() ] )
+                       if cond else None,
+                   order,
+                   [ tbl[0].name for tbl, mrcnd, _id in tbls ],
+               ) ) ).hexdigest()[:8]
+    
+    @staticmethod
+    def _pagetoken( check, pos, last ):
+        
+        if last == NoArg :
+            return base64.urlsafe_b64encode( json.dumps( [ check, pos, None ] ) )
+        
+        vs = []
+        
+        for v in last :
+            if type(v) == types.StringType :
+                vs.append( [ 'x', binascii.hexlify(v) ] )
+            elif type(v) in ( types.UnicodeType, types.IntType,
+                              types.LongType, types.FloatType ) :
+                vs.append( [ 'v', v ] )
+            else :
+                vs.append( [ 's', str(v) ] )
+        
+        return base64.urlsafe_b64encode( json.dumps( [ check, pos, vs ] ) )
+    
+    @staticmethod
+    def _pageuntoken( check, token ):
+        
+        try :
+            c, pos, vs = json.loads( base64.urlsafe_b64decode( str(token) ) )
+            
+            last = NoArg if vs == None else []
+            
+            for t, v in vs or [] :
+                if t == 'x' :
+                    v = binascii.unhexlify( v )
+                elif t == 's' :
+                    v = v.encode( 'utf-8' )
+                last.append( v )
+        except Exception, e :
+            raise TypeError, ( 'bad page token', token )
+        
+        if c != check :
+            raise TypeError, ( 'page token of another query', token )
+        
+        return pos, last
+    
+    @staticmethod
+    def _pageafter( cols, last, desc ):
+        '''
+        condition of the rows after the values last of cols in the order,
+        ( `a`>1 ) OR ( `a`=1 AND `b`>2 ) ...
+        '''
+        
+        op = '<' if desc else '>'
+        
+        ors = []
+        
+        for i, c in enumerate( cols ) :
+            ands = [ '`%s`=%s' % ( e, sqlstr(v) )
+                     for e, v in zip( cols[:i], last[:i] ) ]
+            ands.append( '`%s`%s%s' % ( c, op, sqlstr(last[i]) ) )
+            ors.append( '(' + ' AND '.join( ands ) + ')' )
+        
+        return Condition( '(' + ' OR '.join( ors ) + ')' )
+    
+    def page( self, cond, key, limit, token=None, keys=[] ):
+        '''
+        rows, token = table.page( {'a':1}, 'ID', 100 )
+        rows, token = table.page( {'a':1}, 'ID', 100, token )
+        
+        keyset pagination, the rows are ordered by key ( '~ID' is descending )
+        in each tablet and the tablets are read one by one. the token keeps
+        the tablet and the last key, the next page is read from there by
+        `ID` > last key. the token is None after the last page.
+        
+        the primary key columns of the tablet break the ties of the key in
+        the order and the token, a key which is not unique skips no rows.
+        '''
+        
+        if type( cond ) in ArrayTypes :
+            cond = dict(sum([ c.items() for c in cond ], []))
+        
+        cond = self._encoderow(cond) if cond else cond
+        tbls = self._splitter_ex( cond, 'select' )
+        
+        desc = key.startswith('~')
+        col = key[1:] if desc else key
+        
+        ordercols = [ col ]
+        if tbls :
+            ordercols += [ k for k in tbls[0][0][0].keys if k != col ]
+        
+        order = [ ( '~' + c ) if desc else c for c in ordercols ]
         
-        if n != 1 :
-            raise NotFoundError, 'not found'
+        cols = list( keys ) if keys else None
+        dropcols = [ c for c in ordercols if c not in cols ] \
+                       if cols != None else []
+        if cols != None :
+            cols.extend( dropcols )
         
-        cond.update(rst[0])
+        check = self._pagecheck( cond, order, tbls )
         
-        return rst[0]
+        if token != None :
+            pos, last = self._pageuntoken( check, token )
+        else :
+            pos, last = 0, NoArg
         
-    def gets( self, cond, keys=[], limit=None, offset=None):
-        '''
-        table.gets( {'a':1}, keys=[], limit=n, offset = p )
-        '''
+        rst = []
+        
+        while pos < len(tbls) and len(rst) < limit :
+            
+            tbl, mrcnd, _id = tbls[pos]
+            
+            condx = mrcnd or []
+            if last != NoArg :
+                condx = condx + [ self._pageafter( ordercols, last, desc ) ]
+            
+            need = limit - len(rst)
+            
+            n, r, f, v = self._tabletselect( tbl, cond, condx, cols, need,
+                                             None, None, order, [], [] )
+            
+            rst.extend( r )
+            
+            if n < need :
+                pos, last = pos + 1, NoArg
+            else :
+                last = [ r[-1][c] for c in ordercols ]
         
-        n, rst = self._read( cond, [], cols=keys, limit=limit, offset=offset )
+        token = self._pagetoken( check, pos, last ) \
+                    if pos < len(tbls) else None
         
-        return rst
-
+        rst = self._decoderows( rst )
+        
+        for row in rst :
+            for c in dropcols :
+                row.pop( c, None )
+        
+        return rst, token
+    
     def __getitem__( self, slc ):
         '''
         table[{'ID':1}]
@@ -1760,182 +5012,814 @@ class Table ( object ) :
         
         n, x = self._delete( cond, condx, limit )
         
-        if single == True and n == 0 :
-            raise NotFoundError, 'not found'
+        if single == True and n == 0 :
+            raise NotFoundError, 'not found'
+        
+        return
+    
+    def __contains__( self, name ):
+        '''
+        {} in table
+        '''
+        
+        return
+    
+    def __invert__( self, obj ):
+        '''
+        (~table)[...]
+        SQL(table)[...]
+        table.sql[]
+        '''
+        
+        return
+    
+    def __add__( self, other ):
+        
+        t = Table( self.tablets + other.tablets, self.name, self.connpool )
+        t.querypool = self.querypool
+        t.chunkrows = self.chunkrows
+        t.chunkbytes = self.chunkbytes
+        t.casefold = self.casefold
+        t.balancer = self.balancer
+        
+        return t
+        
+    def __len__( self ):
+        
+        return len(tablets)
+        
+    @staticmethod
+    def sum( table ):
+        
+        return Table( sum([ t.tablets for t in table ],[]), self.name )
+    
+    
+    @staticmethod
+    def _asquery_allcolssql( cols ):
+        
+        return ','.join([ '%s' % ( ('`'+str(c)+'`') \
+                            if type(c) != SQLExprType else \
+                            sqlstr(c), \
+                          ) for c in cols ])
+    
+    def _fastconv( self, cols ):
+        
+        cc = [ ( enkey, dekey, decoder )
+               for enkey, dekey, encoder, decoder in self.colconv
+               if set(dekey) <= set(cols)
+             ]
+        
+        dekeys = [ k for enkey, dekey, decoder in cc for k in dekey ]
+        
+        if len( set(dekeys) ) != len( dekeys ) :
+            raise Exception, 'asquery using fastconv error'
+            
+        oldcols = [ list(dekey) for enkey, dekey, decoder in cc ]
+        nclens = [ len(dekey) for dekey in oldcols ]
+        oldcols = sum( oldcols, [] )
+        pkey = [ key for key in cols if key not in oldcols ]
+        newcols = [ list(enkey) for enkey, dekey, decoder in cc ]
+        newcols = sum( newcols, [] )
+        decoders = [ decoder for enkey, dekey, decoder in cc ]
+        
+        if len(pkey) != 0 :
+            newcols += pkey
+            oldcols += pkey
+            nclens += [len(pkey)]
+            decoders += [ lambda *x : x ]
+        
+        nclens = reduce( lambda x, y : x+[x[-1]+y], nclens, [0] )
+        nclens = zip( nclens[:-1], nclens[1:] )
+        
+        decoders = [ ( decoder, s, e ) 
+                     for (s, e), decoder in zip( nclens, decoders ) ]
+        
+        return tuple(newcols), tuple(oldcols), tuple(decoders)
+    
+    def asquery( self, sql, cols=None, multi=False, columnar=False ):
+        """
+        e.g.: select %(<cols>)s from %(<tablename>)s where `colC` = HEX( %(datakey)s )
+        
+        return CompiledQuery, the query returns Record ( Rows when multi )
+        if columnar
+        """
+        
+        return CompiledQuery( self, sql, cols, multi, columnar )
+    
+    def asexplain( self, sql ):
+        
+        def query( stunt = {} ):
+            
+            tbl = self._gettablets( self._splitter_ex( stunt, 'explain' )[0][0] )
+            
+            n, r = self._explain_low( p.raw, tbl )
+            
+            return r
+        
+        query.sqls = [sql]
+        
+        return query
+
+
+class CompiledQuery( object ):
+    '''
+    sql of Table.asquery compiled for each tablet
+    
+    query = table.asquery( 'SELECT %(<cols>)s FROM %(<tablename>)s '
+                           'WHERE `a`=%(a)s AND `b` IN %(bs)s' )
+    
+    query( [ 1, [ 2, 3 ] ], stunt={} )       # the first row found
+    query( { 'a' : 1, 'bs' : [ 2, 3 ] } )
+    query.many( [ [ 1, [2] ], [ 4, [5] ] ] ) # one sql a tablet for the lot
+    
+    the values have no length limit, a list or tuple is sent as ( a, b, .. )
+    the datas are the values in the order of the parameters, or a dict.
+    stunt is the row given to the splitter to find the tablets.
+    with multi, the rows of all the tablets are returned, and read at once
+    if the table has a querypool.
+    '''
+    
+    # rows of a tablet sent in one sql by many()
+    chunk = 100
+    
+    _param = re.compile( r'%%|%\(([^)]*)\)[-#0 +]*\d*(?:\.\d+)?s' )
+    
+    def __init__( self, table, sql, cols=None, multi=False, columnar=False ):
+        
+        self.table = table
+        self.sql = sql
+        self.cols = cols
+        self.multi = multi
+        self.columnar = columnar
+        
+        self.params = [ m.group(1) for m in self._param.finditer( sql )
+                        if m.group(1) != None and not m.group(1).startswith('<') ]
+        
+        # tablet name -> the compiled sqls, see _tabletsqls
+        self.sqls = {}
+        
+        for t in table.tablets :
+            self._tabletsqls( t )
+        
+        # the tablets of the values of the route key, dropped when the
+        # tablets or the router change
+        self._routes = {}
+        self._routesstate = None
+        
+        return
+    
+    def _tabletsqls( self, t ):
+        '''
+        return the compiled sqls of the tablet t, the tablets added to the
+        table after asquery are compiled at their first query
+        '''
+        
+        try :
+            return self.sqls[t.name]
+        except KeyError, e :
+            pass
+        
+        newcols, oldcols, decoders = self.table._fastconv( self.cols or t.defaultcols )
+        
+        allcols = self.table._asquery_allcolssql( oldcols )
+        
+        lits, slots = self._compile( t.name, allcols, False )
+        
+        if '%(<cols>)' in self.sql :
+            tlits, tslots = self._compile( t.name, allcols, True )
+        else :
+            tlits, tslots = None, None
+        
+        tdecoders = ( ( ( lambda n : ( n, ) ), 0, 1 ), ) + \
+                    tuple( [ ( d, s+1, e+1 ) for d, s, e in decoders ] )
+        
+        r = ( newcols, decoders, lits, slots,
+              ( '_n', ) + newcols, tdecoders, tlits, tslots )
+        
+        self.sqls[t.name] = r
+        
+        return r
+    
+    def _compile( self, name, allcols, tagged ):
+        '''
+        return the literal pieces of the sql and what goes between them,
+        the index of the value, or None for the tag of the row of many()
+        '''
+        
+        lits = []
+        slots = []
+        
+        k = 0
+        last = 0
+        lit = ''
+        
+        for m in self._param.finditer( self.sql ) :
+            
+            lit += self.sql[last:m.start()]
+            last = m.end()
+            
+            p = m.group(1)
+            
+            if p == None :
+                lit += '%'
+            elif p == '<tablename>' :
+                lit += '`' + name + '`'
+            elif p == '<cols>' and tagged :
+                lits.append( lit )
+                slots.append( None )
+                lit = ' AS `_n`,' + allcols
+            elif p == '<cols>' :
+                lit += allcols
+            elif p.startswith('<') :
+                pass
+            else :
+                lits.append( lit )
+                slots.append( k )
+                lit = ''
+                k += 1
+        
+        lits.append( lit + self.sql[last:] )
+        
+        return lits, slots
+    
+    @staticmethod
+    def _fill( lits, slots, vals, tag=None ):
+        
+        r = [ lits[0] ]
+        
+        for slot, lit in zip( slots, lits[1:] ) :
+            r.append( vals[slot] if slot != None else str(tag) )
+            r.append( lit )
+        
+        return ''.join( r )
+    
+    @staticmethod
+    def _qstr( v ):
+        
+        if type(v) in ArrayTypes :
+            return '(' + ','.join( [ sqlstr(x) for x in v ] ) + ')'
+        
+        return sqlstr(v)
+    
+    def _escape( self, datas ):
+        
+        if type(datas) == types.DictType :
+            datas = [ datas[p] for p in self.params ]
+        
+        if len(datas) != len(self.params) :
+            raise TypeError, ( 'query wants %d values' % len(self.params), datas )
+        
+        return [ self._qstr(d) for d in datas ]
+    
+    def _tablets( self, stunt ):
+        '''
+        the tablets of the stunt, the routes of the router are memoized.
+        splitter_ex is called every time, it may not be pure.
+        '''
+        
+        table = self.table
+        router = table.router
+        
+        if router == None :
+            return [ tbl for tbl, mrcnd, _id in table._splitter_ex( stunt, 'select' ) ]
+        
+        # HashRing and RangeTable replace _ring and _table on change
+        state = ( table.hashtablets, router, table.routekey,
+                  getattr( router, '_ring', None ), getattr( router, '_table', None ) )
+        
+        if self._routesstate == None or \
+           any( [ a is not b for a, b in zip( state, self._routesstate ) ] ) :
+            self._routes = {}
+            self._routesstate = state
+        
+        k = stunt.get( table.routekey, NoArg ) if stunt else NoArg
+        
+        try :
+            return self._routes[k]
+        except ( KeyError, TypeError ), e :
+            pass
+        
+        tbls = [ tbl for tbl, mrcnd, _id in table._splitter_ex( stunt, 'select' ) ]
+        
+        try :
+            if len( self._routes ) < 4096 and not isinstance( k, Raw ) :
+                self._routes[k] = tbls
+        except TypeError, e :
+            pass
+        
+        return tbls
+    
+    def _readtablet( self, tbl, sql, tagged ):
+        
+        cols, dec, lits, slots, tcols, tdec, tlits, tslots = self._tabletsqls( tbl[0] )
+        
+        if tagged :
+            cols, dec = tcols, tdec
+        
+        read = lambda t : self.table._read_low( sql, cols, dec, t,
+                                                self.columnar or tagged )
+        
+        return self.table._tabletcall( tbl, False, read )[1]
+    
+    def _gather( self, jobs, tagged=False ):
+        '''
+        run [ ( tbl, sql ), ... ], at once if the table has a querypool
+        '''
+        
+        querypool = self.table.querypool
+        
+        if querypool != None and len(jobs) > 1 :
+            return querypool.map( self._readtablet,
+                                  [ ( tbl, sql, tagged ) for tbl, sql in jobs ] )
+        
+        return [ self._readtablet( tbl, sql, tagged ) for tbl, sql in jobs ]
+    
+    def __call__( self, datas, stunt={} ):
+        
+        vals = self._escape( datas )
+        tbls = self._tablets( stunt )
+        
+        jobs = [ ( tbl, self._fill( self._tabletsqls( tbl[0] )[2],
+                                    self._tabletsqls( tbl[0] )[3], vals ) )
+                 for tbl in tbls ]
+        
+        if self.multi :
+            
+            _r = Rows( self._tabletsqls( tbls[0][0] )[0] if tbls else () ) \
+                     if self.columnar else []
+            
+            for r in self._gather( jobs ) :
+                _r.extend(r)
+            
+            return _r
+        
+        for tbl, sql in jobs :
+            
+            r = self._readtablet( tbl, sql, False )
+            
+            if len(r) >= 1 :
+                return r[0]
+        
+        raise NotFoundError, 'not found'
+    
+    def many( self, datalist, stunts=None, default=NoArg ):
+        '''
+        run the query for each datas of datalist, the sqls of a tablet are
+        sent chunk by chunk as one sql of UNION ALL. the sql must select
+        %(<cols>)s .
+        
+        stunts is a stunt for all the datas, or a list of stunts.
+        
+        return the results in the order of datalist, the first row found
+        ( or default ) of each, or the list ( Rows ) of the rows of each if
+        multi.
+        '''
+        
+        if datalist == [] :
+            return []
+        
+        if type(stunts) in ArrayTypes :
+            routes = [ self._tablets( s ) for s in stunts ]
+        else :
+            routes = [ self._tablets( stunts ) ] * len(datalist)
+        
+        groups = {}
+        names = []
+        
+        for i, ( datas, tbls ) in enumerate( zip( datalist, routes ) ) :
+            
+            vals = self._escape( datas )
+            
+            for tbl in tbls :
+                
+                name = tbl[0].name
+                tsqls = self._tabletsqls( tbl[0] )
+                
+                if tsqls[6] == None :
+                    raise TypeError, 'many() needs %(<cols>)s in the sql'
+                
+                if name not in groups :
+                    groups[name] = ( tbl, [] )
+                    names.append( name )
+                
+                groups[name][1].append( self._fill( tsqls[6], tsqls[7],
+                                                    vals, i ) )
+        
+        jobs = []
+        
+        for name in names :
+            
+            tbl, sqls = groups[name]
+            
+            for s in range( 0, len(sqls), self.chunk ) :
+                
+                part = sqls[s:s+self.chunk]
+                
+                sql = part[0] if len(part) == 1 else \
+                      ' UNION ALL '.join( [ '(' + x + ')' for x in part ] )
+                
+                jobs.append( ( tbl, sql ) )
+        
+        found = {}
+        
+        for ( tbl, sql ), r in zip( jobs, self._gather( jobs, True ) ) :
+            for vals in r.rows :
+                found.setdefault( ( vals[0], tbl[0].name ), [] ).append( vals[1:] )
+        
+        rst = []
+        
+        for i, tbls in enumerate( routes ) :
+            
+            cols = self._tabletsqls( tbls[0][0] )[0] if tbls else ()
+            
+            vals = [ v for tbl in tbls for v in found.get( ( i, tbl[0].name ), [] ) ]
+            
+            if self.multi and self.columnar :
+                rst.append( Rows( cols, vals ) )
+            elif self.multi :
+                rst.append( [ dict( zip( cols, v ) ) for v in vals ] )
+            elif vals != [] and self.columnar :
+                rst.append( Rows( cols, vals[:1] )[0] )
+            elif vals != [] :
+                rst.append( dict( zip( cols, vals[0] ) ) )
+            elif default != NoArg :
+                rst.append( default )
+            else :
+                raise NotFoundError, ( 'not found', datalist[i] )
+        
+        return rst
+
+
+class BufferedWriter( object ):
+    '''
+    write-behind buffer of a table for appending rows at a high rate
+    
+    w = BufferedWriter( table, maxrows=1000, maxdelay=1.0, maxpending=100000,
+                        onerror=lambda exc_info, rows : ... )
+    w.append( row )
+    w.extend( rows )
+    w.flush()         # write the buffered rows and wait for it
+    w.close()         # flush and stop, also at the end of with
+    
+    the rows are encoded and routed to the tablets by a thread, a tablet
+    is written by multi-row inserts when it has maxrows rows, or its oldest
+    row has waited maxdelay seconds. append waits when maxpending rows are
+    not written yet, and raises TimeoutError after timeout seconds.
+    
+    onerror( exc_info, rows ) is called in the thread with the rows failed
+    to write, the rows are dropped. without onerror they are logged.
+    '''
+    
+    def __init__( self, table, maxrows=1000, maxdelay=1.0, maxpending=100000,
+                        ondup=None, onerror=None, timeout=None ):
+        
+        self.table = table
+        self.maxrows = maxrows
+        self.maxdelay = maxdelay
+        self.maxpending = maxpending
+        self.ondup = ondup
+        self.onerror = onerror
+        self.timeout = timeout
+        
+        self.cond = threading.Condition()
+        
+        self.incoming = []
+        self.pending = 0
+        self.closed = False
+        
+        # flush() asks for flushreq, the thread has done flushed
+        self.flushreq = 0
+        self.flushed = 0
+        
+        # tablets -> ( time of the first row, rows ), only used by the thread
+        self.buffers = {}
+        
+        self.stats = { 'appended' : 0, 'written' : 0, 'failed' : 0,
+                       'inserts' : 0, 'waits' : 0 }
+        
+        self.thread = threading.Thread( target=self.run )
+        self.thread.setDaemon(True)
+        self.thread.start()
         
         return
     
-    def __contains__( self, name ):
-        '''
-        {} in table
-        '''
+    def append( self, row ):
         
-        return
+        return self.extend( [row,] )
     
-    def __invert__( self, obj ):
-        '''
-        (~table)[...]
-        SQL(table)[...]
-        table.sql[]
-        '''
+    def extend( self, rows ):
+        
+        self.cond.acquire()
+        try :
+            if self.closed :
+                raise EasySqlException, 'writer closed'
+            
+            if self.pending >= self.maxpending :
+                
+                self.stats['waits'] += 1
+                deadline = ( time.time() + self.timeout ) \
+                                if self.timeout != None else None
+                
+                while self.pending >= self.maxpending and not self.closed :
+                    if deadline == None :
+                        self.cond.wait()
+                        continue
+                    left = deadline - time.time()
+                    if left <= 0 :
+                        raise TimeoutError, 'writer full'
+                    self.cond.wait( left )
+                
+                # closed while waiting, the thread may have stopped already
+                if self.closed :
+                    raise EasySqlException, 'writer closed'
+            
+            if self.incoming == [] or \
+               len(self.incoming) // self.maxrows != \
+               ( len(self.incoming) + len(rows) ) // self.maxrows :
+                self.cond.notifyAll()
+            
+            self.incoming.extend( rows )
+            self.pending += len(rows)
+            self.stats['appended'] += len(rows)
+        finally :
+            self.cond.release()
         
         return
     
-    def __add__( self, other ):
+    def flush( self ):
         
-        return Table( self.tablets + other.tablets, self.name )
+        self.cond.acquire()
+        try :
+            self.flushreq += 1
+            req = self.flushreq
+            self.cond.notifyAll()
+            
+            while self.flushed < req and self.thread.isAlive() :
+                self.cond.wait( 1 )
+        finally :
+            self.cond.release()
         
-    def __len__( self ):
+        return
+    
+    def close( self ):
         
-        return len(tablets)
+        self.cond.acquire()
+        try :
+            self.closed = True
+            self.cond.notifyAll()
+        finally :
+            self.cond.release()
         
-    @staticmethod
-    def sum( table ):
+        self.thread.join()
         
-        return Table( sum([ t.tablets for t in table ],[]), self.name )
-    
+        return
     
-    @staticmethod
-    def _asquery_allcolssql( cols ):
+    def __enter__( self ):
         
-        return ','.join([ '%s' % ( ('`'+str(c)+'`') \
-                            if type(c) != SQLExprType else \
-                            sqlstr(c), \
-                          ) for c in cols ])
+        return self
     
-    def _fastconv( self, cols ):
+    def __exit__( self, *exc ):
         
-        cc = [ ( enkey, dekey, decoder )
-               for enkey, dekey, encoder, decoder in self.colconv
-               if set(dekey) <= set(cols)
-             ]
+        self.close()
         
-        multidekey = reduce( ( lambda x, y : x & y ), 
-                          ( set(dekey) for enkey, dekey, decoder in cc ) )
+        return False
+    
+    def getstats( self ):
         
-        if  multidekey != set([]):
-            raise Exception, 'asquery using fastconv error'
-            
-        oldcols = [ list(dekey) for enkey, dekey, decoder in cc ]
-        nclens = [ len(dekey) for dekey in oldcols ]
-        oldcols = sum( oldcols, [] )
-        pkey = [ key for key in cols if key not in oldcols ]
-        newcols = [ list(enkey) for enkey, dekey, decoder in cc ]
-        newcols = sum( newcols, [] )
-        decoders = list(zip(*cc)[2])
+        self.cond.acquire()
+        try :
+            r = dict( self.stats )
+            r['pending'] = self.pending
+        finally :
+            self.cond.release()
         
-        if len(pkey) != 0 :
-            newcols += pkey
-            oldcols += pkey
-            nclens += [len(pkey)]
-            decoders += [ lambda *x : x ]
+        return r
+    
+    def _failed( self, exc_info, rows ):
         
-        nclens = reduce( lambda x, y : x+[x[-1]+y], nclens, [0] )
-        nclens = zip( nclens[:-1], nclens[1:] )
+        if self.onerror == None :
+            logging.error( 'BufferedWriter failed to write %d rows',
+                           len(rows), exc_info = exc_info )
+            return
         
-        decoders = [ ( decoder, s, e ) 
-                     for (s, e), decoder in zip( nclens, decoders ) ]
+        try :
+            self.onerror( exc_info, rows )
+        except :
+            logging.exception( 'BufferedWriter onerror failed' )
         
-        return tuple(newcols), tuple(oldcols), tuple(decoders)
+        return
     
-    def asquery( self, sql, cols=None, multi=False ):
-        """
-        e.g.: select %(<cols>)s from %(<tablename>)s where `colC` = HEX( %(datakey)-32s )
-        """
+    def _route( self, rows ):
         
-        tbls = [ ( t.name, self._fastconv( cols or t.defaultcols ) )  
-                 for t in self.tablets ]
+        try :
+            tblrows = self.table._grouprows( self.table._encoderows( rows ),
+                                             'insert', 'write' )
+        except :
+            if len(rows) == 1 :
+                self._failed( sys.exc_info(), rows )
+                return 1
+            # only drop the rows can not be encoded or routed
+            return sum( [ self._route( [row,] ) for row in rows ] )
         
-        tbls = [ ( n,
-                   newcols,
-                   oldcols,
-                   decoders,
-                   { '<tablename>' : '`'+n+'`',
-                     '<cols>' : self._asquery_allcolssql(oldcols),
-                   },
-                 ) for n, ( newcols, oldcols, decoders ) in tbls ]
+        now = time.time()
         
-        names, newcolses, oldcolses, decoderses, dinps = zip(*tbls)
+        for tbl, trows in tblrows :
+            self.buffers.setdefault( tbl, ( now, [] ) )[1].extend( trows )
         
-        sqlinputs = [ x.split(')')[0].strip('()') for x in sql.split('%') ]
+        return 0
+    
+    def _writetablet( self, tbl, rows ):
         
-        sqls = [ ( sql % dict( ( x, tk.get(x,"") ) for x in sqlinputs ) )
-                 for tk in dinps ]
+        table = self.table
         
-        segs = [ ( sql % dict( ( x, tk.get(x,"%") ) for x in sqlinputs ) )
-                 for tk in dinps ]
-                
-        segs = [ [ len(z) for z in s.split('%') ] for s in segs ]
-        segs = [ reduce( lambda x, y : x+[x[-1]+y], s, [0] )[1:]
-                 for s in segs
-               ]
-               
-        pps = zip( newcolses, decoderses, sqls, segs )
+        try :
+            try :
+                n, lastids = table._bulkwrite( [ ( tbl,
+                                 tbl[0]._insertchunks( rows, self.ondup,
+                                                       table.chunkrows,
+                                                       table.chunkbytes ) ) ] )
+            finally :
+                if self.ondup :
+                    table._uncacherows( rows )
+        except :
+            self._failed( sys.exc_info(), rows )
+            return False
         
-        sqls = dict( zip( names, pps ) )
+        return True
+    
+    def run( self ):
         
-        def query( datas, stunt = {} ):
+        while True :
+            
+            self.cond.acquire()
+            try :
+                while self.incoming == [] and not self.closed and \
+                      self.flushreq == self.flushed :
+                    
+                    if self.buffers == {} :
+                        self.cond.wait()
+                        continue
+                    
+                    left = min( [ t for t, rows in self.buffers.values() ] ) \
+                           + self.maxdelay - time.time()
+                    
+                    if left <= 0 :
+                        break
+                    
+                    self.cond.wait( left )
+                
+                rows, self.incoming = self.incoming, []
+                closing = self.closed
+                req = self.flushreq
+            finally :
+                self.cond.release()
             
-            tbls = zip( *self._splitter_ex( stunt, 'select' ) )[0]
+            failed = self._route( rows ) if rows != [] else 0
             
-            _r = []
+            now = time.time()
             
-            for tbl in tbls :
+            due = [ ( tbl, trows ) for tbl, ( t, trows ) in self.buffers.items()
+                    if closing or req != self.flushed or
+                       len(trows) >= self.maxrows or
+                       now - t >= self.maxdelay ]
             
-                cols, dec, sql, positions = sqls[tbl[0].name]
-                
-                p = ctypes.create_string_buffer(sql)
-                
-                for pos, d in zip( positions, datas ):
-                    d = sqlstr(d)
-                    p[pos:pos+len(d)] = d
-                
-                n, r = self._read_low( p.raw, cols, dec, 
-                                                    self._gettablets( tbl ) )
+            for tbl, trows in due :
+                del self.buffers[tbl]
+            
+            if self.table.querypool != None and len(due) > 1 :
+                oks = self.table.querypool.map( self._writetablet, due )
+            else :
+                oks = [ self._writetablet( tbl, trows ) for tbl, trows in due ]
+            
+            written = sum( [ len(trows) for ( tbl, trows ), ok
+                             in zip( due, oks ) if ok ] )
+            failed += sum( [ len(trows) for ( tbl, trows ), ok
+                             in zip( due, oks ) if not ok ] )
+            
+            self.cond.acquire()
+            try :
+                self.pending -= written + failed
+                self.stats['written'] += written
+                self.stats['failed'] += failed
+                self.stats['inserts'] += len(due)
                 
-                if multi :
-                    _r.extends(r)
-                    continue
+                self.flushed = max( self.flushed, req )
                 
-                if n >= 1 :
-                    return r[0]
+                self.cond.notifyAll()
                 
-            if multi :
-                return _r
+                if closing and self.incoming == [] and self.buffers == {} :
+                    return
+            finally :
+                self.cond.release()
 
-            raise NotFoundError, 'not found'
-            
-        query.sqls = sqls
-        
-        return query
+
+def _asyncmethod( name ):
     
-    def asexplain( self, sql ):
+    def method( self, *args, **kwargs ):
+        return self.pool.submit( getattr( self.table, name ), *args, **kwargs )
+    
+    method.__name__ = name.strip('_')
+    method.__doc__ = 'QueryFuture of Table.%s' % ( name, )
+    
+    return method
+
+
+class AsyncTable( object ):
+    '''
+    Table whose methods return QueryFuture, the queries run in the threads
+    of an AsyncConnectionPool with the same conditions as Table
+    
+    atable = AsyncTable( table, AsyncConnectionPool( 32, table.connpool ) )
+    
+    f = atable.get( {'ID':1} )
+    row = f.result()
+    
+    atable.getitem( slc )           # table[slc]
+    atable.setitem( slc, value )    # table[slc] = value
+    atable.delitem( slc )           # del table[slc]
+    
+    stream = atable.iter( {'a':1}, batch=1000 )
+    rows = stream.fetch().result()  # [] at the end
+    
+    the AsyncTables made without a pool share AsyncTable.sharedpool(),
+    the queries of each use the connpool of its own table.
+    '''
+    
+    _sharedpool = None
+    _sharedlock = threading.Lock()
+    
+    def __init__( self, table, pool=None ):
         
-        def query( stunt = {} ):
-            
-            tbl = self._gettablets( self._splitter_ex( stunt, 'explain' )[0][0] )
-            
-            n, r = self._explain_low( p.raw, tbl )
-            
-            return r
+        self.table = table
+        self.pool = pool if pool != None else AsyncTable.sharedpool()
         
-        query.sqls = [sql]
+        return
+    
+    @staticmethod
+    def sharedpool():
+        '''
+        the AsyncConnectionPool of 16 threads shared by the AsyncTables,
+        made again if closed
+        '''
         
-        return query
+        AsyncTable._sharedlock.acquire()
+        try :
+            if AsyncTable._sharedpool == None or AsyncTable._sharedpool.closed :
+                AsyncTable._sharedpool = AsyncConnectionPool()
+            return AsyncTable._sharedpool
+        finally :
+            AsyncTable._sharedlock.release()
+    
+    get = _asyncmethod( 'get' )
+    get_many = _asyncmethod( 'get_many' )
+    gets = _asyncmethod( 'gets' )
+    append = _asyncmethod( 'append' )
+    extend = _asyncmethod( 'extend' )
+    set = _asyncmethod( 'set' )
+    sets = _asyncmethod( 'sets' )
+    remove = _asyncmethod( 'remove' )
+    removes = _asyncmethod( 'removes' )
+    load = _asyncmethod( 'load' )
+    loads = _asyncmethod( 'loads' )
+    
+    getitem = _asyncmethod( '__getitem__' )
+    setitem = _asyncmethod( '__setitem__' )
+    delitem = _asyncmethod( '__delitem__' )
+    
+    def iter( self, cond, keys=[], limit=None, offset=None, batch=1000 ):
+        '''
+        return AsyncStream of the rows of table.iter
+        '''
+        
+        return AsyncStream( self.pool,
+                            self.table.iter( cond, keys, limit, offset, batch ),
+                            batch )
 
 
 class DataBase ( object ):
     
-    def __init__( self, tables ):
+    def __init__( self, tables, lazy={} ):
+        '''
+        lazy : { name : function returning the table }, the table is made
+               on the first access
+        '''
         
         self.tables = dict( [ ( t.name, t ) for t in tables ] )
+        self.lazy = dict( lazy )
         
     def __getattr__( self, key ):
         
-        if key not in self.tables :
+        tables = self.__dict__.get( 'tables', {} )
+        
+        if key in tables :
+            return tables[key]
+        
+        lazy = self.__dict__.get( 'lazy', {} )
+        
+        if key not in lazy :
             raise KeyError, 'not has table named `%s`' %(key,)
         
-        return self.tables[key]
+        return tables.setdefault( key, lazy[key]() )
         
     @staticmethod
     def bytablename( tbls ):
@@ -1960,53 +5844,223 @@ class DataBase ( object ):
         
     def keys( self ):
         
-        return self.tables.keys()
+        return list( set( self.tables.keys() ) | set( self.lazy.keys() ) )
 
-def gettablenames( host, port, user, passwd, db ):
+
+class SchemaCache( object ):
     '''
-    SHOW TALBES
+    the tables, columns and primary keys of databases kept in a json file
+    
+    cache = SchemaCache( '/var/cache/app/schema.json', maxage=600 )
+    tables = maketables( host, port, user, passwd, db, schemacache=cache )
+    
+    the cached schema younger than maxage seconds is used without asking
+    the server. the older one is checked by one query of the fingerprint
+    of information_schema, and described again if it changed. maxage None
+    is to check every time.
     '''
     
-    p = SQLConnectionPool()
+    version = 1
     
-    conn_args = ( host, port, user, passwd, db )
+    def __init__( self, path, maxage=None ):
+        
+        self.path = path
+        self.maxage = maxage
+        
+        self.lock = threading.Lock()
+        
+        return
+    
+    def _load( self ):
+        
+        try :
+            with open( self.path, 'rb' ) as fp :
+                return json.load( fp )
+        except ( IOError, ValueError ), e :
+            return {}
+    
+    def _save( self, data ):
+        
+        tmp = '%s.%d.tmp' % ( self.path, os.getpid() )
+        
+        try :
+            with open( tmp, 'wb' ) as fp :
+                json.dump( data, fp )
+            os.rename( tmp, self.path )
+        except ( IOError, OSError ), e :
+            logging.warning( 'can not save schema cache %s : %s',
+                             self.path, e )
+        
+        return
+    
+    @staticmethod
+    def fingerprint( p, conn_args ):
+        
+        r = p.read( conn_args,
+                    "SELECT COUNT(*), SUM( CRC32( CONCAT_WS( ',', "
+                        "c.TABLE_NAME, c.COLUMN_NAME, c.ORDINAL_POSITION, "
+                        "c.COLUMN_TYPE, c.COLUMN_KEY ) ) ) "
+                    "FROM information_schema.COLUMNS c "
+                    "JOIN information_schema.TABLES t "
+                      "ON t.TABLE_SCHEMA = c.TABLE_SCHEMA "
+                      "AND t.TABLE_NAME = c.TABLE_NAME "
+                    "WHERE c.TABLE_SCHEMA = %s "
+                      "AND t.TABLE_TYPE = 'BASE TABLE'" % ( sqlstr(conn_args[4]), ) )
+        
+        return '%s:%s' % tuple( r[0] )
+    
+    def get( self, p, conn_args ):
+        '''
+        return [ [ tablename, cols, keys ], ... ]
+        '''
+        
+        key = '%s@%s:%s/%s' % ( conn_args[2], conn_args[0], conn_args[1],
+                                conn_args[4] )
+        
+        self.lock.acquire()
+        try :
+            data = self._load()
+            entry = data.get( key )
+            now = time.time()
+            
+            if entry == None or entry.get('version') != self.version :
+                entry = None
+            elif self.maxage != None and now - entry['time'] < self.maxage :
+                return entry['tables']
+            
+            fp = self.fingerprint( p, conn_args )
+            
+            if entry == None or entry['fingerprint'] != fp :
+                entry = { 'version' : self.version,
+                          'fingerprint' : fp,
+                          'tables' : _describe( p, conn_args ),
+                        }
+            
+            entry['time'] = now
+            data[key] = entry
+            self._save( data )
+        finally :
+            self.lock.release()
+        
+        return entry['tables']
+
+
+def _showtables( p, conn_args ):
     
     tblnames = p.read( conn_args,
                        "SHOW FULL TABLES FROM `%s` "
-                                "WHERE table_type = 'BASE TABLE'" % (db,) )
+                                "WHERE table_type = 'BASE TABLE'" % (conn_args[4],) )
+    
+    return [ t[0] for t in tblnames ]
+
+
+def _describetable( p, conn_args, n ):
+    '''
+    DESCRIBE
+    
+    return [ cols, keys ]
+    '''
+    
+    cols = p.read( conn_args, "DESCRIBE `%s`.`%s`" % (conn_args[4],n) )
+    
+    return [ [ col[0] for col in cols ],
+             [ col[0] for col in cols if col[3] == 'PRI' ] ]
+
+
+def _describe( p, conn_args, tablename=None ):
+    '''
+    SHOW TALBES
+    DESCRIBE
+    
+    return [ [ tablename, cols, keys ], ... ]
+    '''
     
-    tblnames = [ t[0] for t in tblnames ]
+    tblnames = [ n for n in _showtables( p, conn_args )
+                 if tablename==None or n==tablename ]
     
-    return tblnames
+    return [ [ n, ] + _describetable( p, conn_args, n ) for n in tblnames ]
 
 
-def maketables( host, port, user, passwd, db, tablename=None ):
+def _schema( p, conn_args, schemacache, tablename=None ):
+    
+    if schemacache != None :
+        return [ [ n, cols, keys ]
+                 for n, cols, keys in schemacache.get( p, conn_args )
+                 if tablename==None or n==tablename ]
+    
+    return _describe( p, conn_args, tablename )
+
+
+def gettablenames( host, port, user, passwd, db, schemacache=None ):
+    '''
+    SHOW TALBES
+    '''
+    
+    conn_args = ( host, port, user, passwd, db )
+    
+    if schemacache != None :
+        return [ n for n, cols, keys
+                 in schemacache.get( SQLConnectionPool(), conn_args ) ]
+    
+    return _showtables( SQLConnectionPool(), conn_args )
+
+
+def maketables( host, port, user, passwd, db, tablename=None, connpool=None,
+                schemacache=None ):
     '''
     SHOW TALBES
     DESCRIBE
     SHOW GRANTS
+    
+    the tables share the connpool if it is given,
+    the schema is read from the schemacache if it is given
     '''
     
-    p = SQLConnectionPool()
+    p = connpool if connpool != None else SQLConnectionPool()
     
     conn_args = ( host, port, user, passwd, db )
     
-    tblnames = p.read( conn_args,
-                       "SHOW FULL TABLES FROM `%s` "
-                                "WHERE table_type = 'BASE TABLE'" % (db,) )
+    tablets = [     Tablet( n, conn_args, cols, keys )
+                for n, cols, keys
+                in _schema( p, conn_args, schemacache, tablename ) ]
+    
+    return [ Table( [t,], t.name, connpool ) for t in tablets ]
+
+
+def makedatabase( host, port, user, passwd, db, connpool=None,
+                  schemacache=None ):
+    '''
+    DataBase of the tables of db, a table is made on the first access
+    
+    db = makedatabase( host, port, user, passwd, 'db', schemacache=cache )
+    db.tablename.get( {'ID':1} )
+    
+    without the schemacache only SHOW TABLES is queried here, a table is
+    described on its first access.
+    '''
     
-    tblnames = [ t[0] for t in tblnames
-                 if tablename==None or t[0]==tablename ]
+    p = connpool if connpool != None else SQLConnectionPool()
     
-    tblcols = [     p.read( conn_args, "DESCRIBE `%s`.`%s`" % (db,n) )
-                for n in tblnames ]
+    conn_args = ( host, port, user, passwd, db )
     
-    tblcols = [ [ col[0] for col in cols ] for cols in tblcols ]
+    def maker( n, schema ):
+        
+        def make():
+            cols, keys = schema if schema != None else \
+                         _describetable( p, conn_args, n )
+            return Table( [ Tablet( n, conn_args, cols, keys ), ],
+                          str(n), connpool )
+        
+        return make
     
-    tablets = [     Tablet( n, conn_args, cols )
-                for n, cols in zip(tblnames, tblcols) ]
+    if schemacache != None :
+        schemas = [ ( n, [ cols, keys ] )
+                    for n, cols, keys in schemacache.get( p, conn_args ) ]
+    else :
+        schemas = [ ( n, None ) for n in _showtables( p, conn_args ) ]
     
-    return [ Table( [t,], t.name ) for t in tablets ]
+    return DataBase( [], dict( [ ( str(n), maker( n, schema ) )
+                                 for n, schema in schemas ] ) )
 
 
 def getdbnames( host, port, user, passwd ):
@@ -2043,6 +6097,17 @@ class ENUM_INT( object ):
         
     def de( self, x ):
         return ( self._l[x], )
+    
+    def en_many( self, xs ):
+        
+        idx = {}
+        for i, v in reversed( list( enumerate(self._l) ) ) :
+            idx[v] = i
+        
+        return ( map( idx.__getitem__, xs ), )
+    
+    def de_many( self, xs ):
+        return ( map( self._l.__getitem__, xs ), )
         
     
 
@@ -2069,57 +6134,130 @@ class LIST_MOD( object ):
         lst = [ i for i, z in zip( self._l, lst ) if z == True ] 
         
         return ( lst, )
+    
+    def _detables( self ):
+        '''
+        the items of each byte value at each byte position
+        '''
+        
+        if not hasattr( self, '_tables' ) :
+            self._tables = [ [ [ self._l[p+z] for z in range(8)
+                                 if ( v & ( 1 << z ) ) and p+z < len(self._l) ]
+                               for v in range(256) ]
+                             for p in range(0,len(self._l),8) ]
+        
+        return self._tables
+    
+    def de_many( self, xs ):
+        
+        tables = self._detables()
+        chain = itertools.chain.from_iterable
+        
+        # a column of bitmasks has few distinct values
+        memo = {}
+        for x in set(xs) :
+            memo[x] = list( chain( [ t[ord(c)] for t, c in zip( tables, x ) ] ) )
+        
+        return ( [ list(memo[x]) for x in xs ], )
+
+# the converters are classmethods, so the bulk versions <name>_many
+# are found by _bulkconv from ANY_JSON.de etc.
 
 class ANY_JSON( object ):
         
-    @staticmethod
-    def en( x ):
+    @classmethod
+    def en( cls, x ):
         return (json.dumps( x, encoding='utf-8' ),)
     
-    @staticmethod
-    def de( x ):
+    @classmethod
+    def de( cls, x ):
         return (json.loads( x, encoding='utf-8' ),)
+    
+    @classmethod
+    def en_many( cls, xs ):
+        return ( [ json.dumps( x, encoding='utf-8' ) for x in xs ], )
+    
+    @classmethod
+    def de_many( cls, xs ):
+        
+        # each value alone, a column joined to one array would parse
+        # ['1,[2','3]'] without an error
+        loads = json.loads
+        
+        return ( [ loads( x, encoding='utf-8' ) for x in xs ], )
         
         
 class HEX_BIN( object ):
     
-    @staticmethod
-    def en(x):
+    @classmethod
+    def en( cls, x ):
         return (x.decode('hex'),)
     
-    @staticmethod
-    def de(x):
+    @classmethod
+    def de( cls, x ):
         return (x.encode('hex'),)
+    
+    @classmethod
+    def en_many( cls, xs ):
+        return ( map( binascii.unhexlify, xs ), )
+    
+    @classmethod
+    def de_many( cls, xs ):
+        return ( map( binascii.hexlify, xs ), )
 
 class BOOL_BIN( object ):
     
-    @staticmethod
-    def en(x):
+    @classmethod
+    def en( cls, x ):
         return (chr(1) if x == True else chr(0),)
         
-    @staticmethod
-    def de(x):
+    @classmethod
+    def de( cls, x ):
         return (x == chr(1),)
+    
+    @classmethod
+    def en_many( cls, xs ):
+        return ( [ chr(1) if x == True else chr(0) for x in xs ], )
+    
+    @classmethod
+    def de_many( cls, xs ):
+        return ( [ x == chr(1) for x in xs ], )
         
 class BOOL_NULL( object ):
     
-    @staticmethod
-    def en(x):
+    @classmethod
+    def en( cls, x ):
         return (chr(1) if x == True else null,)
         
-    @staticmethod
-    def de(x):
+    @classmethod
+    def de( cls, x ):
         return (x != None,)
+    
+    @classmethod
+    def en_many( cls, xs ):
+        return ( [ chr(1) if x == True else null for x in xs ], )
+    
+    @classmethod
+    def de_many( cls, xs ):
+        return ( [ x != None for x in xs ], )
         
 class DATETIME_SQL( object ):
     
-    @staticmethod
-    def en(x):
+    @classmethod
+    def en( cls, x ):
         return ( x.strftime('%Y-%m-%d %H:%M:%S'), )
     
-    @staticmethod
-    def de(x):
+    @classmethod
+    def de( cls, x ):
         return ( x, )
+    
+    @classmethod
+    def en_many( cls, xs ):
+        return ( [ x.strftime('%Y-%m-%d %H:%M:%S') for x in xs ], )
+    
+    @classmethod
+    def de_many( cls, xs ):
+        return ( list(xs), )
 
 
 if __name__ == '__main__' :
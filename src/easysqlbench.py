@@ -0,0 +1,527 @@
+#
+# Benchmark of the overhead of easysql without a database
+#
+# author : d13
+# license : new BSD license
+#
+
+import sys
+import types
+import time
+import gc
+import re
+import json
+
+
+class FakeError( Exception ):
+    pass
+
+class FakeOperationalError( FakeError ):
+    pass
+
+class FakeProgrammingError( FakeError ):
+    pass
+
+
+_escapes = { '\0' : '\\0', '\n' : '\\n', '\r' : '\\r', '\\' : '\\\\',
+             "'" : "\\'", '"' : '\\"', '\x1a' : '\\Z' }
+
+_escaper = re.compile( '[\\0\\n\\r\\\\\'"\\x1a]' )
+
+def fake_escape_string( s ):
+
+    return _escaper.sub( lambda m : _escapes[m.group(0)], s )
+
+
+class FakeResult( object ):
+
+    def __init__( self, rows ):
+        
+        self.rows = rows
+        self.pos = 0
+        
+        return
+    
+    def num_rows( self ):
+        
+        return len(self.rows)
+    
+    def fetch_row( self, n=1 ):
+        
+        n = n or len(self.rows)
+        
+        r = self.rows[self.pos:self.pos+n]
+        self.pos += len(r)
+        
+        return r
+    
+    def field_flags( self ):
+        
+        return ()
+
+
+# the strings, names and parentheses of a sql, enough to split it
+_sqltoken = re.compile( r"'(?:\\.|[^'\\])*'|\"(?:\\.|[^\"\\])*\"|`[^`]*`|"
+                        r" UNION ALL |[();]|[^'\"`(); ]+| " )
+
+def _splitsql( sql, sep ):
+    '''
+    split sql by sep ( ';' or ' UNION ALL ' ) out of strings and parentheses
+    '''
+    
+    if sep not in sql :
+        return [ sql ]
+    
+    parts = []
+    part = []
+    depth = 0
+    
+    for t in _sqltoken.findall( sql ) :
+        
+        if t == '(' :
+            depth += 1
+        elif t == ')' :
+            depth -= 1
+        elif t == sep and depth == 0 :
+            parts.append( ''.join( part ) )
+            part = []
+            continue
+        
+        part.append( t )
+    
+    parts.append( ''.join( part ) )
+    
+    return parts
+
+
+# the tag of a row of CompiledQuery.many()
+_tagcol = re.compile( r'(\d+) AS `_n`,' )
+
+
+class FakeConnection( object ):
+    '''
+    MySQLdb.Connection answering every query at once without a server
+    
+    conn = FakeConnection( responder=lambda sql : rows )
+    
+    responder( sql ) returns the tuple of rows of a SELECT, EXPLAIN, SHOW
+    or DESCRIBE. the parts of UNION ALL are asked one by one, the tag
+    column `_n` of many() is added to the rows. the writes change the
+    number of rows in its VALUES, an UPDATE or DELETE changes one row.
+    
+    the statements of a query joined by ';' are run one by one, as the
+    results are read by next_result.
+    '''
+    
+    def __init__( self, responder=None, **kwargs ):
+        
+        self.responder = responder
+        self.kwargs = kwargs
+        
+        self.sql = ''
+        self.rows = None
+        self.queries = 0
+        self.statements = []
+        
+        return
+    
+    def query( self, sql ):
+        
+        self.queries += 1
+        self.statements = _splitsql( sql, ';' )
+        
+        self._run( self.statements.pop(0) )
+        
+        return
+    
+    def _run( self, sql ):
+        
+        self.sql = sql
+        
+        if sql.lstrip( ' (' )[:4].upper() not in ( 'SELE', 'EXPL', 'SHOW', 'DESC' ) :
+            self.rows = None
+        elif self.responder == None :
+            self.rows = ()
+        else :
+            self.rows = sum( [ self._respond( part )
+                               for part in _splitsql( sql, ' UNION ALL ' ) ],
+                             () )
+        
+        return
+    
+    def _respond( self, sql ):
+        
+        sql = sql.strip( ' ' )
+        
+        if sql.startswith( '(' ) and sql.endswith( ')' ) :
+            sql = sql[1:-1]
+        
+        m = _tagcol.search( sql.split( ' FROM ', 1 )[0] )
+        
+        if m == None :
+            return tuple( self.responder( sql ) )
+        
+        tag = ( int( m.group(1) ), )
+        sql = sql[:m.start()] + sql[m.end():]
+        
+        return tuple( [ tag + tuple( r ) for r in self.responder( sql ) ] )
+    
+    def store_result( self ):
+        
+        return FakeResult( self.rows ) if self.rows != None else None
+    
+    use_result = store_result
+    
+    def _records( self ):
+        
+        if ' VALUES ' in self.sql :
+            return self.sql.count( '),(' ) + 1
+        
+        return None
+    
+    def affected_rows( self ):
+        
+        if self.rows != None :
+            return len( self.rows )
+        
+        n = self._records()
+        
+        return n if n != None else 1
+    
+    def insert_id( self ):
+        
+        return 0
+    
+    def info( self ):
+        
+        # as mysql_info(), None for a single row INSERT
+        n = self._records()
+        
+        if n != None and n > 1 :
+            return 'Records: %d  Duplicates: 0  Warnings: 0' % (n,)
+        
+        if self.sql.lstrip()[:6].upper() == 'UPDATE' :
+            return 'Rows matched: 1  Changed: 1  Warnings: 0'
+        
+        return None
+    
+    def next_result( self ):
+        
+        if self.statements == [] :
+            return -1
+        
+        self._run( self.statements.pop(0) )
+        
+        return 0
+    
+    def commit( self ):
+        
+        return
+    
+    def rollback( self ):
+        
+        return
+    
+    def ping( self ):
+        
+        return
+    
+    def close( self ):
+        
+        return
+
+
+def fakemysqldb():
+    '''
+    return a module standing in for MySQLdb made of the fakes
+    '''
+    
+    m = types.ModuleType( 'MySQLdb' )
+    
+    m.Error = FakeError
+    m.OperationalError = FakeOperationalError
+    m.ProgrammingError = FakeProgrammingError
+    m.escape_string = fake_escape_string
+    m.Connection = FakeConnection
+    
+    return m
+
+
+# easysql imports MySQLdb, the fake is used if it is not installed,
+# the queries never reach the driver in the benchmarks anyway
+try :
+    import MySQLdb
+except ImportError :
+    sys.modules['MySQLdb'] = fakemysqldb()
+
+import easysql
+
+
+class FakeConnectionPool( easysql.SQLConnectionPool ):
+    '''
+    SQLConnectionPool of FakeConnection
+    
+    pool = FakeConnectionPool( responder=lambda sql : rows )
+    '''
+    
+    def __init__( self, responder=None, **kwargs ):
+        
+        easysql.SQLConnectionPool.__init__( self, **kwargs )
+        
+        self.responder = responder
+        
+        return
+    
+    def _connect( self, conn_args ):
+        
+        return FakeConnection( self.responder )
+
+
+KINDS = [ 'user', 'group', 'robot', 'guest' ]
+COLS = [ 'ID', 'name', 'kind', 'data', 'flag' ]
+
+
+def responder( rows ):
+    '''
+    return a responder answering every select with the rows ( dicts ),
+    in the order of the columns selected
+    '''
+    
+    cache = {}
+    
+    def respond( sql ):
+        
+        head = sql.split( ' FROM ', 1 )[0]
+        
+        r = cache.get( head )
+        
+        if r == None :
+            cols = re.findall( '`(\\w+)`', head )
+            r = tuple( [ tuple( [ row[c] for c in cols ] ) for row in rows ] )
+            cache[head] = r
+        
+        return r
+    
+    return respond
+
+
+def maketable( nshards, rows=() ):
+    '''
+    table of nshards tablets routed by HashRing on ID, every select
+    returns rows ( encoded dicts )
+    '''
+    
+    pool = FakeConnectionPool( responder = responder( rows ) )
+    
+    tablets = [ easysql.Tablet( 'bench%d' % i,
+                                ( 'fake', 3306, 'user', 'passwd', 'db%d' % i ),
+                                COLS, ['ID',] )
+                for i in range(nshards) ]
+    
+    t = easysql.Table( tablets, 'bench', pool )
+    
+    t._hashtablets( lambda tbl : tbl.name )
+    t.setrouter( easysql.HashRing( [ tbl.name for tbl in tablets ] ), 'ID' )
+    
+    kind = easysql.ENUM_INT( KINDS )
+    
+    t.setconverter( kind.en, kind.de, ['kind',], ['kind',] )
+    t.setconverter( easysql.ANY_JSON.en, easysql.ANY_JSON.de,
+                    ['data',], ['data',] )
+    
+    return t
+
+
+def makerows( nrows ):
+
+    return [ { 'ID' : i,
+               'name' : 'name\'%d"' % i,
+               'kind' : KINDS[ i % len(KINDS) ],
+               'data' : { 'n' : i, 'tags' : [ 'a', 'b' ] },
+               'flag' : i % 2,
+             }
+             for i in range(nrows) ]
+
+
+def benchmarks( nrows, nshards ):
+    '''
+    return [ ( name, func, number of operations a call ), ... ]
+    '''
+    
+    rows = makerows( nrows )
+    
+    t = maketable( nshards )
+    
+    encoded = t._encoderows( rows )
+    records = [ tuple( [ r[c] for c in COLS ] ) for r in encoded ]
+    
+    rt = maketable( nshards, encoded )
+    
+    tbl = t.tablets[0]
+    built = [ tbl._buildrow( r ) for r in encoded ]
+    values = sum( [ r.values() for r in encoded ], [] )
+    
+    def select_sql():
+        for r in rows :
+            tbl._select_sql( { 'ID' : r['ID'] }, limit=1 )
+    
+    def select_sql_nocache():
+        cache = easysql.Tablet.sqlcache
+        easysql.Tablet.sqlcache = None
+        try :
+            select_sql()
+        finally :
+            easysql.Tablet.sqlcache = cache
+    
+    # one row of a lookup
+    q = maketable( nshards, encoded[:1] ).asquery( 'SELECT %(<cols>)s FROM %(<tablename>)s '
+                    'WHERE `ID`=%(ID)s AND `kind` IN %(kinds)s' )
+    
+    def asquery():
+        for r in rows :
+            q( { 'ID' : r['ID'], 'kinds' : [ 0, 1 ] }, { 'ID' : r['ID'] } )
+    
+    def asquery_fill():
+        for r in rows :
+            vals = q._escape( { 'ID' : r['ID'], 'kinds' : [ 0, 1 ] } )
+            for name, sql in q.sqls.items() :
+                q._fill( sql[2], sql[3], vals )
+    
+    return [
+        ( 'sqlstr', lambda : map( easysql.sqlstr, values ), len(values) ),
+        ( 'select_sql', select_sql, nrows ),
+        ( 'select_sql_nocache', select_sql_nocache, nrows ),
+        ( 'insert_sql', lambda : tbl._insert_sql( built ), nrows ),
+        ( 'encode', lambda : t._encoderows( rows ), nrows ),
+        ( 'decode', lambda : t._decoderows( encoded ), nrows ),
+        ( 'decode_columnar',
+          lambda : t._decodecolumns( COLS, records ), nrows ),
+        ( 'route', lambda : t._grouprows( encoded, 'insert', 'write' ),
+          nrows ),
+        ( 'extend', lambda : t.extend( rows ), nrows ),
+        ( 'gets', lambda : rt.gets( { 'flag' : 1 } ), nrows * nshards ),
+        ( 'asquery', asquery, nrows ),
+        ( 'asquery_fill', asquery_fill, nrows * nshards ),
+    ]
+
+
+def measure( func, mintime=0.5 ):
+    '''
+    return ( calls a second, gc objects left a call )
+    
+    the objects tracked by gc are counted before and after the calls,
+    python2 can not count the allocations of a call.
+    '''
+    
+    func()
+    
+    gc.collect()
+    objs = len( gc.get_objects() )
+    
+    n = 0
+    start = time.time()
+    
+    while True :
+        func()
+        n += 1
+        elapsed = time.time() - start
+        if elapsed >= mintime :
+            break
+    
+    gc.collect()
+    objs = len( gc.get_objects() ) - objs
+    
+    return n / elapsed, float(objs) / n
+
+
+def run( nrowss=(1, 100, 1000), nshardss=(1, 4, 16), mintime=0.5,
+         names=None, out=sys.stdout ):
+    '''
+    run the benchmarks, return
+    [ { 'name', 'rows', 'shards', 'ops', 'calls', 'objs' }, ... ]
+    
+    ops is the operations ( rows, values ... ) a second,
+    calls is the calls of the benchmark a second.
+    '''
+    
+    rst = []
+    
+    if out != None :
+        out.write( '%-20s %6s %6s %14s %12s %10s\n' %
+                   ( 'name', 'rows', 'shards', 'ops/s', 'calls/s', 'objs' ) )
+    
+    for nshards in nshardss :
+        for nrows in nrowss :
+            for name, func, ops in benchmarks( nrows, nshards ) :
+                
+                if names != None and name not in names :
+                    continue
+                
+                calls, objs = measure( func, mintime )
+                
+                r = { 'name' : name, 'rows' : nrows, 'shards' : nshards,
+                      'ops' : calls * ops, 'calls' : calls, 'objs' : objs }
+                rst.append( r )
+                
+                if out != None :
+                    out.write( '%(name)-20s %(rows)6d %(shards)6d '
+                               '%(ops)14.1f %(calls)12.1f %(objs)10.1f\n' % r )
+                    out.flush()
+    
+    return rst
+
+
+def compare( base, rst, out=sys.stdout ):
+    '''
+    print the change of ops/s of rst against base, both are results of run
+    '''
+    
+    base = dict( [ ( ( r['name'], r['rows'], r['shards'] ), r ) for r in base ] )
+    
+    for r in rst :
+        
+        b = base.get( ( r['name'], r['rows'], r['shards'] ) )
+        
+        if b == None :
+            continue
+        
+        out.write( '%-20s %6d %6d %+8.1f%%\n' %
+                   ( r['name'], r['rows'], r['shards'],
+                     ( r['ops'] / b['ops'] - 1 ) * 100 ) )
+    
+    return
+
+
+if __name__ == '__main__' :
+
+    import getopt
+    
+    opts, args = getopt.gnu_getopt( sys.argv[1:], 'n:s:t:b:o:h',
+                                    [ 'rows=', 'shards=', 'time=',
+                                      'baseline=', 'output=', 'help' ] )
+    opts = dict( opts )
+    
+    if '-h' in opts or '--help' in opts :
+        print 'usage: easysqlbench.py [-n 1,100,1000] [-s 1,4,16] [-t 0.5]'
+        print '                       [-o result.json] [-b baseline.json]'
+        print '                       [benchmark names ...]'
+        sys.exit(0)
+    
+    nrowss = [ int(x) for x in
+               opts.get( '-n', opts.get( '--rows', '1,100,1000' ) ).split(',') ]
+    nshardss = [ int(x) for x in
+                 opts.get( '-s', opts.get( '--shards', '1,4,16' ) ).split(',') ]
+    mintime = float( opts.get( '-t', opts.get( '--time', '0.5' ) ) )
+    
+    rst = run( nrowss, nshardss, mintime, args or None )
+    
+    output = opts.get( '-o', opts.get( '--output' ) )
+    if output :
+        with open( output, 'w' ) as fp :
+            json.dump( rst, fp, indent=1 )
+    
+    baseline = opts.get( '-b', opts.get( '--baseline' ) )
+    if baseline :
+        with open( baseline ) as fp :
+            print
+            compare( json.load( fp ), rst )
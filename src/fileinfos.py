@@ -34,7 +34,7 @@ class BuildinTypeSegmentMark( ezp.ProtocolType ):
         a = fp.read(1)
         
         if h != '\xff' :
-            raise ezp.ConnectionError, ( 'jpeg deconstruct error.', h, fp.io.tell() )
+            raise ezp.ConnectionError, ( 'jpeg deconstruct error.', h, fp.tell() )
         
         while( a == '\xff' ) :
             a = fp.read(1)
@@ -64,16 +64,23 @@ class JPEG( dict ):
     
     def __init__( self, fname ):
         
-        with open(fname) as fp :
+        with open(fname) as _fp :
+            
+            fp = ezp.mapfile( _fp )
             
-            while( True ):
-                d = self.ebp.read( 'jpeg', fp )
-                name = self.segnames.get( d['appmark'], d['appmark'] )
-                self[name] = d['content']
-                if name == 'EOI' :
-                    break
-                if name == 'SOS' :
-                    fp.seek(-2, os.SEEK_END)
+            try :
+                while( True ):
+                    d = self.ebp.read( 'jpeg', fp )
+                    name = self.segnames.get( d['appmark'], d['appmark'] )
+                    self[name] = d['content']
+                    if name == 'EOI' :
+                        break
+                    if name == 'SOS' :
+                        fp.seek(-2, os.SEEK_END)
+            finally :
+                # the mmap is not closed with the file
+                if fp is not _fp :
+                    fp.close()
         
 
 class PNG( dict ):
@@ -83,21 +90,29 @@ class PNG( dict ):
     
     def __init__( self, fname ):
         
-        with open(fname) as fp :
+        with open(fname) as _fp :
             
-            x = fp.read( 8 )
-            if x != '\x89\x50\x4E\x47\x0D\x0A\x1A\x0A' :
-                raise ezp.ConnectionError, ('png PREFIX error')
+            # the data of the chunks are skipped in the mapped file
+            fp = ezp.mapfile( _fp )
             
-            while( True ):
-                d = self.ebp.read( 'png', fp )
-                name = d['type']
-                self[name] = d
-                if name == 'IEND' :
-                    if d['crc'] != '\xAE\x42\x60\x82' :
-                        raise ezp.ConnectionError, ('png IEND chunk error')
-                    
-                    break
+            try :
+                x = fp.read( 8 )
+                if x != '\x89\x50\x4E\x47\x0D\x0A\x1A\x0A' :
+                    raise ezp.ConnectionError, ('png PREFIX error')
+                
+                while( True ):
+                    d = self.ebp.read( 'png', fp )
+                    name = d['type']
+                    self[name] = d
+                    if name == 'IEND' :
+                        if d['crc'] != '\xAE\x42\x60\x82' :
+                            raise ezp.ConnectionError, ('png IEND chunk error')
+                        
+                        break
+            finally :
+                # the mmap is not closed with the file
+                if fp is not _fp :
+                    fp.close()
             
 
 class BMP( dict ):
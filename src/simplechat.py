@@ -24,6 +24,7 @@ import types
 
 
 import easydecorator
+import easyprotocol
 
 
 class SimpleChatChannel( asynchat.async_chat ):
@@ -58,6 +59,31 @@ class SimpleChatChannel( asynchat.async_chat ):
         self.data += data
 
 
+class SimpleProtocolChannel( asynchat.async_chat ):
+    """
+    binary protocol serv
+    the records are parsed from the stream by the StreamParser,
+    and work is called with each of them.
+    """
+    
+    def __init__( self, socket, work, parser ):
+        
+        asynchat.async_chat.__init__( self, sock = socket )
+        
+        self.set_terminator(None)
+        self.dowork = work
+        self.parser = parser
+        
+    def collect_incoming_data( self, data ):
+        """
+        when has data coming , be called .
+        call do work with the records completed by data
+        """
+        
+        for r in self.parser.feed( data ) :
+            self.push( self.dowork( r ) or '' )
+
+
 
 
 class SimpleChatDeamon( asyncore.dispatcher ):
@@ -102,6 +128,30 @@ class SimpleChatDeamon( asyncore.dispatcher ):
         SimpleChatChannel( conn, self.dowork, self.terminator )
         
 
+class SimpleProtocolDeamon( SimpleChatDeamon ):
+    
+    """ binary protocol serv's daemon
+    every link is dispatched to a simpleprotocolchannel object,
+    which parses the define name of the EasyBinaryProtocol ebp.
+    """
+    
+    def __init__( self, work, addr, ebp, name, **spaces ):
+        
+        SimpleChatDeamon.__init__( self, work, addr )
+        
+        self.ebp = ebp
+        self.name = name
+        self.spaces = spaces
+        
+    def handle_accept(self):
+        
+        conn, addr = self.accept()
+        
+        parser = easyprotocol.StreamParser( self.ebp, self.name, **self.spaces )
+        
+        SimpleProtocolChannel( conn, self.dowork, parser )
+        
+
 
 def simplechat( work, addr, terminator='\r\n' ):
     
@@ -109,6 +159,12 @@ def simplechat( work, addr, terminator='\r\n' ):
     asyncore.loop()
 
 
+def simpleprotocol( work, addr, ebp, name, **spaces ):
+    
+    SimpleProtocolDeamon( work, addr, ebp, name, **spaces )
+    asyncore.loop()
+
+
 @easydecorator.decorator_builder(2)
 def simplechatwith( _old, addr, terminator ):
     
@@ -137,18 +137,25 @@ class ShockwaveFile(object):
     
     def __init__( self, fname ):
         
-        with open(fname) as fp :
+        with open(fname) as _fp :
             
-            self.header = self.ebp.read( 'swf', fp )
-            self.tags = []
+            fp = ezp.mapfile( _fp )
             
-            le = -1
-            
-            while( le !=0 ):
+            try :
+                self.header = self.ebp.read( 'swf', fp )
+                self.tags = []
+                
+                le = -1
                 
-                tag = self.ebp.read( 'tag', fp )
-                le = tag['code_and_length']['length']
-                self.tags.append(tag)
+                while( le !=0 ):
+                    
+                    tag = self.ebp.read( 'tag', fp )
+                    le = tag['code_and_length']['length']
+                    self.tags.append(tag)
+            finally :
+                # the mmap is not closed with the file
+                if fp is not _fp :
+                    fp.close()
                 
         self.fonts = {}
         
@@ -156,7 +163,7 @@ class ShockwaveFile(object):
             
             if tag['code_and_length']['code'] == 91 :
                 
-                font = self.ebp.read( 'tag91', cStringIO.StringIO(tag['content']), length=tag['code_and_length']['length'] )
+                font = self.ebp.read( 'tag91', tag['content'], length=tag['code_and_length']['length'] )
                 font['fontname'] = font['fontname'].strip('\0') 
                 
                 tag['content'] = font
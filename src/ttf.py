@@ -432,20 +432,28 @@ class TTFile(object):
             self.idxsort.remove('glyf')
             self.idxsort.remove('hmtx')
         
-        with open(fname) as fp :
+        with open(fname) as _fp :
             
-            directory = self.ebp.read( 'ttf', fp )['directory']
-            entrys = directory.pop('entry')
+            # the tables are parsed from the mapped file without copying
+            fp = ezp.mapfile( _fp )
             
-            self.sfntversion = directory['sfntversion']
-            
-            entrys = [ e for e in entrys if e['tag'] in self.idxsort ]
-            entrys.sort( key = lambda e : self.idxsort.index(e['tag']) )
-            
-            ae = dict( (e['tag'],e) for e in entrys )
-            
-            for e in entrys :
-                self.read_entry( fp, e, ae, True )
+            try :
+                directory = self.ebp.read( 'ttf', fp )['directory']
+                entrys = directory.pop('entry')
+                
+                self.sfntversion = directory['sfntversion']
+                
+                entrys = [ e for e in entrys if e['tag'] in self.idxsort ]
+                entrys.sort( key = lambda e : self.idxsort.index(e['tag']) )
+                
+                ae = dict( (e['tag'],e) for e in entrys )
+                
+                for e in entrys :
+                    self.read_entry( fp, e, ae, True )
+            finally :
+                # the mmap is not closed with the file
+                if fp is not _fp :
+                    fp.close()
                 
         if noglyph :
             
@@ -1453,20 +1461,28 @@ class CFF(TTFile):
             
     def load_otf( self, fname ):
             
-        with open(fname) as fp :
+        with open(fname) as _fp :
             
-            directory = self.ebp.read( 'ttf', fp )['directory']
-            entrys = directory.pop('entry')
+            # the tables are parsed from the mapped file without copying
+            fp = ezp.mapfile( _fp )
             
-            self.sfntversion = directory['sfntversion']
-            
-            entrys = [ e for e in entrys if e['tag'] in self.idxsort ]
-            entrys.sort( key = lambda e : self.idxsort.index(e['tag']) )
-            
-            ae = dict( (e['tag'],e) for e in entrys )
-            
-            for e in entrys :
-                self.read_entry( fp, e, ae, True )
+            try :
+                directory = self.ebp.read( 'ttf', fp )['directory']
+                entrys = directory.pop('entry')
+                
+                self.sfntversion = directory['sfntversion']
+                
+                entrys = [ e for e in entrys if e['tag'] in self.idxsort ]
+                entrys.sort( key = lambda e : self.idxsort.index(e['tag']) )
+                
+                ae = dict( (e['tag'],e) for e in entrys )
+                
+                for e in entrys :
+                    self.read_entry( fp, e, ae, True )
+            finally :
+                # the mmap is not closed with the file
+                if fp is not _fp :
+                    fp.close()
     
     def _read_index( self, index ):
         
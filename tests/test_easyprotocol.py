@@ -0,0 +1,427 @@
+#
+# tests of easyprotocol
+#
+#   python -m unittest discover -s tests
+#
+
+import os
+import sys
+import mmap
+import random
+import struct
+import tempfile
+import unittest
+import cStringIO
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath(__file__) ),
+                                  '..', 'src' ) )
+
+import easyprotocol
+
+
+PROTOCOL = '''
+tbl TBL(auto)
+    
+    count   uint_b(2)
+    head    HEAD
+        major   uint_b(2)
+        minor   uint_b(2)
+    entry   ENTRY[count]
+        tag     char[4]
+        offset  uint_b(4)
+    crc     byte[4]
+
+msg MSG(auto)
+    
+    length  uint(1)
+    name    char[length]
+'''
+
+DATA = struct.pack( '>HHH', 2, 1, 0 ) + \
+       'abcd' + struct.pack( '>I', 7 ) + \
+       'efgh' + struct.pack( '>I', 9 ) + \
+       'CRC!'
+
+
+def makeprotocol( protocol=PROTOCOL, compiled=True ):
+    
+    ebp = easyprotocol.EasyBinaryProtocol()
+    ebp.compiled = compiled
+    ebp.parse( protocol.splitlines(True) )
+    
+    return ebp
+
+
+class SkimTest( unittest.TestCase ):
+    
+    def setUp( self ):
+        
+        self.ebp = makeprotocol()
+        
+        self.read = self.ebp.read( 'tbl', DATA )
+        self.skim = self.ebp.skim( 'tbl', DATA )
+    
+    def test_deferred( self ):
+        
+        self.assertTrue( isinstance( self.skim, easyprotocol.LazyRecord ) )
+        self.assertTrue( isinstance( self.skim['head'], easyprotocol.LazyRecord ) )
+        self.assertEqual( sorted( self.skim._deferred.keys() ), [ 'crc', 'entry' ] )
+    
+    def test_mapping( self ):
+        
+        self.assertEqual( dict( self.skim ), self.read )
+        self.assertEqual( len( self.skim ), len( self.read ) )
+        
+        items = self.skim.items()
+        
+        self.assertEqual( dict( items ), self.read )
+        self.assertEqual( [ k for k, v in items ], self.skim.keys() )
+        self.assertEqual( [ v for k, v in items ], self.skim.values() )
+        self.assertEqual( sorted( self.skim.keys() ), sorted( self.read.keys() ) )
+        
+        
+        self.assertTrue( 'entry' in self.skim )
+        self.assertFalse( 'length' in self.skim )
+        self.assertEqual( self.skim.get( 'length' ), None )
+    
+    def test_nested( self ):
+        
+        self.assertEqual( dict( self.skim['head'] ), self.read['head'] )
+        self.assertEqual( self.skim['entry'], self.read['entry'] )
+        self.assertEqual( self.skim['entry'][1]['offset'], 9 )
+    
+    def test_set_deferred( self ):
+        
+        self.skim['crc'] = 'none'
+        del self.skim['entry']
+        
+        self.assertEqual( self.skim['crc'], 'none' )
+        self.assertFalse( 'entry' in self.skim )
+        self.assertEqual( self.skim._deferred, {} )
+
+
+def plain( r ):
+    
+    if isinstance( r, ( dict, easyprotocol.LazyRecord ) ) :
+        return dict( ( k, plain( v ) ) for k, v in r.items() )
+    
+    if isinstance( r, ( list, tuple ) ) :
+        return [ plain( v ) for v in r ]
+    
+    return r
+
+
+class BufferTest( unittest.TestCase ):
+    
+    def setUp( self ):
+        
+        self.ebp = makeprotocol()
+        self.expected = plain( self.ebp.read( 'tbl', cStringIO.StringIO( DATA ) ) )
+        
+        fd, self.fname = tempfile.mkstemp()
+        os.write( fd, DATA + DATA )
+        os.close( fd )
+        
+        self.fp = open( self.fname, 'rb' )
+    
+    def tearDown( self ):
+        
+        self.fp.close()
+        os.remove( self.fname )
+    
+    def buffers( self ):
+        
+        return [ DATA, buffer( DATA ), bytearray( DATA ), memoryview( DATA ),
+                 easyprotocol.BufferIO( DATA ),
+                 mmap.mmap( self.fp.fileno(), 0, access=mmap.ACCESS_READ ) ]
+    
+    def test_read( self ):
+        
+        for buf in self.buffers() :
+            self.assertEqual( plain( self.ebp.read( 'tbl', buf ) ), self.expected )
+    
+    def test_skim( self ):
+        
+        for buf in self.buffers() :
+            self.assertEqual( plain( self.ebp.skim( 'tbl', buf ) ), self.expected )
+    
+    def test_cursor( self ):
+        
+        fp = easyprotocol.BufferIO( DATA + DATA )
+        
+        self.assertEqual( plain( self.ebp.read( 'tbl', fp ) ), self.expected )
+        self.assertEqual( plain( self.ebp.skim( 'tbl', fp ) ), self.expected )
+        self.assertEqual( fp.tell(), len( DATA ) * 2 )
+        
+        # the mmap and the file go on after the record as a file
+        m = easyprotocol.mapfile( self.fp )
+        
+        self.assertEqual( plain( self.ebp.read( 'tbl', m ) ), self.expected )
+        self.assertEqual( m.tell(), len( DATA ) )
+        self.assertEqual( plain( self.ebp.skim( 'tbl', m ) ), self.expected )
+        self.assertEqual( m.tell(), len( DATA ) * 2 )
+        
+        m.close()
+        
+        self.assertEqual( plain( self.ebp.skim( 'tbl', self.fp ) ), self.expected )
+        self.assertEqual( self.fp.tell(), len( DATA ) )
+    
+    def test_mapfile( self ):
+        
+        m = easyprotocol.mapfile( self.fp )
+        
+        self.assertTrue( isinstance( m, mmap.mmap ) )
+        self.assertEqual( m[:], DATA + DATA )
+        
+        m.close()
+        
+        # not mapped, read as a file
+        io = cStringIO.StringIO( DATA )
+        
+        self.assertTrue( easyprotocol.mapfile( io ) is io )
+        self.assertEqual( plain( self.ebp.skim( 'tbl', io ) ), self.expected )
+        
+        empty = tempfile.TemporaryFile()
+        self.assertTrue( easyprotocol.mapfile( empty ) is empty )
+        empty.close()
+    
+    def test_truncated( self ):
+        
+        fp = easyprotocol.BufferIO( DATA[:10] )
+        
+        self.assertRaises( easyprotocol.ConnectionError, self.ebp.read, 'tbl', fp )
+        # the entries are unpacked at once after the head of 6 bytes
+        self.assertEqual( fp.need, 6 + 2 * 8 )
+        
+        self.assertRaises( easyprotocol.ConnectionError,
+                           self.ebp.read, 'tbl', cStringIO.StringIO( DATA[:10] ) )
+
+
+class ReadMultiTest( unittest.TestCase ):
+    
+    TYPES = ( easyprotocol.BuildinTypeUINT,
+              easyprotocol.BuildinTypeUINTB,
+              easyprotocol.BuildinTypeINTB )
+    
+    def items( self, lens ):
+        
+        # the bytes around the sign of each byteorder, then random ones
+        heads = [ '\x00', '\x01', '\x7e', '\x7f', '\x80', '\xfe', '\xff' ]
+        
+        items = [ h + '\xff' * ( lens - 1 ) for h in heads ] + \
+                [ h + '\x00' * ( lens - 1 ) for h in heads ] + \
+                [ '\xff' * ( lens - 1 ) + h for h in heads ] + \
+                [ '\x00' * ( lens - 1 ) + h for h in heads ]
+        
+        rnd = random.Random( lens )
+        items += [ ''.join( [ chr( rnd.randrange( 256 ) ) for i in range( lens ) ] )
+                   for j in range( 50 ) ]
+        
+        return [ item[:lens] for item in items ]
+    
+    def test_as_each( self ):
+        
+        for cls in self.TYPES :
+            
+            t = cls()
+            
+            for lens in ( 1, 2, 3, 4, 8 ) :
+                
+                data = ''.join( self.items( lens ) )
+                mlens = len( data ) / lens
+                
+                r, l = t.read_multi( {}, easyprotocol.BufferIO( data ), lens,
+                                     mlens, None )
+                each, le = easyprotocol.ProtocolType.read_multi(
+                               t, {}, easyprotocol.BufferIO( data ), lens,
+                               mlens, None )
+                
+                self.assertEqual( ( list( r ), l ), ( list( each ), le ),
+                                  ( t.name, lens ) )
+                self.assertEqual( l, len( data ) )
+    
+    def test_empty( self ):
+        
+        for cls in self.TYPES :
+            
+            r, l = cls().read_multi( {}, easyprotocol.BufferIO( '' ), 2, 0, None )
+            
+            self.assertEqual( ( list( r ), l ), ( [], 0 ) )
+    
+    def test_truncated( self ):
+        
+        for cls in self.TYPES :
+            
+            fp = easyprotocol.BufferIO( '\x00' * 7 )
+            
+            self.assertRaises( easyprotocol.ConnectionError,
+                               cls().read_multi, {}, fp, 2, 4, None )
+            self.assertEqual( fp.need, 8 )
+
+
+class CompiledTest( unittest.TestCase ):
+    
+    PROTOCOL = '''
+pkt PKT(.length)
+    
+    length  uint(1)
+    kind    uint(1)
+    body    BODY{kind}
+        1:num     int_b(2)
+        2:text    char[4]
+        *:raw     byte[2]
+    sign    int_b(2)[4]
+    wide    int_b(3)
+    point   POINT[2]
+        x       uint_b(2)
+        y       int_b(2)
+    mixed   MIXED[2]
+        a       uint(2)
+        b       int_b(1)
+    item    ITEM(3)
+        tag     char
+        name    char[auto]
+    rest    byte[auto]
+
+pts PTS(auto)
+    
+    n       uint(1)
+    point   POINTS[n]
+        x       uint_b(2)
+        y       int_b(2)
+
+wrd WRD(.length)
+    
+    length  uint(1)
+    words   uint_b(2)[auto]
+'''
+    
+    def setUp( self ):
+        
+        self.compiled = makeprotocol( self.PROTOCOL, True )
+        self.interpreted = makeprotocol( self.PROTOCOL, False )
+    
+    def pkt( self, kind, body, rest ):
+        
+        d = chr( kind ) + body + \
+            struct.pack( '>HHHH', 0x7eff, 0x7f00, 0xffff, 0x8000 ) + \
+            '\xff\x00\x01' + \
+            struct.pack( '>HHHH', 1, 0xfffe, 2, 0x7f00 ) + \
+            struct.pack( '<HBHB', 3, 0x7f, 4, 0x80 ) + \
+            'tab' + rest
+        
+        return chr( len(d) + 1 ) + d
+    
+    def read( self, name, data ):
+        
+        r = [ ebp.read( name, data ) for ebp in ( self.compiled, self.interpreted ) ]
+        
+        self.assertEqual( r[0], r[1] )
+        
+        return r[0]
+    
+    def assertSameError( self, name, data ):
+        
+        for ebp in ( self.compiled, self.interpreted ) :
+            self.assertRaises( easyprotocol.EasyBinaryProtocolError,
+                               ebp.read, name, data )
+    
+    def test_compiled( self ):
+        
+        self.assertFalse( hasattr( self.interpreted.namespaces['PKT'], 'source' ) )
+        self.assertTrue( hasattr( self.compiled.namespaces['PKT'], 'source' ) )
+        
+        # the arrays of the structs of fixed length are read by one struct
+        self.assertTrue( hasattr( self.compiled.namespaces['POINT'], 'multisource' ) )
+        self.assertTrue( hasattr( self.compiled.namespaces['MIXED'], 'multisource' ) )
+    
+    def test_struct( self ):
+        
+        r = self.read( 'pkt', self.pkt( 1, '\xff\xfe', 'REST' ) )
+        
+        self.assertEqual( r['sign'], ( 0x7eff, 0x7f00 - 0x10000, -1, -0x8000 ) )
+        self.assertEqual( r['wide'], 0xff0001 - 0x1000000 )
+        self.assertEqual( r['point'], ( { 'x' : 1, 'y' : -2 },
+                                        { 'x' : 2, 'y' : 0x7f00 - 0x10000 } ) )
+        self.assertEqual( [ m['a'] for m in r['mixed'] ], [ 3, 4 ] )
+        self.assertEqual( r['item'], { 'tag' : 't', 'name' : 'ab' } )
+        self.assertEqual( r['rest'], 'REST' )
+    
+    def test_union( self ):
+        
+        self.assertEqual( self.read( 'pkt', self.pkt( 1, '\xff\xfe', '' ) )['body'],
+                          { 'num' : -2 } )
+        self.assertEqual( self.read( 'pkt', self.pkt( 2, 'wxyz', '' ) )['body'],
+                          { 'text' : 'wxyz' } )
+        self.assertEqual( self.read( 'pkt', self.pkt( 9, 'zz', 'R' ) )['body'],
+                          { 'raw' : 'zz' } )
+    
+    def test_auto_length( self ):
+        
+        self.assertEqual( self.read( 'wrd', '\x05\x00\x01\xff\xff' )['words'],
+                          ( 1, 0xffff ) )
+        self.assertEqual( self.read( 'wrd', '\x01' )['words'], [] )
+        
+        self.assertSameError( 'wrd', '\x04\x00\x01\xff' )
+    
+    def test_struct_arrays( self ):
+        
+        self.assertEqual( self.read( 'pts', '\x00' )['point'], [] )
+        
+        r = self.read( 'pts', '\x03' + struct.pack( '>HHHHHH', 1, 2, 3, 0x7f00,
+                                                     0xffff, 0xffff ) )
+        
+        self.assertEqual( r['point'], ( { 'x' : 1, 'y' : 2 },
+                                        { 'x' : 3, 'y' : 0x7f00 - 0x10000 },
+                                        { 'x' : 0xffff, 'y' : -1 } ) )
+        
+        self.assertSameError( 'pts', '\x03' + struct.pack( '>HHHH', 1, 2, 3, 4 ) )
+
+
+class StreamParserTest( unittest.TestCase ):
+    
+    NAMES = [ 'a', '', 'bcd', 'efghij' ]
+    
+    def setUp( self ):
+        
+        self.ebp = makeprotocol()
+        self.data = ''.join( [ chr( len(n) ) + n for n in self.NAMES ] )
+    
+    def parse( self, n ):
+        
+        p = easyprotocol.StreamParser( self.ebp, 'msg' )
+        
+        r = []
+        for i in range( 0, len( self.data ), n ) :
+            r.extend( p.feed( self.data[i:i+n] ) )
+        
+        p.close()
+        
+        return [ m['name'] for m in r ]
+    
+    def test_chunks( self ):
+        
+        for n in ( 1, 2, 3, 5, len( self.data ) ) :
+            self.assertEqual( self.parse( n ), self.NAMES )
+    
+    def test_pending( self ):
+        
+        p = easyprotocol.StreamParser( self.ebp, 'msg' )
+        
+        self.assertEqual( p.feed( '\x03ab' ), [] )
+        self.assertEqual( p.pending(), 3 )
+        self.assertEqual( p.feed( '' ), [] )
+        
+        self.assertRaises( easyprotocol.ConnectionError, p.close )
+        
+        self.assertEqual( [ m['name'] for m in p.feed( 'c\x01' ) ], [ 'abc' ] )
+        self.assertEqual( p.pending(), 1 )
+        
+        self.assertEqual( [ m['name'] for m in p.feed( 'd' ) ], [ 'd' ] )
+        self.assertEqual( p.pending(), 0 )
+        
+        p.close()
+
+
+if __name__ == '__main__' :
+    unittest.main()
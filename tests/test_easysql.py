@@ -0,0 +1,1164 @@
+#
+# tests of easysql, run without mysql on the fake MySQLdb of easysqlbench
+#
+#   python -m unittest discover -s tests
+#
+
+import os
+import re
+import sys
+import time
+import threading
+import unittest
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath(__file__) ),
+                                  '..', 'src' ) )
+
+import easysqlbench
+import easysql
+import easymc
+
+
+def maketable( rows, nshards=1 ):
+    
+    return easysqlbench.maketable( nshards, rows )
+
+
+def countqueries( t ):
+    
+    queries = []
+    respond = t.connpool.responder
+    t.connpool.responder = lambda sql : queries.append( sql ) or respond( sql )
+    
+    return queries
+
+
+ROW = { 'ID' : 1, 'name' : 'a', 'kind' : 0, 'data' : '{}', 'flag' : 0 }
+
+
+class ReplicaBalancerTest( unittest.TestCase ):
+    
+    def setUp( self ):
+        
+        self.tablets = tuple( [ easysql.Tablet( 'r%d' % i,
+                                    ( 'fake', 3306 + i, 'user', 'passwd', 'db' ),
+                                    easysqlbench.COLS, ['ID',] )
+                                for i in range( 2 ) ] )
+        self.t0, self.t1 = self.tablets
+        
+        self.b = easysql.ReplicaBalancer( failthreshold=2, cooldown=0.05 )
+    
+    def query( self, t, elapsed=None, failed=False ):
+        
+        self.b.begin( t )
+        self.b.end( t, elapsed, failed )
+    
+    def choose( self, n=20, wrt=False ):
+        
+        return set( [ self.b.choose( self.tablets, wrt ) for i in range( n ) ] )
+    
+    def test_choose_cheaper( self ):
+        
+        self.query( self.t0, 1.0 )
+        self.query( self.t1, 0.01 )
+        
+        self.assertEqual( self.choose(), set( [ self.t1 ] ) )
+    
+    def test_circuit_open( self ):
+        
+        self.query( self.t0, failed=True )
+        
+        self.assertEqual( self.b.getstats()['r0@fake:3306']['state'], 'closed' )
+        
+        self.query( self.t0, failed=True )
+        
+        self.assertEqual( self.b.getstats()['r0@fake:3306']['state'], 'open' )
+        self.assertEqual( self.choose(), set( [ self.t1 ] ) )
+    
+    def test_half_open( self ):
+        
+        self.query( self.t1, 0.01 )
+        self.query( self.t0, failed=True )
+        self.query( self.t0, failed=True )
+        
+        time.sleep( 0.06 )
+        
+        # one read tries it, the others keep away while it runs
+        self.assertEqual( self.b.choose( self.tablets ), self.t0 )
+        self.assertEqual( self.choose(), set( [ self.t1 ] ) )
+        
+        self.query( self.t0, 0.01 )
+        
+        self.assertEqual( self.b.getstats()['r0@fake:3306']['state'], 'closed' )
+        self.assertEqual( self.b.getstats()['r0@fake:3306']['fails'], 0 )
+    
+    def test_sticky_primary( self ):
+        
+        self.query( self.t0, 1.0 )
+        self.query( self.t1, 0.01 )
+        
+        self.assertEqual( self.choose( wrt=True ), set( [ self.t0 ] ) )
+        
+        self.query( self.t0, failed=True )
+        self.query( self.t0, failed=True )
+        
+        self.assertEqual( self.choose( wrt=True ), set( [ self.t1 ] ) )
+        
+        # the writes stay on the new primary after the old one is back
+        time.sleep( 0.06 )
+        self.query( self.t0, 0.01 )
+        
+        self.assertEqual( self.choose( wrt=True ), set( [ self.t1 ] ) )
+    
+    def test_query_errors_not_failures( self ):
+        
+        t = maketable( [ ROW, ] )
+        t.setbalancer( self.b )
+        
+        def fail( tablet, code ):
+            raise easysql.MySQLdb.OperationalError( code, 'error' )
+        
+        for code in ( 1205, 1213, 2006 ) :
+            self.assertRaises( easysql.MySQLdb.OperationalError,
+                               t._tabletcall, ( self.t0, ), True, fail, code )
+        
+        self.assertEqual( self.b.getstats()['r0@fake:3306']['failures'], 1 )
+    
+    def test_iter_and_asquery_counted( self ):
+        
+        t = maketable( [ ROW, ] )
+        t.setbalancer( self.b )
+        
+        list( t.iter( { 'flag' : 0 } ) )
+        t.asquery( 'SELECT %(<cols>)s FROM %(<tablename>)s' )( {} )
+        
+        self.assertEqual( self.b.getstats().values()[0]['queries'], 2 )
+
+
+class RouterTest( unittest.TestCase ):
+    
+    def test_range_names_read_once( self ):
+        
+        t = maketable( [ ROW, ], 2 )
+        t.setrouter( easysql.RangeTable( [ 10, 20 ], [ 'bench0', 'bench1', 'bench0' ] ),
+                     'ID' )
+        
+        queries = countqueries( t )
+        
+        self.assertEqual( len( t.gets( { 'flag' : 0 } ) ), 2 )
+        self.assertEqual( len( queries ), 2 )
+    
+    def test_route_by_key( self ):
+        
+        t = maketable( [ ROW, ], 2 )
+        t.setrouter( easysql.RangeTable( [ 10 ], [ 'bench0', 'bench1' ] ), 'ID' )
+        
+        queries = countqueries( t )
+        
+        t.gets( { 'ID' : 15 } )
+        
+        self.assertEqual( len( queries ), 1 )
+        self.assertTrue( '`bench1`' in queries[0] )
+    
+    def test_range_value_types( self ):
+        
+        rt = easysql.RangeTable( [ 10, 20 ], [ 's0', 's1', 's2' ] )
+        
+        self.assertEqual( rt.route( '5' ), 's0' )
+        self.assertEqual( rt.route( u'15' ), 's1' )
+        self.assertEqual( rt.route( 15L ), 's1' )
+        self.assertEqual( rt.route( 20.0 ), 's2' )
+        self.assertEqual( rt.route_many( [ '5', 15, '25' ] ), [ 's0', 's1', 's2' ] )
+        
+        self.assertRaises( TypeError, rt.route, 'abc' )
+        self.assertRaises( TypeError, rt.route_many, [ 5, '5.5' ] )
+        self.assertRaises( TypeError, rt.addname, '3x', 's3' )
+        
+        rt.addname( '30', 's3' )
+        self.assertEqual( rt.route( 100 ), 's3' )
+        
+        rt = easysql.RangeTable( [ 'm' ], [ 's0', 's1' ] )
+        
+        self.assertEqual( rt.route_many( [ 'a', u'z' ] ), [ 's0', 's1' ] )
+        self.assertRaises( TypeError, rt.route, 5 )
+        
+        self.assertRaises( TypeError, easysql.RangeTable, [ 5, 'm' ], [ 's0', 's1', 's2' ] )
+    
+    def test_route_key_of_str( self ):
+        
+        t = maketable( [ ROW, ], 2 )
+        t.setrouter( easysql.RangeTable( [ 10 ], [ 'bench0', 'bench1' ] ), 'ID' )
+        
+        queries = countqueries( t )
+        
+        t.gets( { 'ID' : '5' } )
+        
+        self.assertEqual( len( queries ), 1 )
+        self.assertTrue( '`bench0`' in queries[0] )
+    
+    def test_asquery_after_addtablet( self ):
+        
+        t = maketable( [ ROW, ], 2 )
+        
+        q = t.asquery( 'SELECT %(<cols>)s FROM %(<tablename>)s WHERE `ID`=%(ID)s',
+                       multi=True )
+        
+        self.assertEqual( len( q( { 'ID' : 1 } ) ), 2 )
+        
+        t.addtablet( easysql.Tablet( 'bench2',
+                                     ( 'fake', 3306, 'user', 'passwd', 'db2' ),
+                                     easysqlbench.COLS, ['ID',] ) )
+        t.router.addname( 'bench2' )
+        
+        self.assertEqual( len( q( { 'ID' : 1 } ) ), 3 )
+        self.assertEqual( map( len, q.many( [ { 'ID' : 1 }, { 'ID' : 2 } ] ) ),
+                          [ 3, 3 ] )
+
+
+class SQLTemplateCacheTest( unittest.TestCase ):
+    
+    def test_pages_share_template( self ):
+        
+        tbl = maketable( [] ).tablets[0]
+        tbl.sqlcache = easysql.SQLTemplateCache()
+        
+        sqls = [ tbl._select_sql( { 'flag' : '1' }, [], ['ID'], limit, offset )
+                 for limit, offset in ( ( 10, None ), ( 10, 20 ), ( 10, 30 ),
+                                        ( 5, 30 ), ( 10, 20 ) ) ]
+        
+        self.assertEqual( [ re.sub( '\\s+', ' ', sql ).split( '`flag`=1 ' )[1]
+                            for sql in sqls ],
+                          [ 'LIMIT 10 ', 'LIMIT 10 OFFSET 20', 'LIMIT 10 OFFSET 30',
+                            'LIMIT 5 OFFSET 30', 'LIMIT 10 OFFSET 20' ] )
+        
+        s = tbl.sqlcache.getstats()
+        
+        # one template without offset and one with it
+        self.assertEqual( ( s['size'], s['misses'], s['hits'] ), ( 2, 2, 3 ) )
+        
+        # an offset without a limit is dropped as before
+        self.assertEqual( tbl._select_sql( { 'flag' : '1' }, [], ['ID'], None, 20 ),
+                          tbl._select_sql( { 'flag' : '1' }, [], ['ID'] ) )
+    
+    def test_limit_not_injected( self ):
+        
+        tbl = maketable( [] ).tablets[0]
+        
+        self.assertRaises( TypeError, tbl._select_sql, None, [], ['ID'], '1; DROP' )
+
+
+class CompiledQueryTest( unittest.TestCase ):
+    
+    def test_splitter_not_memoized( self ):
+        
+        t = maketable( [ ROW, ], 2 )
+        t.setrouter( None, None )
+        
+        names = [ 'bench0', 'bench1' ]
+        t.splitter_ex = lambda row, oper : [ ( names.pop(0), None, None ) ]
+        
+        queries = countqueries( t )
+        
+        q = t.asquery( 'SELECT %(<cols>)s FROM %(<tablename>)s WHERE `ID`=%(ID)s' )
+        q( { 'ID' : 1 }, { 'ID' : 1 } )
+        q( { 'ID' : 1 }, { 'ID' : 1 } )
+        
+        self.assertTrue( '`bench0`' in queries[0] )
+        self.assertTrue( '`bench1`' in queries[1] )
+
+
+class PageTest( unittest.TestCase ):
+    
+    def setUp( self ):
+        
+        # flag repeats, the pages of 2 rows end inside the ties
+        self.rows = [ dict( ROW, ID=i, flag=f )
+                      for i, f in enumerate( [ 0, 0, 0, 1, 1, 1, 2 ] ) ]
+        
+        self.t = maketable( [] )
+        self.t.connpool.responder = self.respond
+    
+    def respond( self, sql ):
+        
+        rows = sorted( self.rows, key=lambda r : ( r['flag'], r['ID'] ) )
+        
+        m = re.search( r"\(`flag`>'(\d+)'\) OR \(`flag`='\d+' AND `ID`>'(\d+)'\)", sql )
+        if m :
+            last = ( int( m.group(1) ), int( m.group(2) ) )
+            rows = [ r for r in rows if ( r['flag'], r['ID'] ) > last ]
+        
+        rows = rows[:int( re.search( r'LIMIT (\d+)', sql ).group(1) )]
+        
+        cols = re.findall( '`(\\w+)`', sql.split( ' FROM ', 1 )[0] )
+        
+        return [ tuple( [ r[c] for c in cols ] ) for r in rows ]
+    
+    def test_ties_not_skipped( self ):
+        
+        ids = []
+        token = None
+        
+        while True :
+            rows, token = self.t.page( None, 'flag', 2, token )
+            ids.extend( [ r['ID'] for r in rows ] )
+            if token == None :
+                break
+        
+        self.assertEqual( ids, range( len( self.rows ) ) )
+    
+    def test_order_cols_dropped( self ):
+        
+        rows, token = self.t.page( None, 'flag', 2, keys=['name'] )
+        
+        self.assertEqual( [ r.keys() for r in rows ], [ ['name'], ['name'] ] )
+    
+    def test_token_of_another_query( self ):
+        
+        rows, token = self.t.page( None, 'flag', 2 )
+        
+        self.assertEqual( [ r['ID'] for r in rows ], [ 0, 1 ] )
+        self.assertRaises( easysql.TypeError, self.t.page, None, 'ID', 2, token )
+
+
+class GetManyTest( unittest.TestCase ):
+    
+    def test_keys_of_other_types( self ):
+        
+        # the server answers 1.0 and a Decimal for the integers asked
+        t = maketable( [ dict( ROW, ID=1.0 ),
+                         dict( ROW, ID=easysql.decimal.Decimal('2.00') ) ] )
+        
+        rows = t.get_many( [ { 'ID' : 2 }, { 'ID' : 1L }, { 'ID' : 3 } ],
+                           default=None )
+        
+        self.assertEqual( [ r and int( r['ID'] ) for r in rows ], [ 2, 1, None ] )
+    
+    def test_keys_of_other_case( self ):
+        
+        t = maketable( [ dict( ROW, name='Abc ' ), dict( ROW, ID=2, name='abc' ) ] )
+        t.setcasefold( True )
+        
+        rows = t.get_many( [ { 'name' : 'abc' }, { 'name' : u'ABC' } ],
+                           default=None )
+        
+        # the exact value first, then one equal by the collation
+        self.assertEqual( rows[0]['ID'], 2 )
+        self.assertNotEqual( rows[1], None )
+        
+        t = maketable( [ dict( ROW, name='Abc ' ) ] )
+        t.setcasefold( True )
+        
+        rows = t.get_many( [ { 'name' : 'abc' } ], default=None )
+        
+        self.assertEqual( [ r['name'] for r in rows ], [ 'Abc ' ] )
+    
+    def test_keys_of_binary_collation( self ):
+        
+        t = maketable( [ dict( ROW, name='abc' ) ] )
+        
+        rows = t.get_many( [ { 'name' : 'ABC' }, { 'name' : 'abc' } ],
+                           default=None )
+        
+        self.assertEqual( [ r and r['name'] for r in rows ], [ None, 'abc' ] )
+    
+    def test_key_out_of_defaultcols( self ):
+        
+        cols = easysqlbench.COLS + [ '_seq' ]
+        
+        t = easysql.Table( [ easysql.Tablet( 'bench0',
+                                 ( 'fake', 3306, 'user', 'passwd', 'db0' ),
+                                 cols, ['ID',] ) ], 'bench',
+                           easysqlbench.FakeConnectionPool(
+                               responder = easysqlbench.responder(
+                                   [ dict( ROW, _seq=7 ), dict( ROW, ID=2, _seq=8 ) ] ) ) )
+        
+        rows = t.get_many( [ { '_seq' : 8 }, { '_seq' : 9 }, { '_seq' : 7 } ],
+                           default=None )
+        
+        self.assertEqual( [ r and r['ID'] for r in rows ], [ 2, None, 1 ] )
+        self.assertFalse( '_seq' in rows[0] )
+
+
+class FanoutTest( unittest.TestCase ):
+    
+    def maketable( self, nshards, n, wait=None ):
+        
+        t = maketable( [], nshards )
+        
+        responds = dict( ( tbl.name, easysqlbench.responder( t._encoderows(
+                             [ dict( r, ID=i*n+r['ID'] )
+                               for r in easysqlbench.makerows( n ) ] ) ) )
+                         for i, tbl in enumerate( t.tablets ) )
+        
+        queries = []
+        
+        def respond( sql ):
+            
+            # the tablets after the first one wait for the event
+            if wait != None and queries :
+                queries.append( sql )
+                wait.wait( 5 )
+            else :
+                queries.append( sql )
+            
+            r = responds[ re.search( 'FROM `(\\w+)`', sql ).group( 1 ) ]( sql )
+            limit = re.search( 'LIMIT (\\d+)$', sql )
+            
+            return r[:int( limit.group( 1 ) )] if limit else r
+        
+        t.connpool.responder = respond
+        
+        return t, queries
+    
+    def test_as_serial( self ):
+        
+        t, queries = self.maketable( 4, 3 )
+        
+        for limit in ( None, 1, 3, 4, 7, 12, 20 ) :
+            
+            t.setfanout( None )
+            serial = t.gets( { 'flag' : 1 }, limit=limit )
+            
+            t.setfanout( 4 )
+            self.assertEqual( t.gets( { 'flag' : 1 }, limit=limit ), serial )
+            
+            self.assertEqual( len( serial ), min( limit or 12, 12 ) )
+        
+        t.setfanout( None )
+    
+    def test_enough( self ):
+        
+        wait = threading.Event()
+        t, queries = self.maketable( 4, 3, wait )
+        
+        pool = easysql.QueryThreadPool( 1 )
+        t.setfanout( pool )
+        
+        rows = t.gets( { 'flag' : 1 }, limit=3 )
+        wait.set()
+        pool.close()
+        
+        self.assertEqual( [ r['ID'] for r in rows ], [ 0, 1, 2 ] )
+        
+        # the tablets not started when the first satisfied the limit are
+        # cancelled, the second may be running already
+        self.assertTrue( len( queries ) <= 2 )
+    
+    def test_close( self ):
+        
+        pool = easysql.QueryThreadPool( 3 )
+        
+        self.assertEqual( pool.map( lambda x : x * 2, [ (1,), (2,) ] ), [ 2, 4 ] )
+        
+        pool.close()
+        
+        self.assertEqual( [ th.isAlive() for th in pool.ts ], [ False ] * 3 )
+        self.assertRaises( easysql.EasySqlException, pool.map, len, [ ('a',) ] )
+        self.assertRaises( easysql.EasySqlException, pool.submit, len, 'a' )
+    
+    def test_setfanout_closes_own_pool( self ):
+        
+        t = maketable( [], 2 )
+        
+        t.setfanout( 2 )
+        own = t.querypool
+        
+        shared = easysql.QueryThreadPool( 2 )
+        t.setfanout( shared )
+        
+        self.assertTrue( own.closed )
+        self.assertEqual( [ th.isAlive() for th in own.ts ], [ False ] * 2 )
+        
+        t.setfanout( None )
+        
+        self.assertFalse( shared.closed )
+        shared.close()
+
+
+class AsyncTest( unittest.TestCase ):
+    
+    def setUp( self ):
+        
+        self.pools = []
+    
+    def tearDown( self ):
+        
+        for pool in self.pools :
+            pool.close()
+    
+    def makepool( self, connpool ):
+        
+        pool = easysql.AsyncConnectionPool( 2, connpool )
+        self.pools.append( pool )
+        
+        return pool
+    
+    def maketable( self, n, pool=True ):
+        
+        t = maketable( [] )
+        t.connpool.responder = easysqlbench.responder(
+                                   t._encoderows( easysqlbench.makerows( n ) ) )
+        
+        return easysql.AsyncTable( t, self.makepool( t.connpool ) if pool else None )
+    
+    def test_get( self ):
+        
+        t = self.maketable( 1 )
+        
+        called = []
+        done = threading.Event()
+        
+        f = t.get( { 'ID' : 0 } )
+        f.add_done_callback( lambda f : called.append( f ) or done.set() )
+        
+        self.assertEqual( f.result( 5 ), easysqlbench.makerows( 1 )[0] )
+        
+        # the callback runs in the thread after the result is set
+        done.wait( 5 )
+        self.assertEqual( called, [ f ] )
+    
+    def test_exception( self ):
+        
+        f = self.maketable( 0 ).get( { 'ID' : 0 } )
+        
+        self.assertRaises( easysql.NotFoundError, f.result, 5 )
+        self.assertTrue( isinstance( f.exception(), easysql.NotFoundError ) )
+    
+    def test_iter( self ):
+        
+        stream = self.maketable( 5 ).iter( { 'flag' : 1 }, batch=2 )
+        
+        self.assertEqual( [ len( stream.fetch().result( 5 ) ) for i in range( 4 ) ],
+                          [ 2, 2, 1, 0 ] )
+        
+        stream.close().result( 5 )
+    
+    def test_pool( self ):
+        
+        pool = self.makepool(
+                   easysqlbench.FakeConnectionPool( responder=lambda sql : [ (1,) ] ) )
+        
+        conn_args = ( 'fake', 3306, 'user', 'passwd', 'db' )
+        
+        fs = [ pool.read( conn_args, 'SELECT 1' ) for i in range( 4 ) ]
+        
+        self.assertEqual( [ list( f.result( 5 ) ) for f in fs ], [ [ (1,) ] ] * 4 )
+        self.assertEqual( pool.writemany( conn_args, [ 'DELETE FROM `t`' ] ).result( 5 ),
+                          [ ( 1, None, None ) ] )
+    
+    def test_close( self ):
+        
+        pool = self.makepool( None )
+        f = pool.submit( time.sleep, 0.05 )
+        
+        pool.close()
+        
+        # the queries queued are done before the threads stop
+        self.assertTrue( f.done() )
+        self.assertTrue( pool.closed )
+        self.assertEqual( [ th.isAlive() for th in pool.querypool.ts ], [ False ] * 2 )
+        self.assertRaises( easysql.EasySqlException, pool.submit, len, 'a' )
+    
+    def test_shared_pool( self ):
+        
+        n = threading.activeCount()
+        
+        ts = [ self.maketable( 1, pool=False ) for i in range( 4 ) ]
+        
+        self.assertEqual( set( [ id( t.pool ) for t in ts ] ), set( [ id( ts[0].pool ) ] ) )
+        self.assertTrue( threading.activeCount() <= n + 16 )
+        
+        self.assertEqual( [ t.get( { 'ID' : 0 } ).result( 5 )['ID'] for t in ts ],
+                          [ 0 ] * 4 )
+        
+        # a closed shared pool is made again
+        ts[0].pool.close()
+        t = self.maketable( 1, pool=False )
+        
+        self.assertFalse( t.pool.closed )
+        self.assertEqual( t.get( { 'ID' : 0 } ).result( 5 )['ID'], 0 )
+        
+        t.pool.close()
+
+
+class SchemaTest( unittest.TestCase ):
+    
+    CONN_ARGS = ( 'localhost', 3306, 'user', '', 'db' )
+    
+    def setUp( self ):
+        
+        self.queries = []
+        self.pool = easysqlbench.FakeConnectionPool( responder=self.respond )
+    
+    def respond( self, sql ):
+        
+        self.queries.append( sql )
+        
+        if sql.startswith( 'SHOW FULL TABLES' ) :
+            return [ ( 'users', 'BASE TABLE' ), ( 'groups', 'BASE TABLE' ) ]
+        
+        return [ ( 'ID', 'bigint(20)', 'NO', 'PRI', None, '' ),
+                 ( 'name', 'varchar(64)', 'NO', '', None, '' ) ]
+    
+    def describes( self ):
+        
+        return [ q.split( '.' )[-1] for q in self.queries
+                 if q.startswith( 'DESCRIBE' ) ]
+    
+    def test_maketables_describes_the_table_named( self ):
+        
+        tables = easysql.maketables( *self.CONN_ARGS, tablename='groups',
+                                     connpool=self.pool )
+        
+        self.assertEqual( [ t.name for t in tables ], [ 'groups' ] )
+        self.assertEqual( self.describes(), [ '`groups`' ] )
+    
+    def test_makedatabase_describes_on_access( self ):
+        
+        db = easysql.makedatabase( *self.CONN_ARGS, connpool=self.pool )
+        
+        self.assertEqual( sorted( db.keys() ), [ 'groups', 'users' ] )
+        self.assertEqual( self.describes(), [] )
+        
+        self.assertEqual( db.users.name, 'users' )
+        self.assertEqual( db.users.tablets[0].keys, [ 'ID' ] )
+        self.assertEqual( self.describes(), [ '`users`' ] )
+
+
+class BufferedWriterTest( unittest.TestCase ):
+    
+    def test_close_while_waiting( self ):
+        
+        gate = threading.Event()
+        
+        w = easysql.BufferedWriter( maketable( [] ), maxrows=1, maxdelay=0.01,
+                                    maxpending=1 )
+        w._writetablet = lambda tbl, rows : gate.wait( 5 ) or True
+        w.append( easysqlbench.makerows( 1 )[0] )
+        
+        errors = []
+        
+        def append():
+            try :
+                w.append( easysqlbench.makerows( 1 )[0] )
+            except easysql.EasySqlException, e :
+                errors.append( e )
+        
+        appender = threading.Thread( target=append )
+        appender.start()
+        
+        while w.getstats()['waits'] == 0 :
+            time.sleep( 0.001 )
+        
+        closer = threading.Thread( target=w.close )
+        closer.start()
+        
+        appender.join( 5 )
+        gate.set()
+        closer.join( 5 )
+        
+        self.assertEqual( len( errors ), 1 )
+        self.assertEqual( w.getstats()['appended'], 1 )
+        self.assertEqual( w.getstats()['pending'], 0 )
+        self.assertRaises( easysql.EasySqlException, w.append, ROW )
+
+
+class BrokenConnection( easysqlbench.FakeConnection ):
+    
+    def query( self, sql ):
+        
+        raise easysql.MySQLdb.OperationalError( 2006, 'gone away' )
+
+
+class FakeConnectionTest( unittest.TestCase ):
+    
+    CONN_ARGS = ( 'fake', 3306, 'user', 'passwd', 'db0' )
+    
+    def test_update( self ):
+        
+        t = maketable( [ ROW, ] )
+        
+        t.set( { 'ID' : 1 }, { 'flag' : 1 } )
+        
+        self.assertEqual( t.sets( { 'flag' : 0 }, { 'flag' : 1 }, 10 ), 1 )
+    
+    def test_union( self ):
+        
+        rows = [ ROW, dict( ROW, ID=2 ) ]
+        queries = []
+        
+        def respond( sql ):
+            queries.append( sql )
+            i = int( re.search( r"`ID`='(\d+)'", sql ).group(1) )
+            return [ ( r['ID'], r['name'] ) for r in rows if r['ID'] == i ]
+        
+        t = maketable( [] )
+        t.connpool.responder = respond
+        
+        q = t.asquery( 'SELECT %(<cols>)s FROM %(<tablename>)s WHERE `ID`=%(ID)s',
+                       cols=[ 'ID', 'name' ] )
+        
+        got = q.many( [ { 'ID' : 2 }, { 'ID' : 3 }, { 'ID' : 1 } ], default=None )
+        
+        # the parts of UNION ALL are answered one by one without the tag
+        self.assertEqual( len( queries ), 3 )
+        self.assertFalse( any( [ '`_n`' in sql for sql in queries ] ) )
+        self.assertEqual( [ r and r['ID'] for r in got ], [ 2, None, 1 ] )
+    
+    def test_pipelined_results( self ):
+        
+        pool = easysqlbench.FakeConnectionPool()
+        
+        rs = pool.writemany( self.CONN_ARGS,
+                             [ "INSERT INTO `t` (`a`) VALUES ('1;'),('2')",
+                               "INSERT INTO `t` (`a`) VALUES (3)",
+                               "UPDATE `t` SET `a`=4 WHERE `a`=3" ] )
+        
+        self.assertEqual( rs, [ ( 2, None, { 'Records' : 2, 'Duplicates' : 0,
+                                             'Warnings' : 0 } ),
+                                ( 1, None, None ),
+                                ( 1, None, { 'Rows matched' : 1, 'Changed' : 1,
+                                             'Warnings' : 0 } ) ] )
+    
+    def test_read_after_presql( self ):
+        
+        pool = easysqlbench.FakeConnectionPool( responder=lambda sql : [ (1,) ] )
+        
+        self.assertEqual( list( pool.read( self.CONN_ARGS, 'SELECT @a',
+                                           presql='SET @a=1' ) ), [ (1,) ] )
+
+
+class PipelinedConnection( easysqlbench.FakeConnection ):
+    '''
+    logs the queries, the connection is lost after the results of lose
+    statements are read
+    '''
+    
+    def __init__( self, log, lose=None ):
+        
+        easysqlbench.FakeConnection.__init__( self )
+        
+        self.log = log
+        self.lose = lose
+        self.read = 0
+    
+    def query( self, sql ):
+        
+        self.log.append( sql )
+        self.read = 1
+        
+        easysqlbench.FakeConnection.query( self, sql )
+    
+    def next_result( self ):
+        
+        if self.statements != [] and self.lose != None and \
+           self.read >= self.lose :
+            raise easysql.MySQLdb.OperationalError( 2006, 'gone away' )
+        
+        self.read += 1
+        
+        return easysqlbench.FakeConnection.next_result( self )
+
+
+class PipelineTest( unittest.TestCase ):
+    
+    def setUp( self ):
+        
+        self.t = maketable( [] )
+        self.log = []
+        self.conns = []
+        self.refuse = 0
+        
+        self.t.connpool._connect = self.connect
+    
+    def connect( self, conn_args ):
+        
+        if self.conns :
+            return self.conns.pop(0)
+        
+        if self.refuse :
+            self.refuse -= 1
+            raise easysql.MySQLdb.OperationalError( 2003, 'refused' )
+        
+        return PipelinedConnection( self.log )
+    
+    def rows( self, n ):
+        
+        return easysqlbench.makerows( n )
+    
+    def test_chunkrows_not_pipelined( self ):
+        
+        self.t.setchunk( 3 )
+        
+        self.assertEqual( self.t.extend( self.rows( 10 ) ), 10 )
+        self.assertEqual( [ q.count( 'INSERT' ) for q in self.log ],
+                          [ 1, 1, 1, 1 ] )
+    
+    def test_chunkbytes_pipelined( self ):
+        
+        self.t.setchunk( 3, 1 << 20 )
+        
+        self.assertEqual( self.t.extend( self.rows( 10 ) ), 10 )
+        self.assertEqual( [ q.count( 'INSERT' ) for q in self.log ], [ 4 ] )
+    
+    def test_retry_not_done( self ):
+        
+        self.conns = [ PipelinedConnection( self.log, lose=2 ) ]
+        self.t.setchunk( 3, 1 << 20 )
+        
+        self.assertEqual( self.t.extend( self.rows( 10 ) ), 10 )
+        self.assertEqual( [ q.count( 'INSERT' ) for q in self.log ], [ 4, 2 ] )
+    
+    def test_retry_after_connection_error( self ):
+        
+        # the connection lost after 3 sqls can not be made again at once,
+        # the table runs the last one
+        self.conns = [ PipelinedConnection( self.log, lose=3 ) ]
+        self.refuse = 1
+        self.t.setchunk( 3, 1 << 20 )
+        
+        self.assertEqual( self.t.extend( self.rows( 10 ) ), 10 )
+        self.assertEqual( [ q.count( 'INSERT' ) for q in self.log ], [ 4, 1 ] )
+
+
+class ConnectionPoolTest( unittest.TestCase ):
+    
+    CONN_ARGS = ( 'fake', 3306, 'user', 'passwd', 'db' )
+    
+    def makepool( self, **kwargs ):
+        
+        return easysqlbench.FakeConnectionPool( responder=lambda sql : [ (1,) ],
+                                                **kwargs )
+    
+    def waitfor( self, pool, cond ):
+        
+        deadline = time.time() + 5
+        while not cond() and time.time() < deadline :
+            time.sleep( 0.01 )
+        
+        return cond()
+    
+    def test_exhausted( self ):
+        
+        pool = self.makepool( maxconnections=2, waittimeout=0.05 )
+        
+        conns = [ pool._get( self.CONN_ARGS, False ) for i in range( 2 ) ]
+        
+        t = time.time()
+        self.assertRaises( easysql.ConnectionError,
+                           pool._get, self.CONN_ARGS, False )
+        self.assertTrue( time.time() - t >= 0.05 )
+        
+        s = pool.getstats()
+        
+        self.assertEqual( ( s['waits'], s['waittimeouts'], s['creations'] ),
+                          ( 1, 1, 2 ) )
+        self.assertEqual( s['backends'].values(), [ { 'opened' : 2, 'idle' : 0 } ] )
+        
+        pool._put( self.CONN_ARGS, False, conns[0] )
+        
+        # the idle one is taken instead of a new one
+        self.assertTrue( pool._get( self.CONN_ARGS, False ) is conns[0] )
+    
+    def test_wait_for_putback( self ):
+        
+        pool = self.makepool( maxconnections=1 )
+        pool.waitinterval = 0.01
+        
+        timeouts = []
+        wait = pool.lock.wait
+        pool.lock.wait = lambda timeout=None : timeouts.append( timeout ) or wait( timeout )
+        
+        conn = pool._get( self.CONN_ARGS, False )
+        
+        got = []
+        th = threading.Thread( target=lambda : got.append(
+                                   pool._get( self.CONN_ARGS, False ) ) )
+        th.setDaemon( True )
+        th.start()
+        
+        # waits without waittimeout, but never without a timeout
+        self.assertTrue( self.waitfor( pool, lambda : len( timeouts ) > 3 ) )
+        self.assertFalse( None in timeouts )
+        self.assertEqual( got, [] )
+        
+        pool._put( self.CONN_ARGS, False, conn )
+        th.join( 5 )
+        
+        self.assertEqual( got, [ conn ] )
+        self.assertEqual( pool.getstats()['waittimeouts'], 0 )
+    
+    def test_idle_reaped( self ):
+        
+        pool = self.makepool( maxconnections=2, idletimeout=0.05 )
+        
+        conns = [ pool._get( self.CONN_ARGS, False ) for i in range( 2 ) ]
+        for conn in conns :
+            pool._put( self.CONN_ARGS, False, conn )
+        
+        self.assertEqual( pool.getstats()['backends'].values(),
+                          [ { 'opened' : 2, 'idle' : 2 } ] )
+        
+        pool.reap()
+        self.assertEqual( pool.getstats()['reaped'], 0 )
+        
+        time.sleep( 0.06 )
+        
+        # the expired ones are closed at checkout, a new one is made
+        conn = pool._get( self.CONN_ARGS, False )
+        
+        s = pool.getstats()
+        
+        self.assertFalse( conn in conns )
+        self.assertEqual( ( s['reaped'], s['creations'] ), ( 2, 3 ) )
+        self.assertEqual( s['backends'].values(), [ { 'opened' : 1, 'idle' : 0 } ] )
+        
+        pool._put( self.CONN_ARGS, False, conn )
+        time.sleep( 0.06 )
+        pool.reap()
+        
+        s = pool.getstats()
+        
+        self.assertEqual( s['reaped'], 3 )
+        self.assertEqual( s['backends'].values(), [ { 'opened' : 0, 'idle' : 0 } ] )
+    
+    def test_idle_slot_taken_over( self ):
+        
+        pool = self.makepool( maxconnections=1, waittimeout=0.05 )
+        
+        conn = pool._get( self.CONN_ARGS, False )
+        pool._put( self.CONN_ARGS, False, conn )
+        
+        # a write can not share the idle read connection, its slot is taken
+        wconn = pool._get( self.CONN_ARGS, True )
+        
+        self.assertFalse( wconn is conn )
+        self.assertEqual( pool.getstats()['reaped'], 1 )
+        
+        pool._put( self.CONN_ARGS, True, wconn )
+        
+        self.assertEqual( pool.getstats()['backends'].values(),
+                          [ { 'opened' : 0, 'idle' : 0 } ] )
+
+
+class QueryMetricsTest( unittest.TestCase ):
+    
+    def test_reconnect_failure_counted_once( self ):
+        
+        pool = easysqlbench.FakeConnectionPool( metrics=easysql.QueryMetrics() )
+        
+        conns = [ BrokenConnection() ]
+        
+        def connect( conn_args ):
+            if conns :
+                return conns.pop()
+            raise easysql.MySQLdb.OperationalError( 2003, 'refused' )
+        
+        pool._connect = connect
+        
+        conn_args = ( 'fake', 3306, 'user', 'passwd', 'db' )
+        
+        self.assertRaises( easysql.ConnectionError,
+                           pool.read, conn_args, 'SELECT 1' )
+        
+        s = pool.metrics.getstats()['backends'].values()[0]
+        
+        self.assertEqual( s['connectfailed'], 1 )
+        self.assertEqual( s['errors'], 0 )
+
+
+class ConverterTest( unittest.TestCase ):
+    
+    KINDS = easysqlbench.KINDS
+    
+    # ( converter object, values to en, values to de )
+    CASES = [
+        ( easysql.ENUM_INT( KINDS ), [ 'user', 'robot', 'user' ], [ 0, 3, 1 ] ),
+        ( easysql.LIST_MOD( KINDS * 3 ), [ [ 'user' ], [], KINDS ],
+          [ '\x01\x00', '\x00\x00', '\xff\x0f', '\x81\x08' ] ),
+        ( easysql.ANY_JSON, [ {'a':[1,2]}, None, u'x' ],
+          [ '{"a": [1, 2]}', 'null', '"x"', '[]' ] ),
+        ( easysql.HEX_BIN, [ '00ff', '', 'ab' ], [ '\x00\xff', '', '\xab' ] ),
+        ( easysql.BOOL_BIN, [ True, False, 1 ], [ '\x01', '\x00', 'x' ] ),
+        ( easysql.BOOL_NULL, [ True, False ], [ '\x01', None ] ),
+        ( easysql.DATETIME_SQL, [ easysql.datetime.datetime( 2001, 2, 3, 4, 5, 6 ) ],
+          [ easysql.datetime.datetime( 2001, 2, 3, 4, 5, 6 ) ] ),
+      ]
+    
+    def test_many_as_each( self ):
+        
+        for conv, ens, des in self.CASES :
+            for name, xs in ( ( 'en', ens ), ( 'de', des ) ) :
+                
+                one = getattr( conv, name )
+                many = easysql._bulkconv( one )
+                
+                self.assertEqual( list( many( xs )[0] ),
+                                  [ one( x )[0] for x in xs ], ( conv, name ) )
+    
+    def test_json_malformed( self ):
+        
+        many = easysql._bulkconv( easysql.ANY_JSON.de )
+        
+        self.assertRaises( ValueError, many, [ '1,[2', '3]' ] )
+    
+    def test_subclass_overriding_de( self ):
+        
+        class UPPER_ENUM( easysql.ENUM_INT ) :
+            def de( self, x ):
+                return ( self._l[x].upper(), )
+        
+        many = easysql._bulkconv( UPPER_ENUM( self.KINDS ).de )
+        
+        self.assertEqual( list( many( [ 0, 1 ] )[0] ), [ 'USER', 'GROUP' ] )
+        
+        # en is not overridden, its en_many is still used
+        conv = UPPER_ENUM( self.KINDS )
+        self.assertEqual( easysql._bulkconv( conv.en ), conv.en_many )
+
+
+class RowCacheTest( unittest.TestCase ):
+    
+    def test_readthrough( self ):
+        
+        t = maketable( [ ROW, ] )
+        t.setrowcache( ['ID',] )
+        
+        queries = countqueries( t )
+        
+        self.assertEqual( t.get( {'ID':1} )['name'], 'a' )
+        self.assertEqual( t.get( {'ID':1} )['name'], 'a' )
+        self.assertEqual( len(queries), 1 )
+        
+        # a write drops the row
+        t.set( {'ID':1}, {'flag':1} )
+        
+        self.assertEqual( t.get( {'ID':1} )['name'], 'a' )
+        self.assertEqual( len(queries), 2 )
+    
+    def test_key_types( self ):
+        
+        t = maketable( [ ROW, ] )
+        t.setrowcache( ['ID',] )
+        
+        queries = countqueries( t )
+        
+        t.get( {'ID':1} )
+        t.set( {'ID':'1'}, {'flag':1} )
+        
+        self.assertEqual( t.rowcache.getstats()['invalidations'], 1 )
+        
+        t.get( {'ID':1L} )
+        t.get( {'ID':u'1'} )
+        
+        self.assertEqual( len(queries), 2 )
+    
+    def test_read_racing_write( self ):
+        
+        t = maketable( [ ROW, ] )
+        t.setrowcache( ['ID',] )
+        
+        queries = countqueries( t )
+        
+        # the write lands while the row is read from mysql
+        respond = t.connpool.responder
+        
+        def racing( sql ):
+            if queries == [] :
+                t.rowcache.invalidate( t.rowcache.key( {'ID':1} ) )
+            return respond( sql )
+        
+        t.connpool.responder = racing
+        
+        t.get( {'ID':1} )
+        t.get( {'ID':1} )
+        t.get( {'ID':1} )
+        
+        self.assertEqual( len(queries), 2 )
+    
+    def test_lru( self ):
+        
+        cache = easysql.RowCache( ['ID',], maxsize=2 )
+        
+        for i in range( 3 ) :
+            cache.put( (i,), None, { 'ID' : i } )
+        
+        self.assertEqual( cache.get( (0,), None ), easysql.NoArg )
+        self.assertEqual( cache.get( (2,), None ), { 'ID' : 2 } )
+        self.assertEqual( cache.getstats()['evictions'], 1 )
+    
+    def test_ttl( self ):
+        
+        cache = easysql.RowCache( ['ID',], ttl=0.01 )
+        cache.put( (1,), None, { 'ID' : 1 } )
+        
+        time.sleep( 0.02 )
+        
+        self.assertEqual( cache.get( (1,), None ), easysql.NoArg )
+        self.assertEqual( cache.getstats()['expired'], 1 )
+
+
+class MemcacheRowCacheTest( unittest.TestCase ):
+    
+    def setUp( self ):
+        
+        self.server = easymc.FakeMemcacheServer().start()
+        self.mc = easymc.Memcache( *self.server.server_address )
+        
+        self.cache = easysql.MemcacheRowCache( ['ID',], self.mc, 'test' )
+    
+    def tearDown( self ):
+        
+        self.mc.close()
+        self.server.stop()
+    
+    def test_readthrough( self ):
+        
+        t = maketable( [ ROW, ] )
+        t.rowcache = self.cache
+        
+        queries = countqueries( t )
+        
+        self.assertEqual( t.get( {'ID':1} )['name'], 'a' )
+        self.assertEqual( t.get( {'ID':1} )['name'], 'a' )
+        
+        self.assertEqual( len(queries), 1 )
+        self.assertEqual( self.cache.getstats()['hits'], 1 )
+    
+    def test_finite_ttl( self ):
+        
+        self.assertTrue( self.cache.ttl > 0 )
+    
+    def test_fill_does_not_overwrite( self ):
+        
+        self.cache.put( (1,), None, { 'ID' : 1, 'name' : 'new' } )
+        self.cache.put( (1,), None, { 'ID' : 1, 'name' : 'stale' } )
+        
+        self.assertEqual( self.cache.get( (1,), None )['name'], 'new' )
+    
+    def test_lost_generation( self ):
+        
+        self.cache.put( (1,), None, { 'ID' : 1 } )
+        gen = self.cache.gen
+        
+        self.assertNotEqual( gen, 0 )
+        
+        time.sleep( 0.01 )
+        self.mc.delete( self.cache.genkey )
+        self.cache.gen = None
+        
+        self.assertEqual( self.cache.get( (1,), None ), easysql.NoArg )
+        self.assertNotEqual( self.cache.gen, gen )
+    
+    def test_clear( self ):
+        
+        self.cache.put( (1,), None, { 'ID' : 1 } )
+        self.cache.clear()
+        
+        self.assertEqual( self.cache.get( (1,), None ), easysql.NoArg )
+        self.assertEqual( self.cache.getstats()['clears'], 1 )
+
+
+if __name__ == '__main__' :
+    
+    unittest.main()